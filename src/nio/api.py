@@ -23,7 +23,6 @@ client like AsyncClient or HttpClient.
 
 from __future__ import annotations
 
-import json
 import re
 import warnings
 from collections import defaultdict, namedtuple
@@ -41,6 +40,8 @@ from typing import (
 )
 from uuid import UUID
 
+from . import json
+
 if TYPE_CHECKING:
     from .events.account_data import PushAction, PushCondition
 
@@ -174,17 +175,12 @@ class Api:
     @staticmethod
     def to_json(content_dict: Dict[Any, Any]) -> str:
         """Turn a dictionary into a json string."""
-        return json.dumps(content_dict, separators=(",", ":"))
+        return json.dumps(content_dict)
 
     @staticmethod
     def to_canonical_json(content_dict: Dict[Any, Any]) -> str:
         """Turn a dictionary into a canonical json string."""
-        return json.dumps(
-            content_dict,
-            ensure_ascii=False,
-            separators=(",", ":"),
-            sort_keys=True,
-        )
+        return json.canonical_dumps(content_dict)
 
     @staticmethod
     def mimetype_to_msgtype(mimetype: str) -> str:
@@ -596,7 +592,7 @@ class Api:
             query_parameters["set_presence"] = set_presence
 
         if isinstance(filter, dict):
-            filter_json = json.dumps(filter, separators=(",", ":"))
+            filter_json = json.dumps(filter)
             query_parameters["filter"] = filter_json
         elif isinstance(filter, str):
             query_parameters["filter"] = filter
@@ -1253,7 +1249,7 @@ class Api:
         query_parameters["dir"] = direction.value
 
         if isinstance(message_filter, dict):
-            filter_json = json.dumps(message_filter, separators=(",", ":"))
+            filter_json = json.dumps(message_filter)
             query_parameters["filter"] = filter_json
 
         path = ["rooms", room_id, "messages"]
@@ -15,11 +15,13 @@
 
 import asyncio
 import io
-import json
 import logging
 import os
+import time
 import warnings
 from asyncio import Event as AsyncioEvent
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import partial, wraps
 from json.decoder import JSONDecodeError
@@ -29,6 +31,7 @@ from typing import (
     AsyncIterator,
     Callable,
     Coroutine,
+    DefaultDict,
     Dict,
     Iterable,
     List,
@@ -55,7 +58,9 @@ from aiohttp import (
 from aiohttp.client_exceptions import ClientConnectionError
 from aiohttp.connector import Connection
 from aiohttp_socks import ProxyConnector
+from jsonschema.exceptions import SchemaError, ValidationError
 
+from .. import json
 from ..api import (
     Api,
     EventFormat,
@@ -71,6 +76,7 @@ from ..api import (
     _FilterT,
 )
 from ..crypto import (
+    ENCRYPTION_ENABLED,
     AsyncDataT,
     OlmDevice,
     async_encrypt_attachment,
@@ -90,7 +96,7 @@ from ..events import (
     RoomKeyRequestCancellation,
     ToDeviceEvent,
 )
-from ..exceptions import LocalProtocolError, TransferCancelledError
+from ..exceptions import LocalProtocolError, OlmTrustError, TransferCancelledError
 from ..monitors import TransferMonitor
 from ..responses import (
     ContentRepositoryConfigError,
@@ -195,6 +201,7 @@ from ..responses import (
     RoomRedactResponse,
     RoomResolveAliasError,
     RoomResolveAliasResponse,
+    Rooms,
     RoomSendError,
     RoomSendResponse,
     RoomThreadsResponse,
@@ -231,6 +238,7 @@ from ..responses import (
     WhoamiResponse,
 )
 from ..rooms import MatrixRoom
+from ..streaming import SyncStreamParser
 from .base_client import (
     Client,
     ClientCallback,
@@ -239,6 +247,10 @@ from .base_client import (
     store_loaded,
 )
 
+if ENCRYPTION_ENABLED:
+    from ..crypto import LazyGroupSessionStore
+    from ..store import AsyncMatrixStore, MatrixStore
+
 _ShareGroupSessionT = Union[ShareGroupSessionError, ShareGroupSessionResponse]
 
 _ProfileGetDisplayNameT = Union[
@@ -310,6 +322,34 @@ def client_session(func):
     return wrapper
 
 
+class RateLimitBackoff:
+    """A backoff that is shared between concurrent requests.
+
+    Once one of the requests gets rate limited by the server every request
+    using the backoff waits before it's sent, instead of each one retrying
+    on its own and hitting the limit again.
+
+    Attributes:
+        resume_at (float): The event loop time at which requests may be sent
+            again.
+    """
+
+    def __init__(self) -> None:
+        self.resume_at = 0.0
+
+    def rate_limited(self, delay: float) -> None:
+        """Hold back all requests for the given amount of seconds."""
+        loop = asyncio.get_running_loop()
+        self.resume_at = max(self.resume_at, loop.time() + delay)
+
+    async def wait(self) -> None:
+        """Wait until requests may be sent again."""
+        loop = asyncio.get_running_loop()
+
+        while (delay := self.resume_at - loop.time()) > 0:  # noqa: ASYNC110
+            await asyncio.sleep(delay)
+
+
 @dataclass(frozen=True)
 class AsyncClientConfig(ClientConfig):
     """Async nio client configuration.
@@ -347,6 +387,101 @@ class AsyncClientConfig(ClientConfig):
         io_chunk_size (int): The size (in bytes) of the chunks to read from the IO
             streams when saving files to disk.
             Defaults to 64 KiB.
+
+        lazy_sync_parsing (bool): Parse the state, timeline and account data
+            events of sync responses on first access instead of all at once.
+            The event lists of the RoomInfo objects will be LazyEventList
+            objects instead of plain lists.
+            Defaults to False.
+
+        streaming_sync_parsing (bool): Parse the body of successful sync
+            responses incrementally while it's being downloaded. Every room is
+            parsed as soon as it has arrived, the full body is never held in
+            memory at once.
+            Defaults to False.
+
+        megolm_decryption_workers (int, optional): The number of threads
+            that decrypt the Megolm events of sync responses. None uses the
+            default executor of the event loop, 0 decrypts the events on the
+            event loop itself.
+            Defaults to None.
+
+        megolm_decryption_batch_size (int): The number of Megolm events,
+            grouped by their session, that are decrypted as a single unit of
+            work.
+            Defaults to 100.
+
+        olm_encryption_workers (int, optional): The number of threads that
+            encrypt the room key for the recipient devices when a group
+            session is shared. The to-device requests are sent as soon as
+            their messages are encrypted. None uses the default executor of
+            the event loop, 0 encrypts the room key on the event loop itself.
+            Defaults to 0.
+
+        max_to_device_requests (int): The maximum number of to-device
+            requests that are in flight at once when a group session is
+            shared. If the server rate limits one of the requests, all of
+            them back off together.
+            Defaults to 8.
+
+        max_key_query_users (int): The maximum number of users whose keys
+            are queried in a single keys query request, keys_query() splits
+            larger queries into multiple requests.
+            Defaults to 250.
+
+        max_key_query_requests (int): The maximum number of keys query
+            requests that are in flight at once.
+            Defaults to 4.
+
+        max_key_claim_devices (int): The maximum number of devices whose
+            one-time keys are claimed in a single keys claim request,
+            keys_claim() splits larger claims into multiple requests.
+            Defaults to 250.
+
+        max_key_claim_requests (int): The maximum number of keys claim
+            requests that are in flight at once.
+            Defaults to 4.
+
+        one_time_key_preclaiming (bool): Claim one-time keys for the devices
+            in encrypted rooms that we don't have an Olm session with in the
+            background, after every sync of sync_forever(). Sharing a group
+            session with new devices then doesn't need to wait for the keys
+            to be claimed.
+            Defaults to False.
+
+        group_session_presharing (bool): Share the group sessions of rooms
+            that messages were recently sent to in the background, after
+            every sync of sync_forever(). Membership and device changes, as
+            well as the rotation of sessions, are handled ahead of time so
+            room_send() usually only needs to encrypt the message.
+            Defaults to False.
+
+        presharing_active_time (float): The number of seconds after the last
+            room_send() call for a room that its group session is kept shared
+            in the background. Rooms that are idle for longer aren't touched.
+            Defaults to 3600.
+
+        presharing_max_rooms (int): The maximum number of rooms whose group
+            sessions are shared in the background at once.
+            Defaults to 4.
+
+        presharing_rotation_margin (float): The fraction of the message count
+            and age limits of a group session that a replacement is shared
+            ahead of the rotation in the background.
+            Defaults to 0.1.
+
+        store_maintenance_interval (float, optional): The number of seconds
+            between two runs of prune_store_in_background() by
+            sync_forever(), the first run happens one interval after the
+            client was created. None disables the maintenance.
+            Defaults to None.
+
+        store_thread (bool): Run the store on a dedicated database thread
+            using an AsyncMatrixStore so the event loop doesn't wait for the
+            disk. Writes are queued and committed in groups, store_write_behind
+            is ignored. Only applies to the SQLite stores, can't be used with
+            the SqliteMemoryStore.
+            Defaults to False.
     """
 
     max_limit_exceeded: Optional[int] = None
@@ -355,6 +490,23 @@ class AsyncClientConfig(ClientConfig):
     max_timeout_retry_wait_time: float = 60
     request_timeout: float = 60
     io_chunk_size: int = 64 * 1024
+    lazy_sync_parsing: bool = False
+    streaming_sync_parsing: bool = False
+    megolm_decryption_workers: Optional[int] = None
+    megolm_decryption_batch_size: int = 100
+    olm_encryption_workers: Optional[int] = 0
+    max_to_device_requests: int = 8
+    max_key_query_users: int = 250
+    max_key_query_requests: int = 4
+    max_key_claim_devices: int = 250
+    max_key_claim_requests: int = 4
+    one_time_key_preclaiming: bool = False
+    group_session_presharing: bool = False
+    presharing_active_time: float = 3600
+    presharing_max_rooms: int = 4
+    presharing_rotation_margin: float = 0.1
+    store_maintenance_interval: Optional[float] = None
+    store_thread: bool = False
 
 
 class AsyncClient(Client):
@@ -440,6 +592,24 @@ class AsyncClient(Client):
         self.response_callbacks: List[ClientCallback] = []
 
         self.sharing_session: Dict[str, AsyncioEvent] = {}
+        self._to_device_backoff = RateLimitBackoff()
+
+        # The time of the last room_send() call for an encrypted room and
+        # whether unverified devices were ignored, used for presharing.
+        self._room_activity: Dict[str, Tuple[float, bool]] = {}
+        self._presharing: Dict[str, asyncio.Future] = {}
+
+        # Devices that one-time keys were claimed for in the background, the
+        # claim isn't repeated if it didn't result in an Olm session.
+        self._preclaimed_devices: Set[Tuple[str, str]] = set()
+        self._preclaiming: Optional[asyncio.Future] = None
+
+        self._last_store_maintenance = time.monotonic()
+        self._store_maintenance: Optional[asyncio.Future] = None
+        self.async_store: Optional[AsyncMatrixStore] = None
+
+        self._decryption_executor: Optional[ThreadPoolExecutor] = None
+        self._encryption_executor: Optional[ThreadPoolExecutor] = None
 
         is_config = isinstance(config, ClientConfig)
         is_async_config = isinstance(config, AsyncClientConfig)
@@ -498,7 +668,7 @@ class AsyncClient(Client):
         Returns a dictionary representing the response.
         """
         try:
-            return await transport_response.json()
+            return await transport_response.json(loads=json.loads)
         except (JSONDecodeError, ContentTypeError):
             try:
                 # matrix.org return an incorrect content-type for .well-known
@@ -509,6 +679,41 @@ class AsyncClient(Client):
 
             return {}
 
+    async def parse_sync_body(
+        self, transport_response: ClientResponse, lazy: bool = False
+    ) -> Union[SyncResponse, SyncError]:
+        """Parse the body of a sync response while it's being downloaded.
+
+        Low-level function which is normally only used by other methods of
+        this class.
+
+        Args:
+            transport_response(ClientResponse): The transport response that
+                contains the body of the sync response.
+            lazy (bool): Should the events of the rooms be parsed lazily.
+
+        Returns either a `SyncResponse` or a `SyncError` if the body isn't a
+        valid sync response.
+        """
+        parser = SyncStreamParser()
+        rooms = Rooms({}, {}, {})
+
+        try:
+            async for chunk in transport_response.content.iter_chunked(
+                self.config.io_chunk_size
+            ):
+                for room in parser.feed(chunk):
+                    SyncResponse.add_streamed_room(rooms, *room, lazy)
+
+            for room in parser.close():
+                SyncResponse.add_streamed_room(rooms, *room, lazy)
+
+        except (JSONDecodeError, SchemaError, ValidationError) as e:
+            logger.warning(f"Error parsing sync response: {e}")
+            return SyncError("unknown error")
+
+        return SyncResponse.from_dict(parser.result, lazy, rooms)
+
     async def create_matrix_response(
         self,
         response_class: Type,
@@ -571,6 +776,13 @@ class AsyncClient(Client):
             parsed_dict = await self.parse_body(transport_response)
             resp = response_class.create_error(parsed_dict, data[-1])
 
+        elif (
+            response_class is SyncResponse
+            and self.config.streaming_sync_parsing
+            and transport_response.status == 200
+        ):
+            resp = await self.parse_sync_body(transport_response, *data)
+
         elif (
             transport_response.status == 401 and response_class == DeleteDevicesResponse
         ):
@@ -615,6 +827,72 @@ class AsyncClient(Client):
 
                 await self._on_invited_rooms(event, room)
 
+    async def _decrypt_megolm_events(
+        self, room_id: str, events: Sequence[Union[Event, BadEventType]]
+    ) -> Dict[int, Union[Event, BadEventType]]:
+        """Decrypt the Megolm events of a room timeline.
+
+        The events are decrypted in batches, either in a thread pool or on the
+        event loop, yielding control back to it between every batch.
+
+        Returns a dictionary mapping the index of every event that could be
+        decrypted to the decrypted event.
+        """
+        if not self.olm:
+            return {}
+
+        indices = []
+        megolm_events = []
+
+        for index, event in enumerate(events):
+            if isinstance(event, MegolmEvent):
+                event.room_id = room_id
+                indices.append(index)
+                megolm_events.append(event)
+
+        if not megolm_events:
+            return {}
+
+        batches = self.olm.megolm_decryption_batches(
+            megolm_events, room_id, self.config.megolm_decryption_batch_size
+        )
+
+        if self.config.megolm_decryption_workers == 0:
+            payloads = []
+
+            for batch in batches:
+                payloads.append(self.olm.decrypt_megolm_batch(batch))
+                await asyncio.sleep(0)
+        else:
+            if (
+                self._decryption_executor is None
+                and self.config.megolm_decryption_workers is not None
+            ):
+                self._decryption_executor = ThreadPoolExecutor(
+                    self.config.megolm_decryption_workers,
+                    thread_name_prefix="nio-decryption",
+                )
+
+            loop = asyncio.get_event_loop()
+            payloads = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self._decryption_executor,
+                        self.olm.decrypt_megolm_batch,
+                        batch,
+                    )
+                    for batch in batches
+                )
+            )
+
+        decrypted = {}
+
+        for batch, batch_payloads in zip(batches, payloads):
+            for index, event in self.olm.finish_megolm_batch(batch, batch_payloads):
+                decrypted[indices[index]] = event
+
+        return decrypted
+
     async def _handle_joined_rooms(self, response: SyncResponse) -> None:
         encrypted_rooms: Set[str] = set()
 
@@ -622,21 +900,20 @@ class AsyncClient(Client):
             self._handle_joined_state(room_id, join_info, encrypted_rooms)
 
             room = self.rooms[room_id]
-            decrypted_events: List[Tuple[int, Union[Event, BadEventType]]] = []
+            decrypted_events = await self._decrypt_megolm_events(
+                room_id, join_info.timeline.events
+            )
 
             for index, event in enumerate(join_info.timeline.events):
-                decrypted_event = self._handle_timeline_event(
-                    event, room_id, room, encrypted_rooms
+                event = decrypted_events.get(index, event)
+                self._handle_timeline_event(
+                    event, room_id, room, encrypted_rooms, decrypt=False
                 )
 
-                if decrypted_event:
-                    event = decrypted_event
-                    decrypted_events.append((index, decrypted_event))
-
                 await self._on_event(event, room)
 
             # Replace the Megolm events with decrypted ones
-            for index, event in decrypted_events:
+            for index, event in decrypted_events.items():
                 join_info.timeline.events[index] = event
 
             for event in join_info.ephemeral:
@@ -769,6 +1046,11 @@ class AsyncClient(Client):
 
         if isinstance(response, SyncResponse):
             await self._handle_sync(response)
+
+            if self.async_store:
+                await self.async_store.flush()
+            elif self.store:
+                self.store.flush()
         else:
             super().receive_response(response)
 
@@ -791,6 +1073,7 @@ class AsyncClient(Client):
         timeout: Optional[float] = None,  # noqa: ASYNC109
         content_length: Optional[int] = None,
         save_to: Optional[os.PathLike] = None,
+        backoff: Optional[RateLimitBackoff] = None,
     ):
         headers = request.headers.copy()
 
@@ -809,6 +1092,9 @@ class AsyncClient(Client):
         max_timeouts = self.config.max_timeouts
 
         while True:
+            if backoff:
+                await backoff.wait()
+
             if data_provider:
                 # mypy expects an "Awaitable[Any]" but data_provider is a
                 # method generated during runtime that may or may not be
@@ -849,7 +1135,11 @@ class AsyncClient(Client):
                         "Got 429 response (ratelimited), sleeping for %dms",
                         retry_after_ms,
                     )
-                    await asyncio.sleep(retry_after_ms / 1000)
+
+                    if backoff:
+                        backoff.rate_limited(retry_after_ms / 1000)
+                    else:
+                        await asyncio.sleep(retry_after_ms / 1000)
                 else:
                     break
 
@@ -1218,6 +1508,7 @@ class AsyncClient(Client):
         response = await self._send(
             SyncResponse,
             request,
+            response_data=(self.config.lazy_sync_parsing,),
             # 0 if full_state: server doesn't respect timeout if full_state
             # + 15: give server a chance to naturally return before we timeout
             timeout=0 if full_state else timeout / 1000 + 15 if timeout else timeout,
@@ -1231,18 +1522,65 @@ class AsyncClient(Client):
     ) -> List[Union[ToDeviceResponse, ToDeviceError]]:
         """Send out outgoing to-device messages.
 
+        Messages of the same type are sent together, in as few requests as
+        possible.
+
         Automatically called by sync_forever().
+
+        Returns a response for every message that was sent out. Messages
+        that were sent in the same request share the outcome of the request.
         """
         if not self.outgoing_to_device_messages:
             return []
 
-        tasks = []
+        assert self.olm
+
+        responses = await asyncio.gather(
+            *(
+                self._send_to_device_batch(batch)
+                for batch in self.olm.to_device_message_batches()
+            )
+        )
+
+        return [response for batch in responses for response in batch]
 
-        for message in self.outgoing_to_device_messages:
-            task = asyncio.ensure_future(self.to_device(message))
-            tasks.append(task)
+    async def _send_to_device_batch(
+        self, batch: List[ToDeviceMessage]
+    ) -> List[Union[ToDeviceResponse, ToDeviceError]]:
+        messages: DefaultDict[str, Dict[str, Any]] = defaultdict(dict)
+
+        for message in batch:
+            messages[message.recipient][message.recipient_device] = message.content
+
+        request = Api.to_device(
+            self.access_token, batch[0].type, {"messages": messages}, uuid4()
+        )
+        response = await self._send(
+            ToDeviceResponse,
+            request,
+            response_data=(batch[0],),
+            backoff=self._to_device_backoff,
+        )
 
-        return await asyncio.gather(*tasks)
+        responses = [response]
+
+        for message in batch[1:]:
+            if isinstance(response, ToDeviceResponse):
+                merged = ToDeviceResponse(message)
+                await self.receive_response(merged)
+                responses.append(merged)
+            else:
+                responses.append(
+                    ToDeviceError(
+                        response.message,
+                        response.status_code,
+                        response.retry_after_ms,
+                        response.soft_logout,
+                        message,
+                    )
+                )
+
+        return responses
 
     async def run_response_callbacks(
         self, responses: List[Union[Response, ErrorResponse]]
@@ -1379,6 +1717,16 @@ class AsyncClient(Client):
                 self.synced.set()
                 self.synced.clear()
 
+                if self.config.one_time_key_preclaiming:
+                    self.preclaim_one_time_keys()
+
+                if self.config.group_session_presharing:
+                    self.preshare_group_sessions()
+
+                if self._store_maintenance_due():
+                    self._last_store_maintenance = time.monotonic()
+                    self.prune_store_in_background()
+
                 if loop_sleep_time:
                     await asyncio.sleep(loop_sleep_time / 1000)
 
@@ -1566,19 +1914,61 @@ class AsyncClient(Client):
 
         Calls receive_response() to update the client state if necessary.
 
+        The users are split into chunks of
+        AsyncClientConfig.max_key_query_users users, at most
+        AsyncClientConfig.max_key_query_requests of them are queried at once.
+        Every chunk is handled and its devices are stored as soon as its
+        response arrives. Users are only removed from the set of users that
+        need a key query once their chunk succeeded, calling this method again
+        after a failure only queries the remaining users.
+
+        Returns a KeysQueryResponse containing the keys of all the chunks, or
+        the KeysQueryError of the first chunk that failed.
+
         Raises LocalProtocolError if the client isn't logged in, if the session
         store isn't loaded or if no key query needs to be performed.
         """
-        user_list = self.users_for_key_query
+        user_list = list(self.users_for_key_query)
 
         if not user_list:
             raise LocalProtocolError("No key query required.")
 
-        # TODO pass the sync token here if it's a device update that triggered
-        # our need for a key query.
-        request = Api.keys_query(self.access_token, user_list)
+        # Our latest sync token is at least as new as the device list updates
+        # that made the query necessary, the server can answer the query
+        # from its caches up to that point.
+        token = self.next_batch or None
+        chunk_size = self.config.max_key_query_users
+        in_flight = asyncio.Semaphore(self.config.max_key_query_requests)
+
+        async def query_chunk(
+            users: List[str],
+        ) -> Union[KeysQueryResponse, KeysQueryError]:
+            async with in_flight:
+                request = Api.keys_query(self.access_token, users, token)
+                return await self._send(KeysQueryResponse, request)
+
+        responses = await asyncio.gather(
+            *(
+                query_chunk(user_list[i : i + chunk_size])
+                for i in range(0, len(user_list), chunk_size)
+            )
+        )
+
+        if len(responses) == 1:
+            return responses[0]
+
+        for response in responses:
+            if isinstance(response, KeysQueryError):
+                return response
+
+        merged = KeysQueryResponse({}, {})
+
+        for response in responses:
+            merged.device_keys.update(response.device_keys)
+            merged.failures.update(response.failures)
+            merged.changed.update(response.changed)
 
-        return await self._send(KeysQueryResponse, request)
+        return merged
 
     @logged_in_async
     async def devices(self) -> Union[DevicesResponse, DevicesError]:
@@ -1781,18 +2171,39 @@ class AsyncClient(Client):
                     if self.should_query_keys:
                         responses.append(await self.keys_query())
 
+                self._room_activity[room_id] = (
+                    time.monotonic(),
+                    ignore_unverified_devices,
+                )
+
                 # Check if we need to share a group session, it might have been
-                # invalidated or expired.
-                if self.olm.should_share_group_session(room_id):
+                # invalidated or expired. If the session is being shared in
+                # the background wait for it, and check again in case that
+                # failed.
+                while self.olm.should_share_group_session(room_id):
                     try:
                         event = self.sharing_session[room_id]
-                        await event.wait()
                     except KeyError:
-                        await self.share_group_session(
+                        response = await self.share_group_session(
                             room_id,
                             ignore_unverified_devices=ignore_unverified_devices,
                         )
 
+                        # Send the message even if some of the devices didn't
+                        # receive the session, they won't be able to decrypt
+                        # it but the rest of the room will.
+                        if isinstance(response, ShareGroupSessionError):
+                            logger.warning(
+                                f"Error sharing the group session for room "
+                                f"{room_id}: {response}"
+                            )
+                            self.olm.outbound_group_sessions[room_id].shared = True
+                            self.olm.save_outbound_group_session(room_id)
+
+                        break
+
+                    await event.wait()
+
                 # Reactions as of yet don't support encryption.
                 # Relevant spec proposal https://github.com/matrix-org/matrix-doc/pull/1849
                 if message_type != "m.reaction":
@@ -2170,19 +2581,69 @@ class AsyncClient(Client):
 
         Calls receive_response() to update the client state if necessary.
 
+        Claims for more than AsyncClientConfig.max_key_claim_devices devices
+        are split into chunks, at most AsyncClientConfig.max_key_claim_requests
+        of them are in flight at once. The Olm sessions of a chunk are created
+        as soon as its response arrives.
+
         Args:
             user_set(Dict[str, Iterator[str]]): A dictionary mapping from a user
                 id to a iterator of device ids. If a user set for a specific
                 room is required it can be obtained using the
                 `get_missing_sessions()` method.
 
+        Returns a KeysClaimResponse containing the one-time keys of all the
+        chunks, or the KeysClaimError of the first chunk that failed.
+
         Raises LocalProtocolError if the client isn't logged in, if the session
         store isn't loaded, no room with the given room id exists or the room
         isn't an encrypted room.
         """
-        request = Api.keys_claim(self.access_token, user_set)
+        devices = [
+            (user_id, device_id)
+            for user_id, device_ids in user_set.items()
+            for device_id in device_ids
+        ]
+        chunk_size = self.config.max_key_claim_devices
+
+        if len(devices) <= chunk_size:
+            request = Api.keys_claim(self.access_token, user_set)
+            return await self._send(KeysClaimResponse, request)
+
+        in_flight = asyncio.Semaphore(self.config.max_key_claim_requests)
+
+        async def claim_chunk(
+            chunk: List[Tuple[str, str]],
+        ) -> Union[KeysClaimResponse, KeysClaimError]:
+            chunk_set: DefaultDict[str, List[str]] = defaultdict(list)
+
+            for user_id, device_id in chunk:
+                chunk_set[user_id].append(device_id)
+
+            async with in_flight:
+                request = Api.keys_claim(self.access_token, chunk_set)
+                return await self._send(KeysClaimResponse, request)
+
+        responses = await asyncio.gather(
+            *(
+                claim_chunk(devices[i : i + chunk_size])
+                for i in range(0, len(devices), chunk_size)
+            )
+        )
+
+        for response in responses:
+            if isinstance(response, KeysClaimError):
+                return response
 
-        return await self._send(KeysClaimResponse, request)
+        merged = KeysClaimResponse({}, {})
+
+        for response in responses:
+            for user_id, keys in response.one_time_keys.items():
+                merged.one_time_keys.setdefault(user_id, {}).update(keys)
+
+            merged.failures.update(response.failures)
+
+        return merged
 
     @logged_in_async
     @store_loaded
@@ -2190,6 +2651,7 @@ class AsyncClient(Client):
         self,
         room_id: str,
         ignore_unverified_devices: bool = False,
+        progress_callback: Optional[Callable[[_ShareGroupSessionT], Any]] = None,
     ) -> Union[ShareGroupSessionResponse, ShareGroupSessionError]:
         """Share a group session with a room.
 
@@ -2199,13 +2661,25 @@ class AsyncClient(Client):
 
         Calls receive_response() to update the client state if necessary.
 
+        The to-device messages are sent in chunks as soon as they are
+        encrypted, AsyncClientConfig.max_to_device_requests limits how many
+        of them are in flight at once.
+
+        If some of the chunks can't be sent, the session isn't marked as
+        shared and a ShareGroupSessionError containing the devices that didn't
+        receive the session is returned. Calling this method again resumes
+        the sharing, the session is only sent to the remaining devices.
+
         Args:
             room_id(str): The room id of the room where the message should be
                 sent to.
             ignore_unverified_devices(bool): Mark unverified devices as
                 ignored. Ignored devices will still receive encryption
                 keys for messages but they won't be marked as verified.
-
+            progress_callback(Callable, optional): A function or coroutine
+                that is called with the response of every chunk, either a
+                ShareGroupSessionResponse or a ShareGroupSessionError
+                containing the devices of the chunk.
 
         Raises LocalProtocolError if the client isn't logged in, if the session
         store isn't loaded, no room with the given room id exists, the room
@@ -2227,50 +2701,351 @@ class AsyncClient(Client):
 
         self.sharing_session[room_id] = AsyncioEvent()
 
+        # Don't claim one-time keys that are being claimed in the background.
+        if self._preclaiming:
+            await asyncio.wait([self._preclaiming])
+
         missing_sessions = self.get_missing_sessions(room_id)
 
         if missing_sessions:
             await self.keys_claim(missing_sessions)
 
-        shared_with = set()
+        shared_with: Set[Tuple[str, str]] = set()
+        failed: Set[Tuple[str, str]] = set()
 
-        try:
-            requests = []
+        in_flight = asyncio.Semaphore(self.config.max_to_device_requests)
+        requests = []
+
+        async def send_chunk(
+            sharing_with: Set[Tuple[str, str]], to_device_dict: Dict[str, Any]
+        ):
+            request = Api.to_device(
+                self.access_token, "m.room.encrypted", to_device_dict, uuid4()
+            )
+
+            try:
+                response = await self._send(
+                    ShareGroupSessionResponse,
+                    request,
+                    response_data=(room_id, sharing_with),
+                    backoff=self._to_device_backoff,
+                )
+            except (ClientConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+                response = ShareGroupSessionError(
+                    str(e) or type(e).__name__,
+                    room_id=room_id,
+                    users_shared_with=sharing_with,
+                )
+            finally:
+                in_flight.release()
 
-            for sharing_with, to_device_dict in self.olm.share_group_session_parallel(
+            if isinstance(response, ShareGroupSessionResponse):
+                shared_with.update(response.users_shared_with)
+            else:
+                failed.update(sharing_with)
+
+            if progress_callback:
+                await ClientCallback(progress_callback).async_execute(response)
+
+        try:
+            async for sharing_with, to_device_dict in self._group_session_chunks(
                 room_id,
                 list(room.users.keys()),
-                ignore_unverified_devices=ignore_unverified_devices,
+                ignore_unverified_devices,
             ):
-                request = Api.to_device(
-                    self.access_token, "m.room.encrypted", to_device_dict, uuid4()
-                )
-
+                await in_flight.acquire()
                 requests.append(
-                    self._send(
-                        ShareGroupSessionResponse,
-                        request,
-                        response_data=(room_id, sharing_with),
-                    )
+                    asyncio.ensure_future(send_chunk(sharing_with, to_device_dict))
                 )
 
-            for response in await asyncio.gather(*requests, return_exceptions=True):
-                if isinstance(response, ShareGroupSessionResponse):
-                    shared_with.update(response.users_shared_with)
+            await asyncio.gather(*requests)
+
+            if failed:
+                return ShareGroupSessionError(
+                    f"Failed to share the group session with {len(failed)} devices",
+                    room_id=room_id,
+                    users_shared_with=failed,
+                )
 
             # Mark the session as shared, usually the olm machine will do this
             # for us, but if there was no-one to share the session with it we
             # need to do it ourselves.
             self.olm.outbound_group_sessions[room_id].shared = True
+            self.olm.save_outbound_group_session(room_id)
 
-        except ClientConnectionError:
-            raise
         finally:
+            for request in requests:
+                request.cancel()
+
             event = self.sharing_session.pop(room_id)
             event.set()
 
         return ShareGroupSessionResponse(room_id, shared_with)
 
+    def _store_maintenance_due(self) -> bool:
+        interval = self.config.store_maintenance_interval
+
+        if interval is None or not self.olm:
+            return False
+
+        return time.monotonic() - self._last_store_maintenance >= interval
+
+    def prune_store_in_background(self) -> Optional[asyncio.Future]:
+        """Run prune_store() in the background.
+
+        If AsyncClientConfig.store_thread is enabled the store is pruned and
+        vacuumed on the database thread, the event loop only forgets the
+        pruned sessions and devices. Otherwise the store is pruned on the
+        event loop once the task runs.
+
+        Automatically called by sync_forever() if
+        AsyncClientConfig.store_maintenance_interval is set.
+
+        Returns the task that was started, or None if the previous one is
+        still running.
+        """
+        if not self.olm or (
+            self._store_maintenance and not self._store_maintenance.done()
+        ):
+            return None
+
+        self._store_maintenance = asyncio.ensure_future(self._prune_store())
+
+        return self._store_maintenance
+
+    async def _prune_store(self) -> None:
+        assert self.olm
+
+        try:
+            if not self.async_store:
+                self.prune_store()
+                return
+
+            users = self._users_to_prune()
+            max_olm_sessions = self.config.store_max_olm_sessions
+            self.olm.prune_memory(max_olm_sessions, users)
+            result = await self.async_store.prune(max_olm_sessions, users)
+        except Exception as e:
+            logger.warning(f"Error pruning the store: {e}")
+            return
+
+        logger.info(f"Pruned the store: {result}")
+
+    def preclaim_one_time_keys(self) -> Optional[asyncio.Future]:
+        """Claim one-time keys for new devices in the background.
+
+        Creates Olm sessions with the devices of encrypted rooms that we
+        don't have a session with yet, so sharing a group session with them
+        doesn't have to wait for the keys to be claimed. Keys are only claimed
+        once for every device, and only one background claim runs at a time.
+
+        Automatically called by sync_forever() if
+        AsyncClientConfig.one_time_key_preclaiming is enabled.
+
+        Returns the task that was started, or None if there are no new devices
+        or a claim is still in flight.
+        """
+        if not self.olm or (self._preclaiming and not self._preclaiming.done()):
+            return None
+
+        users = {
+            user_id
+            for room in self.rooms.values()
+            if room.encrypted
+            for user_id in room.users
+        }
+        missing: DefaultDict[str, List[str]] = defaultdict(list)
+
+        for user_id in users:
+            for device in self.olm.device_store.active_user_devices(user_id):
+                if (
+                    (user_id, device.id) in self._preclaimed_devices
+                    or device.id == self.device_id
+                    or self.olm.session_store.get(device.curve25519)
+                ):
+                    continue
+
+                missing[user_id].append(device.id)
+
+        if not missing:
+            return None
+
+        self._preclaiming = asyncio.ensure_future(self._preclaim_one_time_keys(missing))
+
+        return self._preclaiming
+
+    async def _preclaim_one_time_keys(self, user_set: Dict[str, List[str]]) -> None:
+        device_count = sum(len(devices) for devices in user_set.values())
+        logger.info(f"Claiming one-time keys for {device_count} devices in advance")
+
+        try:
+            response = await self.keys_claim(user_set)
+        except (ClientConnectionError, LocalProtocolError) as e:
+            logger.warning(f"Error claiming one-time keys in advance: {e}")
+            return
+
+        if isinstance(response, KeysClaimError):
+            logger.warning(f"Error claiming one-time keys in advance: {response}")
+            return
+
+        # Only remember the devices once the claim went through, a failed
+        # claim is retried the next time.
+        self._preclaimed_devices.update(
+            (user_id, device_id)
+            for user_id, device_ids in user_set.items()
+            for device_id in device_ids
+        )
+
+    def preshare_group_sessions(self) -> List[asyncio.Future]:
+        """Share the group sessions of active rooms in the background.
+
+        Rooms are active if a message was sent to them using room_send()
+        in the last AsyncClientConfig.presharing_active_time seconds. For
+        every active encrypted room the members are synced and the group
+        session is shared if it was invalidated, has expired or is about to
+        be rotated. At most
+        AsyncClientConfig.presharing_max_rooms rooms, the most recently
+        active ones first, are handled at once.
+
+        Automatically called by sync_forever() if
+        AsyncClientConfig.group_session_presharing is enabled.
+
+        Returns the tasks that were started.
+        """
+        if not self.olm:
+            return []
+
+        now = time.monotonic()
+        started = []
+
+        for room_id, (last_active, ignore_unverified_devices) in sorted(
+            self._room_activity.items(), key=lambda item: item[1][0], reverse=True
+        ):
+            if now - last_active > self.config.presharing_active_time:
+                del self._room_activity[room_id]
+                continue
+
+            if len(self._presharing) >= self.config.presharing_max_rooms:
+                break
+
+            if room_id in self._presharing or room_id in self.sharing_session:
+                continue
+
+            room = self.rooms.get(room_id)
+
+            if not room or not room.encrypted:
+                del self._room_activity[room_id]
+                continue
+
+            if not self._should_preshare_group_session(room):
+                continue
+
+            task = asyncio.ensure_future(
+                self._preshare_group_session(room, ignore_unverified_devices)
+            )
+            task.add_done_callback(lambda _, r=room_id: self._presharing.pop(r, None))
+            self._presharing[room_id] = task
+            started.append(task)
+
+        return started
+
+    def _should_preshare_group_session(self, room: MatrixRoom) -> bool:
+        assert self.olm
+
+        if not room.members_synced:
+            return True
+
+        session = self.olm.outbound_group_sessions.get(room.room_id)
+
+        return (
+            not session
+            or not session.shared
+            or session.should_rotate(self.config.presharing_rotation_margin)
+        )
+
+    async def _preshare_group_session(
+        self, room: MatrixRoom, ignore_unverified_devices: bool
+    ) -> None:
+        assert self.olm
+        room_id = room.room_id
+
+        try:
+            if not room.members_synced:
+                await self.joined_members(room_id)
+
+            if room_id in self.sharing_session:
+                return
+
+            session = self.olm.outbound_group_sessions.get(room_id)
+
+            # Replace a session that is about to expire before room_send()
+            # has to do so, the new session is shared right away.
+            if session and session.should_rotate(
+                self.config.presharing_rotation_margin
+            ):
+                self.olm.create_outbound_group_session(room_id)
+
+            if self.olm.should_share_group_session(room_id):
+                logger.info(f"Sharing the group session for {room_id} in advance")
+                response = await self.share_group_session(
+                    room_id, ignore_unverified_devices=ignore_unverified_devices
+                )
+
+                if isinstance(response, ShareGroupSessionError):
+                    logger.warning(
+                        f"Error sharing the group session for room {room_id} "
+                        f"in advance: {response}"
+                    )
+
+        except (ClientConnectionError, LocalProtocolError, OlmTrustError) as e:
+            logger.warning(
+                f"Error sharing the group session for room {room_id} in advance: {e}"
+            )
+
+    async def _group_session_chunks(
+        self, room_id: str, users: List[str], ignore_unverified_devices: bool
+    ) -> AsyncIterator[Tuple[Set[Tuple[str, str]], Dict[str, Any]]]:
+        """Encrypt the outbound group session of a room for its members.
+
+        Yields the to-device messages in chunks that fit into a single
+        request, in a thread pool the chunks are yielded in the order their
+        encryption finishes.
+        """
+        assert self.olm
+
+        if self.config.olm_encryption_workers == 0:
+            for chunk in self.olm.share_group_session_parallel(
+                room_id, users, ignore_unverified_devices=ignore_unverified_devices
+            ):
+                yield chunk
+
+            return
+
+        batches, template = self.olm.group_session_share_batches(
+            room_id, users, ignore_unverified_devices
+        )
+
+        if (
+            self._encryption_executor is None
+            and self.config.olm_encryption_workers is not None
+        ):
+            self._encryption_executor = ThreadPoolExecutor(
+                self.config.olm_encryption_workers,
+                thread_name_prefix="nio-encryption",
+            )
+
+        loop = asyncio.get_event_loop()
+
+        async def encrypt(batch):
+            chunk = await loop.run_in_executor(
+                self._encryption_executor, self.olm.encrypt_olm_batch, batch, template
+            )
+            self.olm.finish_olm_batch(batch)
+            return chunk
+
+        for encrypted in asyncio.as_completed([encrypt(batch) for batch in batches]):
+            yield await encrypted
+
     @logged_in_async
     @store_loaded
     async def request_room_key(
@@ -2321,12 +3096,57 @@ class AsyncClient(Client):
             ),
         )
 
+    def load_store(self):
+        """Load the session store and olm account.
+
+        See Client.load_store(), if store_thread is set in the config a
+        MatrixStore is run on a database thread.
+        """
+        super().load_store()
+
+        if (
+            not self.config.store_thread
+            or not isinstance(self.store, MatrixStore)
+            or self.async_store
+        ):
+            return
+
+        self.async_store = AsyncMatrixStore(self.store)
+        self.store = self.async_store.threaded_store()
+        self.olm.store = self.store
+
+        if isinstance(self.olm.inbound_group_store, LazyGroupSessionStore):
+            self.olm.inbound_group_store.store = self.store
+
     async def close(self):
         """Close the underlying http session."""
         if self.client_session:
             await self.client_session.close()
             self.client_session = None
 
+        if self._store_maintenance:
+            self._store_maintenance.cancel()
+
+        if self.async_store:
+            await self.async_store.close()
+            self.async_store = None
+        elif self.store:
+            self.store.flush()
+
+        if self._decryption_executor:
+            self._decryption_executor.shutdown(wait=False)
+            self._decryption_executor = None
+
+        if self._encryption_executor:
+            self._encryption_executor.shutdown(wait=False)
+            self._encryption_executor = None
+
+        for task in self._presharing.values():
+            task.cancel()
+
+        if self._preclaiming:
+            self._preclaiming.cancel()
+
     @store_loaded
     async def export_keys(self, outfile: str, passphrase: str, count: int = 10000):
         """Export all the Megolm decryption keys of this device.
@@ -2386,8 +3206,9 @@ class AsyncClient(Client):
         for session in sessions:
             # This could be improved by writing everything to db at once at
             # the end
-            if self.olm.inbound_group_store.add(session):
-                self.store.save_inbound_group_session(session)
+            self.olm.add_inbound_group_session(session)
+
+        self.store.flush()
 
     @logged_in_async
     async def room_create(
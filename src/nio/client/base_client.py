@@ -17,6 +17,7 @@ from __future__ import annotations
 import asyncio
 import inspect
 import logging
+import time
 from collections import defaultdict
 from dataclasses import dataclass, field
 from functools import wraps
@@ -58,6 +59,7 @@ from ..responses import (
     KeysClaimResponse,
     KeysQueryResponse,
     KeysUploadResponse,
+    LazyEventList,
     LoginResponse,
     LogoutResponse,
     PresenceGetResponse,
@@ -78,7 +80,14 @@ from ..rooms import MatrixInvitedRoom, MatrixRoom
 
 if ENCRYPTION_ENABLED:
     from ..crypto import Olm
-    from ..store import DefaultStore, MatrixStore, SqliteMemoryStore
+    from ..store import (
+        CryptoStore,
+        DefaultStore,
+        MatrixStore,
+        SqliteMemoryStore,
+        StoreMaintenanceResult,
+        StoreProfile,
+    )
 if TYPE_CHECKING:
     from ..crypto import OlmDevice, Sas
 
@@ -165,8 +174,8 @@ class ClientConfig:
     """nio client configuration.
 
     Attributes:
-        store (MatrixStore, optional): The store that should be used for state
-            storage.
+        store (CryptoStore, optional): The store that should be used for state
+            storage, e.g. a MatrixStore subclass or the SnapshotStore.
         store_name (str, optional): Filename that should be used for the
             store.
         encryption_enabled (bool, optional): Should end to end encryption be
@@ -175,6 +184,30 @@ class ClientConfig:
             end to end encryption keys.
         store_sync_tokens (bool, optional): Should the client store and restore
             sync tokens.
+        store_write_behind (bool, optional): Should the store defer writing the
+            Olm account, Olm and Megolm sessions and the sync token until a
+            response has been fully handled. All the changes a response caused
+            are then written in a single transaction. See MatrixStore for the
+            crash-safety guarantees.
+        store_write_behind_delay (float, optional): The maximal age in seconds
+            of a deferred store write before it's written out, for writes
+            that don't happen while handling a response.
+        store_profile (StoreProfile, optional): The SQLite performance
+            profile of the store, e.g. StoreProfile.high_throughput(). The
+            store's secure default profile is used if none is given. Stores
+            that aren't a MatrixStore subclass ignore it.
+        store_lazy_group_sessions (bool, optional): Should the Megolm inbound
+            sessions be loaded from the store on demand instead of loading
+            all of them when the store is loaded. Keeps startup time and
+            memory usage independent of the number of stored sessions.
+        store_group_session_cache_size (int, optional): The maximal number of
+            Megolm inbound sessions kept in memory if the sessions are loaded
+            on demand.
+        store_max_olm_sessions (int, optional): The number of most recently
+            used Olm sessions that prune_store() keeps for every device.
+        store_device_grace_period (float, optional): The number of seconds
+            that we need to not share an encrypted room with a user before
+            prune_store() deletes their devices.
         custom_headers (Dict[str, str]): A dictionary of custom http headers.
 
     Raises an ImportWarning if encryption_enabled is true but the dependencies
@@ -182,13 +215,20 @@ class ClientConfig:
 
     """
 
-    store: Optional[Type[MatrixStore]] = DefaultStore if ENCRYPTION_ENABLED else None
+    store: Optional[Type[CryptoStore]] = DefaultStore if ENCRYPTION_ENABLED else None
 
     encryption_enabled: bool = ENCRYPTION_ENABLED
 
     store_name: str = ""
     pickle_key: str = "DEFAULT_KEY"
     store_sync_tokens: bool = False
+    store_write_behind: bool = False
+    store_write_behind_delay: float = 5.0
+    store_profile: Optional[StoreProfile] = None
+    store_lazy_group_sessions: bool = False
+    store_group_session_cache_size: int = 1000
+    store_max_olm_sessions: int = 10
+    store_device_grace_period: float = 7 * 24 * 60 * 60
     custom_headers: Optional[Dict[str, str]] = None
 
     def __post_init__(self):
@@ -238,7 +278,7 @@ class Client:
         self.device_id = device_id
         self.store_path = store_path
         self.olm: Optional[Olm] = None
-        self.store: Optional[MatrixStore] = None
+        self.store: Optional[CryptoStore] = None
         self.config = config or ClientConfig()
 
         self.user_id = ""
@@ -251,6 +291,10 @@ class Client:
         self.invited_rooms: Dict[str, MatrixInvitedRoom] = {}
         self.encrypted_rooms: Set[str] = set()
 
+        # When we noticed that we don't share an encrypted room with a user
+        # anymore, for the grace period of prune_store().
+        self._untracked_users: Dict[str, float] = {}
+
         self.event_callbacks: List[ClientCallback] = []
         self.ephemeral_callbacks: List[ClientCallback] = []
         self.to_device_callbacks: List[ClientCallback] = []
@@ -397,11 +441,18 @@ class Client:
             raise LocalProtocolError("No store class was provided in the config.")
 
         if self.config.encryption_enabled:
+            store_kwargs = {}
+
+            # Only the SQLite stores have a performance profile.
+            if self.config.store_profile and issubclass(self.config.store, MatrixStore):
+                store_kwargs["profile"] = self.config.store_profile
+
             if self.config.store is SqliteMemoryStore:
                 self.store = self.config.store(
                     self.user_id,
                     self.device_id,
                     self.config.pickle_key,
+                    **store_kwargs,
                 )
             else:
                 if not self.store_path:
@@ -413,10 +464,20 @@ class Client:
                     self.store_path,
                     self.config.pickle_key,
                     self.config.store_name,
+                    **store_kwargs,
                 )
             assert self.store
 
+            self.store.lazy_group_sessions = self.config.store_lazy_group_sessions
+            self.store.group_session_cache_size = (
+                self.config.store_group_session_cache_size
+            )
+
             self.olm = Olm(self.user_id, self.device_id, self.store)
+
+            self.store.write_behind = self.config.store_write_behind
+            self.store.write_behind_delay = self.config.store_write_behind_delay
+
             self.encrypted_rooms = self.store.load_encrypted_rooms()
 
             if self.config.store_sync_tokens:
@@ -491,6 +552,7 @@ class Client:
             self.olm.outbound_group_sessions[room_id] = session
         elif session:
             logger.info(f"Invalidating session for {room_id}")
+            self.olm.remove_outbound_group_session(room_id)
 
     def _invalidate_outbound_sessions(self, device: OlmDevice) -> None:
         assert self.olm
@@ -732,7 +794,13 @@ class Client:
 
         room = self.rooms[room_id]
 
-        for event in join_info.state:
+        if isinstance(join_info.state, LazyEventList):
+            # Only parse the state events that the room cares about.
+            state = join_info.state.iter_types(MatrixRoom.STATE_EVENT_TYPES)
+        else:
+            state = join_info.state
+
+        for event in state:
             if isinstance(event, RoomEncryptionEvent):
                 encrypted_rooms.add(room_id)
 
@@ -754,10 +822,11 @@ class Client:
         room_id: str,
         room: MatrixRoom,
         encrypted_rooms: Set[str],
+        decrypt: bool = True,
     ) -> Optional[Union[Event, BadEventType]]:
         decrypted_event = None
 
-        if isinstance(event, MegolmEvent) and self.olm:
+        if isinstance(event, MegolmEvent) and self.olm and decrypt:
             event.room_id = room_id
             decrypted_event = self.olm._decrypt_megolm_no_error(event)
 
@@ -1011,10 +1080,12 @@ class Client:
                         user not in session.users_shared_with
                         and user not in session.users_ignored
                     ):
+                        self.olm.save_outbound_group_session(room_id)
                         return
 
             logger.info(f"Marking outbound group session for room {room_id} as shared")
             session.shared = True
+            self.olm.save_outbound_group_session(room_id)
 
         elif isinstance(response, KeysQueryResponse):
             for user_id in response.changed:
@@ -1132,6 +1203,11 @@ class Client:
             if response.soft_logout:
                 self.access_token = ""
 
+        # Write out the changes the response caused if the store defers
+        # writes, this is a no-op otherwise.
+        if self.store:
+            self.store.flush()
+
         return None
 
     @store_loaded
@@ -1194,6 +1270,79 @@ class Client:
 
         return self.olm.get_missing_sessions(list(room.users))
 
+    @store_loaded
+    def prune_store(self, compact: bool = True) -> StoreMaintenanceResult:
+        """Delete encryption data that isn't needed anymore from the store.
+
+        Only the ClientConfig.store_max_olm_sessions most recently used Olm
+        sessions of every device are kept. The devices of users that we
+        haven't shared an encrypted room with for
+        ClientConfig.store_device_grace_period seconds are deleted, unless one
+        of them is verified, blacklisted or ignored. The grace period starts
+        when this method first notices that a user isn't in any of our
+        encrypted rooms, a restart starts it again.
+
+        Args:
+            compact (bool): Give the space freed in the database back to the
+                file system, see MatrixStore.vacuum().
+
+        Returns a StoreMaintenanceResult describing what was removed.
+        """
+        assert self.olm
+
+        result = self.olm.prune_store(
+            self.config.store_max_olm_sessions,
+            self._users_to_prune(),
+            compact,
+        )
+
+        logger.info(f"Pruned the store: {result}")
+
+        return result
+
+    def _users_to_prune(self) -> Set[str]:
+        assert self.olm
+
+        # Without a sync or with lazily loaded members we can't know who we
+        # share a room with.
+        if not self.next_batch or any(
+            room.encrypted and not room.members_synced for room in self.rooms.values()
+        ):
+            return set()
+
+        room_users = {
+            user_id
+            for room in self.rooms.values()
+            if room.encrypted
+            for user_id in room.users
+        }
+        untracked = set(self.olm.device_store.users) - room_users - {self.user_id}
+
+        for user_id in list(self._untracked_users):
+            if user_id not in untracked:
+                del self._untracked_users[user_id]
+
+        now = time.monotonic()
+        users = set()
+
+        for user_id in untracked:
+            since = self._untracked_users.setdefault(user_id, now)
+
+            if now - since < self.config.store_device_grace_period:
+                continue
+
+            if any(
+                self.olm.is_device_verified(device)
+                or self.olm.is_device_blacklisted(device)
+                or self.olm.is_device_ignored(device)
+                for device in self.olm.device_store[user_id].values()
+            ):
+                continue
+
+            users.add(user_id)
+
+        return users
+
     @store_loaded
     def get_users_for_key_claiming(self) -> Dict[str, List[str]]:
         """Get the content for a key claim request that needs to be made.
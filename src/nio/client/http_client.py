@@ -14,7 +14,6 @@
 
 from __future__ import annotations
 
-import json
 import logging
 import pprint
 from collections import deque
@@ -29,6 +28,7 @@ from uuid import UUID, uuid4
 import h2
 import h11
 
+from .. import json
 from ..api import (
     Api,
     MessageDirection,
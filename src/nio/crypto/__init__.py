@@ -32,7 +32,7 @@ if package_installed("olm"):
     from .device import DeviceStore, OlmDevice, TrustState
     from .key_request import OutgoingKeyRequest
     from .log import logger
-    from .memorystores import GroupSessionStore, SessionStore
+    from .memorystores import GroupSessionStore, LazyGroupSessionStore, SessionStore
     from .olm_machine import Olm
     from .sas import Sas, SasState
 
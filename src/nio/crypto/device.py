@@ -16,7 +16,7 @@
 from collections import defaultdict
 from dataclasses import asdict, dataclass, field
 from enum import Enum
-from typing import DefaultDict, Dict, Iterator, KeysView, Optional
+from typing import DefaultDict, Dict, Iterator, KeysView, Optional, Tuple
 
 
 # TODO document the values better.
@@ -131,10 +131,25 @@ class DeviceStore:
     >>> for device in device_store.active_user_devices("@bob:example.org"):
     ...    print(device.user_id, device.device_id)
 
+    The store keeps an index of the non-deleted devices of every user and of
+    their curve25519 keys. To keep the indexes up to date devices that are
+    in the store should be marked as deleted using the mark_deleted() method
+    and their curve25519 key should be changed using the update_curve25519()
+    method.
+
     """
 
     def __init__(self):
         self._entries: DefaultDict[str, Dict[str, OlmDevice]] = defaultdict(dict)
+        self._active: DefaultDict[str, Dict[str, OlmDevice]] = defaultdict(dict)
+        self._curve_keys: Dict[Tuple[str, str], OlmDevice] = {}
+
+    def __contains__(self, device: object) -> bool:
+        if not isinstance(device, OlmDevice):
+            return False
+
+        user_devices = self._entries.get(device.user_id, {})
+        return user_devices.get(device.id) == device
 
     def __iter__(self) -> Iterator[OlmDevice]:
         for user_devices in self._entries.values():
@@ -162,7 +177,10 @@ class DeviceStore:
         user.
 
         """
-        for device in self._entries[user_id].values():
+        # Users we ask about are known to the store, even without devices.
+        self._entries.setdefault(user_id, {})
+
+        for device in list(self._active[user_id].values()):
             if not device.deleted:
                 yield device
 
@@ -176,9 +194,10 @@ class DeviceStore:
             sender_key (str): The encryption key that is owned by the device,
             usually a curve25519 public key.
         """
-        for device in self.active_user_devices(user_id):
-            if device.curve25519 == sender_key:
-                return device
+        device = self._curve_keys.get((user_id, sender_key))
+
+        if device and not device.deleted and device.curve25519 == sender_key:
+            return device
 
         return None
 
@@ -199,8 +218,68 @@ class DeviceStore:
         Returns True if the device was added to the store, False if it already
         was in the store.
         """
-        if device in self:
+        old_device = self._entries[device.user_id].get(device.id)
+
+        if old_device == device:
             return False
 
+        if old_device:
+            self._remove_from_index(old_device)
+
         self._entries[device.user_id][device.id] = device
+        self._add_to_index(device)
+
         return True
+
+    def remove_user(self, user_id: str) -> None:
+        """Forget all the devices of the given user.
+
+        Args:
+            user_id (str): The user whose devices should be removed.
+        """
+        for device in self._entries.pop(user_id, {}).values():
+            self._remove_from_index(device)
+
+        self._active.pop(user_id, None)
+
+    def mark_deleted(self, device: OlmDevice) -> None:
+        """Mark the given device as deleted.
+
+        Args:
+            device (OlmDevice): The device that was deleted by its owner.
+        """
+        device.deleted = True
+        self._remove_from_index(device)
+
+    def update_curve25519(self, device: OlmDevice, curve_key: str) -> None:
+        """Change the curve25519 key of the given device.
+
+        Args:
+            device (OlmDevice): The device of which the key changed.
+            curve_key (str): The new curve25519 key of the device.
+        """
+        self._remove_from_index(device)
+        device.curve25519 = curve_key
+        self._add_to_index(device)
+
+    def _add_to_index(self, device: OlmDevice) -> None:
+        if device.deleted:
+            return
+
+        self._active[device.user_id][device.id] = device
+
+        curve_key = device.keys.get("curve25519")
+
+        if curve_key:
+            self._curve_keys[(device.user_id, curve_key)] = device
+
+    def _remove_from_index(self, device: OlmDevice) -> None:
+        user_devices = self._active.get(device.user_id, {})
+
+        if user_devices.get(device.id) is device:
+            del user_devices[device.id]
+
+        curve_key = (device.user_id, device.keys.get("curve25519"))
+
+        if self._curve_keys.get(curve_key) is device:
+            del self._curve_keys[curve_key]
@@ -12,22 +12,45 @@
 # CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
 # CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-from collections import defaultdict
-from typing import DefaultDict, Dict, Iterator, List, Optional
+from __future__ import annotations
+
+from collections import OrderedDict, defaultdict
+from typing import TYPE_CHECKING, DefaultDict, Dict, Iterator, List, Optional, Tuple
 
 from .sessions import InboundGroupSession, Session
 
+if TYPE_CHECKING:
+    from ..store import MatrixStore
+
 
 class SessionStore:
+    """Olm sessions, grouped by the curve25519 key of the other device.
+
+    The sessions of a device are kept ordered by their use, the most recently
+    used session first, and are indexed by their session id.
+    """
+
     def __init__(self):
         self._entries: DefaultDict[str, List[Session]] = defaultdict(list)
+        self._index: DefaultDict[str, Dict[str, Session]] = defaultdict(dict)
 
     def add(self, sender_key: str, session: Session) -> bool:
-        if session in self._entries[sender_key]:
+        index = self._index[sender_key]
+
+        if session.id in index:
             return False
 
-        self._entries[sender_key].append(session)
-        self._entries[sender_key].sort(key=lambda x: x.use_time, reverse=True)
+        index[session.id] = session
+
+        # Sessions are loaded from the store in the order of their use, those
+        # end up at the back right away.
+        entries = self._entries[sender_key]
+        position = len(entries)
+
+        while position > 0 and entries[position - 1].use_time < session.use_time:
+            position -= 1
+
+        entries.insert(position, session)
         return True
 
     def __iter__(self) -> Iterator[Session]:
@@ -46,6 +69,47 @@ class SessionStore:
 
         return None
 
+    def get_by_id(self, sender_key: str, session_id: str) -> Optional[Session]:
+        """Get the session of a device with the given session id."""
+        index = self._index.get(sender_key)
+
+        if not index:
+            return None
+
+        return index.get(session_id)
+
+    def mark_used(self, sender_key: str, session: Session) -> None:
+        """Move a session to the front, it was the last one that was used."""
+        entries = self._entries[sender_key]
+
+        if entries and entries[0] is session:
+            return
+
+        try:
+            entries.remove(session)
+        except ValueError:
+            return
+
+        entries.insert(0, session)
+
+    def prune(self, max_sessions: int) -> int:
+        """Forget all but the most recently used sessions of every device.
+
+        Returns the number of sessions that were removed.
+        """
+        removed = 0
+
+        for sender_key, entries in self._entries.items():
+            index = self._index[sender_key]
+
+            for session in entries[max_sessions:]:
+                index.pop(session.id, None)
+                removed += 1
+
+            del entries[max_sessions:]
+
+        return removed
+
     def __getitem__(self, sender_key: str) -> List[Session]:
         return self._entries[sender_key]
 
@@ -80,3 +144,81 @@ class GroupSessionStore:
         self, room_id: str
     ) -> DefaultDict[str, Dict[str, InboundGroupSession]]:
         return self._entries[room_id]
+
+
+class LazyGroupSessionStore(GroupSessionStore):
+    """Group session store that loads the sessions on demand.
+
+    Instead of holding every session in memory the sessions are fetched from
+    a MatrixStore and unpickled the first time they are requested. The most
+    recently used sessions are kept in a bounded LRU cache. Sessions that are
+    added to the store are written through to the MatrixStore.
+
+    Iterating over the store or indexing it by a room id reads the sessions
+    from the MatrixStore, the returned room dictionary is a snapshot and
+    modifying it won't modify the store.
+
+    Args:
+        store (MatrixStore): The store the sessions are loaded from and saved
+            to.
+        max_cached (int): The maximal number of sessions that are kept in
+            memory.
+    """
+
+    def __init__(self, store: MatrixStore, max_cached: int = 1000):
+        self.store = store
+        self.max_cached = max_cached
+        self._cache: OrderedDict[Tuple[str, str, str], InboundGroupSession] = (
+            OrderedDict()
+        )
+
+    def _cache_session(self, session: InboundGroupSession) -> None:
+        key = (session.room_id, session.sender_key, session.id)
+        self._cache[key] = session
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def __iter__(self) -> Iterator[InboundGroupSession]:
+        for session in self.store.iter_inbound_group_sessions():
+            key = (session.room_id, session.sender_key, session.id)
+            yield self._cache.get(key, session)
+
+    def add(self, session: InboundGroupSession) -> bool:
+        key = (session.room_id, session.sender_key, session.id)
+
+        if self._cache.get(key) is session:
+            return False
+
+        self._cache_session(session)
+        self.store.save_inbound_group_session(session)
+        return True
+
+    def get(
+        self, room_id: str, sender_key: str, session_id: str
+    ) -> Optional[InboundGroupSession]:
+        key = (room_id, sender_key, session_id)
+        session = self._cache.get(key)
+
+        if session:
+            self._cache.move_to_end(key)
+            return session
+
+        session = self.store.load_inbound_group_session(room_id, sender_key, session_id)
+
+        if session:
+            self._cache_session(session)
+
+        return session
+
+    def __getitem__(
+        self, room_id: str
+    ) -> DefaultDict[str, Dict[str, InboundGroupSession]]:
+        sessions: DefaultDict[str, Dict[str, InboundGroupSession]] = defaultdict(dict)
+
+        for session in self.store.iter_inbound_group_sessions(room_id):
+            key = (room_id, session.sender_key, session.id)
+            sessions[session.sender_key][session.id] = self._cache.get(key, session)
+
+        return sessions
@@ -14,19 +14,31 @@
 
 from __future__ import annotations
 
-import json
 from collections import defaultdict
 from datetime import datetime, timedelta
 from json.decoder import JSONDecodeError
-from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple, Union
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import olm
 from cachetools import LRUCache
 from jsonschema import SchemaError, ValidationError
 from olm import OlmGroupSessionError, OlmMessage, OlmPreKeyMessage, OlmSessionError
 
+from .. import json
 from ..api import Api
-from ..crypto.sessions import Session
+from ..crypto.sessions import Session, prekey_message_session_id
 from ..event_builders import DummyMessage, RoomKeyRequestMessage, ToDeviceMessage
 from ..events import (
     BadEvent,
@@ -65,12 +77,13 @@ from ..responses import (
     ToDeviceResponse,
 )
 from ..schemas import Schemas, validate_json
-from ..store import MatrixStore
+from ..store import CryptoStore, StoreMaintenanceResult
 from . import (
     DeviceStore,
     GroupSessionStore,
     InboundGroupSession,
     InboundSession,
+    LazyGroupSessionStore,
     OlmAccount,
     OlmDevice,
     OutboundGroupSession,
@@ -83,6 +96,10 @@ from .key_export import decrypt_and_read, encrypt_and_save
 from .sas import Sas
 
 DecryptedOlmT = Union[RoomKeyEvent, BadEvent, UnknownBadEvent, None]
+MegolmBatchT = List[Tuple[int, MegolmEvent, InboundGroupSession]]
+MegolmPayloadT = Union[Tuple[int, Union[Event, BadEvent]], EncryptionError]
+OlmBatchT = List[Tuple[str, OlmDevice, Session]]
+ToDeviceChunkT = Tuple[Set[Tuple[str, str]], Dict[str, Any]]
 
 
 def chunks(lst, n):
@@ -95,11 +112,38 @@ class KeyShareError(Exception):
     pass
 
 
+class OlmPayloadTemplate:
+    """An Olm payload that is encoded once and completed for every recipient.
+
+    Only the recipient fields differ between the payloads a message is
+    encrypted to, the rest of the payload, e.g. the content of a room key, is
+    encoded only once.
+
+    Args:
+        sender_key (str): The curve25519 key of our own device.
+        payload (Dict[str, Any]): The payload without the recipient fields.
+    """
+
+    def __init__(self, sender_key: str, payload: Dict[str, Any]):
+        self.sender_key = sender_key
+        self._prefix = f'{json.dumps(payload)[:-1]},"recipient":'
+
+    def encode(self, device: OlmDevice) -> str:
+        """Encode the payload for the given recipient device."""
+        recipient_keys = json.dumps({"ed25519": device.ed25519})
+
+        return (
+            f"{self._prefix}{json.dumps(device.user_id)},"
+            f'"recipient_keys":{recipient_keys}}}'
+        )
+
+
 class Olm:
     _olm_algorithm = "m.olm.v1.curve25519-aes-sha2"
     _megolm_algorithm = "m.megolm.v1.aes-sha2"
     _algorithms = [_olm_algorithm, _megolm_algorithm]
     _maxToDeviceMessagesPerRequest = 20
+    _max_olm_decryption_attempts = 10
     _max_sas_life = timedelta(minutes=20)
     _unwedging_interval = timedelta(minutes=60)
 
@@ -124,7 +168,7 @@ class Olm:
         self,
         user_id: str,
         device_id: str,
-        store: MatrixStore,
+        store: CryptoStore,
     ) -> None:
         # Our own user id and device id. A tuple of user_id/device_id is
         # guaranteed to be unique.
@@ -161,7 +205,8 @@ class Olm:
         # there). These keys will not be stored permanently, they get rotated
         # relatively frequently. These keys need to be shared with all the
         # users/devices in a room before they can be used to encrypt a room
-        # message.
+        # message. The keys are stored together with the devices they were
+        # shared with, so they can be used after a restart.
         # Dict of outbound Megolm sessions Dict[room_id]
         self.outbound_group_sessions: Dict[str, OutboundGroupSession] = {}
 
@@ -355,25 +400,34 @@ class Olm:
 
         return content
 
-    def _olm_encrypt(self, session, recipient_device, message_type, content):
-        payload = {
-            "sender": self.user_id,
-            "sender_device": self.device_id,
-            "keys": {"ed25519": self.account.identity_keys["ed25519"]},
-            "recipient": recipient_device.user_id,
-            "recipient_keys": {
-                "ed25519": recipient_device.ed25519,
+    def _olm_payload_template(
+        self, message_type: str, content: Dict[str, Any]
+    ) -> OlmPayloadTemplate:
+        identity_keys = self.account.identity_keys
+
+        return OlmPayloadTemplate(
+            identity_keys["curve25519"],
+            {
+                "sender": self.user_id,
+                "sender_device": self.device_id,
+                "keys": {"ed25519": identity_keys["ed25519"]},
+                "type": message_type,
+                "content": content,
             },
-            "type": message_type,
-            "content": content,
-        }
+        )
 
-        olm_message = session.encrypt(Api.to_json(payload))
-        self.store.save_session(recipient_device.curve25519, session)
+    @classmethod
+    def _encrypt_olm_payload(
+        cls,
+        session: Session,
+        recipient_device: OlmDevice,
+        template: OlmPayloadTemplate,
+    ) -> Dict[str, Any]:
+        olm_message = session.encrypt(template.encode(recipient_device))
 
         return {
-            "algorithm": self._olm_algorithm,
-            "sender_key": self.account.identity_keys["curve25519"],
+            "algorithm": cls._olm_algorithm,
+            "sender_key": template.sender_key,
             "ciphertext": {
                 recipient_device.curve25519: {
                     "type": olm_message.message_type,
@@ -382,6 +436,13 @@ class Olm:
             },
         }
 
+    def _olm_encrypt(self, session, recipient_device, message_type, content):
+        template = self._olm_payload_template(message_type, content)
+        olm_dict = self._encrypt_olm_payload(session, recipient_device, template)
+        self.store.save_session(recipient_device.curve25519, session, sent=True)
+
+        return olm_dict
+
     def _queue_dummy_message(self, session, device):
         olm_dict = self._olm_encrypt(session, device, "m.dummy", {})
 
@@ -777,7 +838,7 @@ class Olm:
                         continue
 
                     if device.curve25519 != curve_key:
-                        device.curve25519 = curve_key
+                        self.device_store.update_curve25519(device, curve_key)
                         logger.info(
                             "Updating curve key in the device store "
                             f"for user {user_id} with device id {device_id}"
@@ -800,13 +861,42 @@ class Olm:
 
             for device_id in deleted_devices:
                 device = self.device_store[user_id][device_id]
-                device.deleted = True
+                self.device_store.mark_deleted(device)
                 logger.info(f"Marking device {user_id} of user {device_id} as deleted")
                 changed[user_id][device_id] = device
 
         self.store.save_device_keys(changed)
         response.changed = changed
 
+    def to_device_message_batches(self) -> List[List[ToDeviceMessage]]:
+        """Group the outgoing to-device messages into batches.
+
+        Every batch can be sent out in a single to-device request, the
+        messages of a batch have the same type and are meant for different
+        devices. A batch contains at most _maxToDeviceMessagesPerRequest
+        messages.
+        """
+        batches: List[List[ToDeviceMessage]] = []
+        open_batches: Dict[str, Tuple[List[ToDeviceMessage], Set[Tuple[str, str]]]] = {}
+
+        for message in self.outgoing_to_device_messages:
+            recipient = (message.recipient, message.recipient_device)
+            batch, recipients = open_batches.get(message.type, ([], set()))
+
+            if (
+                not batch
+                or recipient in recipients
+                or len(batch) >= self._maxToDeviceMessagesPerRequest
+            ):
+                batch, recipients = [], set()
+                batches.append(batch)
+                open_batches[message.type] = (batch, recipients)
+
+            batch.append(message)
+            recipients.add(recipient)
+
+        return batches
+
     def _mark_to_device_message_as_sent(self, message):
         """Mark a to-device message as sent.
 
@@ -951,13 +1041,13 @@ class Olm:
             logger.warning(e)
             return
 
-        self.inbound_group_store.add(session)
-        self.save_inbound_group_session(session)
+        self.add_inbound_group_session(session)
 
     def create_outbound_group_session(self, room_id: str) -> None:
         logger.info(f"Creating outbound group session for {room_id}")
         session = OutboundGroupSession()
         self.outbound_group_sessions[room_id] = session
+        self.store.save_outbound_group_session(room_id, session)
 
         id_key = self.account.identity_keys["curve25519"]
         fp_key = self.account.identity_keys["ed25519"]
@@ -1045,53 +1135,72 @@ class Olm:
         sender_key: str,
         message: Union[OlmPreKeyMessage, OlmMessage],
     ) -> Optional[str]:
-        plaintext = None
-
-        # Let's try to decrypt with each known session for the sender.
-        # for a specific device?
-        for session in self.session_store[sender_key]:
-            matches = False
-            try:
-                if isinstance(message, OlmPreKeyMessage):
-                    # It's a prekey message, check if the session matches
-                    # if it doesn't no need to try to decrypt.
-                    matches = session.matches(message)
-                    if not matches:
-                        continue
-
-                logger.info(
-                    "Trying to decrypt olm message using existing "
-                    f"session for {sender} and sender_key {sender_key}"
+        if isinstance(message, OlmPreKeyMessage):
+            # A pre-key message can only be decrypted by the session it
+            # established, if we don't know it yet a new one needs to be
+            # created.
+            session_id = prekey_message_session_id(message)
+
+            if session_id:
+                session = self.session_store.get_by_id(sender_key, session_id)
+            else:
+                session = next(
+                    (s for s in self.session_store[sender_key] if s.matches(message)),
+                    None,
                 )
 
-                plaintext = session.decrypt(message)
-                self.save_session(sender_key, session)
-
-                logger.info(
-                    "Successfully decrypted olm message " "using existing session"
-                )
-                return plaintext
+            if not session:
+                return None
 
+            try:
+                plaintext = session.decrypt(message)
             except OlmSessionError as e:
                 # Decryption failed using a matching session, we don't want
                 # to create a new session using this prekey message so
                 # raise an exception and log the error.
-                if matches:
-                    logger.error(
-                        "Found matching session yet decryption "
-                        f"failed for sender {sender} and "
-                        f"sender key {sender_key}"
+                logger.error(
+                    "Found matching session yet decryption failed for sender "
+                    "%s and sender key %s: %s",
+                    sender,
+                    sender_key,
+                    e,
+                )
+                raise EncryptionError("Decryption failed for matching session")
+
+        else:
+            # Try the most recently used sessions first, peers keep using
+            # the session they last received a message with. Old sessions of
+            # a device rarely decrypt anything, give up after a couple of
+            # them and let the device be unwedged instead.
+            sessions = self.session_store[sender_key][
+                : self._max_olm_decryption_attempts
+            ]
+
+            for session in sessions:
+                try:
+                    plaintext = session.decrypt(message)
+                    break
+                except OlmSessionError as e:  # noqa: PERF203
+                    logger.debug(
+                        "Error decrypting olm message from %s and sender key "
+                        "%s using session %s: %s",
+                        sender,
+                        sender_key,
+                        session.id,
+                        e,
                     )
-                    raise EncryptionError("Decryption failed for matching session")
+            else:
+                return None
 
-                # Decryption failed, we'll try another session in the next
-                # iteration.
-                logger.info(
-                    f"Error decrypting olm message from {sender} "
-                    f"and sender key {sender_key}: {e}"
-                )
+        self.session_store.mark_used(sender_key, session)
+        self.save_session(sender_key, session)
 
-        return None
+        logger.debug(
+            "Decrypted olm message from %s using existing session %s",
+            sender,
+            session.id,
+        )
+        return plaintext
 
     def _verify_olm_payload(self, sender: str, payload: Dict[Any, Any]) -> bool:
         # Verify that the sender in the payload matches the sender of the event
@@ -1223,8 +1332,7 @@ class Olm:
         if not session:
             return None
 
-        if self.inbound_group_store.add(session):
-            self.save_inbound_group_session(session)
+        self.add_inbound_group_session(session)
 
         key_request = self.outgoing_key_requests.pop(event.session_id)
         self.store.remove_outgoing_key_request(key_request)
@@ -1357,8 +1465,6 @@ class Olm:
         if not room_id:
             raise EncryptionError("Event doesn't contain a room id")
 
-        verified = False
-
         session = self.inbound_group_store.get(
             room_id, event.sender_key, event.session_id
         )
@@ -1372,6 +1478,167 @@ class Olm:
             logger.warning(message)
             raise EncryptionError(message)
 
+        message_index, new_event = self._decrypt_megolm_payload(event, session)
+
+        return self._verify_megolm_event(event, session, message_index, new_event)
+
+    def megolm_decryption_batches(
+        self,
+        events: Sequence[MegolmEvent],
+        room_id: Optional[str] = None,
+        batch_size: int = 100,
+    ) -> List[MegolmBatchT]:
+        """Group Megolm events into batches for decryption.
+
+        The events are grouped by their room, sender key and session id, the
+        session of every group is looked up only once. Events for which no
+        session is found are left out.
+
+        All the events of a session end up in the same batch, in their original
+        order, so the batches can be decrypted in parallel.
+
+        Args:
+            events (Sequence[MegolmEvent]): The events that should be grouped.
+            room_id (str, optional): The room id of the events, defaults to
+                the room id of every event.
+            batch_size (int): Groups are added to a batch until it contains
+                at least this many events.
+
+        Returns a list of batches, a batch is a list of
+        (index, event, session) tuples, the index being the position of the
+        event in the events sequence.
+        """
+        groups: Dict[Tuple[str, str, str], List[Tuple[int, MegolmEvent]]] = {}
+
+        for index, event in enumerate(events):
+            event_room_id = room_id or event.room_id
+
+            if not event_room_id:
+                logger.warning(f"Event {event.event_id} doesn't contain a room id")
+                continue
+
+            key = (event_room_id, event.sender_key, event.session_id)
+            groups.setdefault(key, []).append((index, event))
+
+        batches: List[MegolmBatchT] = []
+        batch: MegolmBatchT = []
+
+        for (group_room_id, sender_key, session_id), group in groups.items():
+            session = self.inbound_group_store.get(
+                group_room_id, sender_key, session_id
+            )
+
+            if not session:
+                logger.warning(
+                    f"Error decrypting {len(group)} megolm events, no session "
+                    f"found with session id {session_id} for room {group_room_id}"
+                )
+
+                for _, event in group:
+                    self.check_if_wedged(event)
+
+                continue
+
+            batch.extend((index, event, session) for index, event in group)
+
+            if len(batch) >= batch_size:
+                batches.append(batch)
+                batch = []
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    @classmethod
+    def decrypt_megolm_batch(cls, batch: MegolmBatchT) -> List[MegolmPayloadT]:
+        """Decrypt and parse a batch of Megolm events.
+
+        This doesn't access the state of the Olm machine and can be run in a
+        worker thread. Batches that share a session must not be decrypted at
+        the same time.
+
+        Args:
+            batch (MegolmBatchT): A batch created by
+                megolm_decryption_batches().
+
+        Returns a list containing a (message_index, event) tuple, or the
+        EncryptionError describing why decryption failed, for every event of
+        the batch. The result needs to be passed to finish_megolm_batch().
+        """
+        payloads: List[MegolmPayloadT] = []
+
+        for _, event, session in batch:
+            try:
+                payloads.append(cls._decrypt_megolm_payload(event, session))
+            except EncryptionError as e:  # noqa: PERF203
+                payloads.append(e)
+
+        return payloads
+
+    def finish_megolm_batch(
+        self, batch: MegolmBatchT, payloads: List[MegolmPayloadT]
+    ) -> List[Tuple[int, Union[Event, BadEvent]]]:
+        """Verify the decrypted events of a batch.
+
+        Args:
+            batch (MegolmBatchT): A batch created by
+                megolm_decryption_batches().
+            payloads (List[MegolmPayloadT]): The result of
+                decrypt_megolm_batch() for the batch.
+
+        Returns a list of (index, decrypted_event) tuples, events that failed
+        to decrypt or verify are left out.
+        """
+        decrypted = []
+
+        for (index, event, session), payload in zip(batch, payloads):
+            if isinstance(payload, EncryptionError):
+                continue
+
+            message_index, new_event = payload
+
+            try:
+                new_event = self._verify_megolm_event(
+                    event, session, message_index, new_event
+                )
+            except EncryptionError:
+                continue
+
+            decrypted.append((index, new_event))
+
+        return decrypted
+
+    def decrypt_megolm_events(
+        self,
+        events: Sequence[MegolmEvent],
+        room_id: Optional[str] = None,
+    ) -> List[Optional[Union[Event, BadEvent]]]:
+        """Decrypt multiple Megolm events at once.
+
+        Args:
+            events (Sequence[MegolmEvent]): The events that should be
+                decrypted.
+            room_id (str, optional): The room id of the events, defaults to
+                the room id of every event.
+
+        Returns a list containing the decrypted event, or None if the event
+        couldn't be decrypted, for every event in the same order.
+        """
+        decrypted: List[Optional[Union[Event, BadEvent]]] = [None] * len(events)
+
+        for batch in self.megolm_decryption_batches(events, room_id):
+            payloads = self.decrypt_megolm_batch(batch)
+
+            for index, event in self.finish_megolm_batch(batch, payloads):
+                decrypted[index] = event
+
+        return decrypted
+
+    @staticmethod
+    def _decrypt_megolm_payload(
+        event: MegolmEvent, session: InboundGroupSession
+    ) -> Tuple[int, Union[Event, BadEvent]]:
         try:
             plaintext, message_index = session.decrypt(event.ciphertext)
         except OlmGroupSessionError as e:
@@ -1379,6 +1646,53 @@ class Olm:
             logger.warning(message)
             raise EncryptionError(message)
 
+        try:
+            parsed_dict: Dict[Any, Any] = json.loads(plaintext)
+        except JSONDecodeError as e:
+            raise EncryptionError(f"Error parsing payload: {str(e)}")
+
+        bad = validate_or_badevent(parsed_dict, Schemas.room_megolm_decrypted)
+
+        if bad:
+            return message_index, bad
+
+        parsed_dict["event_id"] = event.event_id
+
+        if "m.relates_to" not in parsed_dict["content"]:
+            try:
+                parsed_dict["content"]["m.relates_to"] = event.source["content"][
+                    "m.relates_to"
+                ]
+            except KeyError:
+                pass
+
+        parsed_dict["sender"] = event.sender
+        parsed_dict["origin_server_ts"] = event.server_timestamp
+
+        if event.transaction_id:
+            parsed_dict["unsigned"] = {"transaction_id": event.transaction_id}
+
+        new_event = Event.parse_decrypted_event(parsed_dict)
+
+        if isinstance(new_event, UnknownBadEvent):
+            return message_index, new_event
+
+        new_event.decrypted = True
+        new_event.sender_key = event.sender_key
+        new_event.session_id = event.session_id
+        new_event.room_id = session.room_id
+
+        return message_index, new_event
+
+    def _verify_megolm_event(
+        self,
+        event: MegolmEvent,
+        session: InboundGroupSession,
+        message_index: int,
+        new_event: Union[Event, BadEvent],
+    ) -> Union[Event, BadEvent]:
+        verified = False
+
         if not self.message_index_ok(message_index, event):
             raise EncryptionError(
                 f"Duplicate message index, possible replay attack from "
@@ -1419,42 +1733,8 @@ class Olm:
                     logger.info(f"Event {event.event_id} successfully verified")
                     verified = True
 
-        try:
-            parsed_dict: Dict[Any, Any] = json.loads(plaintext)
-        except JSONDecodeError as e:
-            raise EncryptionError(f"Error parsing payload: {str(e)}")
-
-        bad = validate_or_badevent(parsed_dict, Schemas.room_megolm_decrypted)
-
-        if bad:
-            return bad
-
-        parsed_dict["event_id"] = event.event_id
-
-        if "m.relates_to" not in parsed_dict["content"]:
-            try:
-                parsed_dict["content"]["m.relates_to"] = event.source["content"][
-                    "m.relates_to"
-                ]
-            except KeyError:
-                pass
-
-        parsed_dict["sender"] = event.sender
-        parsed_dict["origin_server_ts"] = event.server_timestamp
-
-        if event.transaction_id:
-            parsed_dict["unsigned"] = {"transaction_id": event.transaction_id}
-
-        new_event = Event.parse_decrypted_event(parsed_dict)
-
-        if isinstance(new_event, UnknownBadEvent):
-            return new_event
-
-        new_event.decrypted = True
-        new_event.verified = verified
-        new_event.sender_key = event.sender_key
-        new_event.session_id = event.session_id
-        new_event.room_id = room_id
+        if new_event.decrypted:
+            new_event.verified = verified
 
         return new_event
 
@@ -1613,6 +1893,7 @@ class Olm:
 
         plaintext_dict["room_id"] = room_id
         ciphertext = session.encrypt(Api.to_json(plaintext_dict))
+        self.store.save_outbound_group_session(room_id, session)
 
         payload_dict = {
             "algorithm": self._megolm_algorithm,
@@ -1624,11 +1905,9 @@ class Olm:
 
         return payload_dict
 
-    def share_group_session_parallel(
-        self, room_id: str, users: List[str], ignore_unverified_devices: bool = False
-    ) -> Iterator[Tuple[Set[Tuple[str, str]], Dict[str, Any]]]:
-        logger.info(f"Sharing group session for room {room_id}")
-
+    def _group_session_recipients(
+        self, room_id: str, users: List[str], ignore_unverified_devices: bool
+    ) -> Tuple[Dict[str, Any], OlmBatchT]:
         if room_id not in self.outbound_group_sessions:
             self.create_outbound_group_session(room_id)
 
@@ -1694,20 +1973,96 @@ class Olm:
         if mark_as_ignored:
             self.store.ignore_devices(mark_as_ignored)
 
-        for user_map_chunk in chunks(user_map, self._maxToDeviceMessagesPerRequest):
-            to_device_dict: Dict[str, Any] = {"messages": {}}
-            sharing_with = set()
+        return key_content, user_map
+
+    def group_session_share_batches(
+        self,
+        room_id: str,
+        users: List[str],
+        ignore_unverified_devices: bool = False,
+    ) -> Tuple[List[OlmBatchT], OlmPayloadTemplate]:
+        """Prepare the sharing of the outbound group session of a room.
+
+        A new outbound group session is created if the room doesn't have one
+        or if the current one was already shared.
+
+        Args:
+            room_id (str): The room id of the room whose session should be
+                shared.
+            users (List[str]): The users the session should be shared with.
+            ignore_unverified_devices (bool): Mark unverified devices as
+                ignored instead of raising an OlmUnverifiedDeviceError.
+
+        Returns a list of batches and the payload template of the room key.
+        A batch is a list of (user_id, device, session) tuples that fits into a
+        single to-device request. The batches can be encrypted in parallel
+        using encrypt_olm_batch(), every encrypted batch needs to be passed to
+        finish_olm_batch().
+        """
+        logger.info(f"Sharing group session for room {room_id}")
+
+        key_content, user_map = self._group_session_recipients(
+            room_id, users, ignore_unverified_devices
+        )
+        template = self._olm_payload_template("m.room_key", key_content)
+
+        return list(chunks(user_map, self._maxToDeviceMessagesPerRequest)), template
+
+    @classmethod
+    def encrypt_olm_batch(
+        cls, batch: OlmBatchT, template: OlmPayloadTemplate
+    ) -> ToDeviceChunkT:
+        """Encrypt a payload for every device of a batch.
+
+        This doesn't access the state of the Olm machine and can be run in a
+        worker thread, the Olm sessions are locked while they are in use.
 
-            for user_id, device, session in user_map_chunk:
-                olm_dict = self._olm_encrypt(session, device, "m.room_key", key_content)
-                sharing_with.add((user_id, device.id))
+        Args:
+            batch (OlmBatchT): A batch created by group_session_share_batches().
+            template (OlmPayloadTemplate): The payload that should be
+                encrypted.
+
+        Returns a tuple containing the set of (user_id, device_id) tuples the
+        payload was encrypted for and the to-device messages.
+        """
+        to_device_dict: Dict[str, Any] = {"messages": {}}
+        sharing_with = set()
+
+        for user_id, device, session in batch:
+            olm_dict = cls._encrypt_olm_payload(session, device, template)
+            sharing_with.add((user_id, device.id))
+
+            if user_id not in to_device_dict["messages"]:
+                to_device_dict["messages"][user_id] = {}
+
+            to_device_dict["messages"][user_id][device.id] = olm_dict
 
-                if user_id not in to_device_dict["messages"]:
-                    to_device_dict["messages"][user_id] = {}
+        return sharing_with, to_device_dict
 
-                to_device_dict["messages"][user_id][device.id] = olm_dict
+    def finish_olm_batch(self, batch: OlmBatchT) -> None:
+        """Store the Olm sessions that were used to encrypt a batch.
 
-            yield (sharing_with, to_device_dict)
+        Args:
+            batch (OlmBatchT): A batch that was encrypted using
+                encrypt_olm_batch().
+        """
+        sessions = {
+            id(session): (device.curve25519, session) for _, device, session in batch
+        }
+        self.store.save_sessions(list(sessions.values()), sent=True)
+
+    def share_group_session_parallel(
+        self, room_id: str, users: List[str], ignore_unverified_devices: bool = False
+    ) -> Iterator[ToDeviceChunkT]:
+        batches, template = self.group_session_share_batches(
+            room_id, users, ignore_unverified_devices
+        )
+
+        for batch in batches:
+            chunk = self.encrypt_olm_batch(batch, template)
+            self.finish_olm_batch(batch)
+
+            yield chunk
 
     def share_group_session(
         self,
@@ -1806,15 +2161,80 @@ class Olm:
     def load(self) -> None:
         self.session_store = self.store.load_sessions()
         self.inbound_group_store = self.store.load_inbound_group_sessions()
+        self.outbound_group_sessions = self.store.load_outbound_group_sessions()
         self.device_store = self.store.load_device_keys()
         self.outgoing_key_requests = self.store.load_outgoing_key_requests()
 
+    def prune_store(
+        self,
+        max_olm_sessions: int,
+        users: Iterable[str] = (),
+        compact: bool = True,
+    ) -> StoreMaintenanceResult:
+        """Forget old Olm sessions and the devices of the given users.
+
+        Keeps the most recently used Olm sessions of every device, both in
+        memory and in the store, and removes the devices of the users. See
+        MatrixStore.prune() for the details.
+
+        Args:
+            max_olm_sessions (int): The number of Olm sessions that are kept
+                for every device.
+            users (Iterable[str]): The users whose devices should be
+                forgotten.
+            compact (bool): Give the space freed in the database back to the
+                file system.
+        """
+        users = set(users)
+        self.prune_memory(max_olm_sessions, users)
+
+        return self.store.prune(max_olm_sessions, users, compact)
+
+    def prune_memory(self, max_olm_sessions: int, users: Iterable[str] = ()) -> None:
+        """Forget old Olm sessions and the devices of the given users.
+
+        Like prune_store() but the store isn't touched, the caller prunes it.
+        """
+        self.session_store.prune(max_olm_sessions)
+
+        for user_id in users:
+            self.device_store.remove_user(user_id)
+            self.tracked_users.discard(user_id)
+            self.users_for_key_query.discard(user_id)
+
     def save_session(self, curve_key: str, session: Session) -> None:
         self.store.save_session(curve_key, session)
 
     def save_inbound_group_session(self, session: InboundGroupSession) -> None:
         self.store.save_inbound_group_session(session)
 
+    def save_outbound_group_session(self, room_id: str) -> None:
+        """Save the outbound group session of a room, if there is one."""
+        session = self.outbound_group_sessions.get(room_id)
+
+        if session:
+            self.store.save_outbound_group_session(room_id, session)
+
+    def remove_outbound_group_session(self, room_id: str) -> None:
+        """Forget the outbound group session of a room."""
+        self.outbound_group_sessions.pop(room_id, None)
+        self.store.remove_outbound_group_session(room_id)
+
+    def add_inbound_group_session(self, session: InboundGroupSession) -> bool:
+        """Add a Megolm inbound session to the group session store and save it.
+
+        Returns True if the session was added, False if it was already in the
+        store.
+        """
+        if not self.inbound_group_store.add(session):
+            return False
+
+        # A lazy group session store writes the session through itself.
+        if not isinstance(self.inbound_group_store, LazyGroupSessionStore):
+            self.save_inbound_group_session(session)
+
+        return True
+
     def save_account(self, account: Optional[OlmAccount] = None) -> None:
         if account:
             self.store.save_account(account)
@@ -1997,8 +2417,9 @@ class Olm:
         for session in sessions:
             # This could be improved by writing everything to db at once at
             # the end
-            if self.inbound_group_store.add(session):
-                self.save_inbound_group_session(session)
+            self.add_inbound_group_session(session)
+
+        self.store.flush()
 
         logger.info(f"Successfully imported encryption keys from {infile}")
 
@@ -15,7 +15,11 @@
 
 from __future__ import annotations
 
+import base64
+import binascii
+import hashlib
 from datetime import datetime, timedelta
+from threading import Lock
 from typing import List, Optional, Set, Tuple
 
 import olm
@@ -43,13 +47,82 @@ class OlmAccount(olm.Account):
         return account
 
 
+def prekey_message_session_id(message: olm.OlmPreKeyMessage) -> Optional[str]:
+    """Get the id of the Olm session that a pre-key message belongs to.
+
+    The session id is the SHA-256 hash of the identity key and base key of
+    the sender and the one-time key of the receiver, all of which are part of
+    a pre-key message.
+
+    Returns None if the message can't be parsed.
+    """
+    try:
+        data = base64.b64decode(
+            message.ciphertext + "=" * (-len(message.ciphertext) % 4)
+        )
+    except (binascii.Error, ValueError):
+        return None
+
+    keys = {}
+    position = 1
+
+    # Skip the version byte, the rest are tagged, length prefixed fields.
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        length = shift = 0
+
+        while True:
+            if position >= len(data):
+                return None
+
+            byte = data[position]
+            position += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+
+            if not byte & 0x80:
+                break
+
+        keys[tag] = data[position : position + length]
+        position += length
+
+    try:
+        one_time_key, base_key, identity_key = keys[0x0A], keys[0x12], keys[0x1A]
+    except KeyError:
+        return None
+
+    digest = hashlib.sha256(identity_key + base_key + one_time_key).digest()
+    return base64.b64encode(digest).decode().rstrip("=")
+
+
 class _SessionExpirationMixin:
     @property
     def expired(self):
         return False
 
 
-class Session(olm.Session, _SessionExpirationMixin):
+class _SessionLockMixin:
+    """Serialize the use of an Olm session between threads.
+
+    Encrypting, decrypting and pickling a session all modify or read its
+    ratchet, the libolm calls release the GIL so they need to hold the lock
+    of the session.
+    """
+
+    @property
+    def lock(self) -> Lock:
+        try:
+            return self._lock
+        except AttributeError:
+            return self.__dict__.setdefault("_lock", Lock())
+
+    def pickle(self, passphrase=""):
+        with self.lock:
+            return super().pickle(passphrase)
+
+
+class Session(_SessionLockMixin, olm.Session, _SessionExpirationMixin):
     def __init__(self):
         super().__init__()
         self.creation_time = datetime.now()
@@ -73,14 +146,18 @@ class Session(olm.Session, _SessionExpirationMixin):
 
     def decrypt(self, ciphertext, unicode_errors="replace"):
         self.use_time = datetime.now()
-        return super().decrypt(ciphertext, unicode_errors)
+
+        with self.lock:
+            return super().decrypt(ciphertext, unicode_errors)
 
     def encrypt(self, plaintext):
         self.use_time = datetime.now()
-        return super().encrypt(plaintext)
+
+        with self.lock:
+            return super().encrypt(plaintext)
 
 
-class InboundSession(olm.InboundSession, _SessionExpirationMixin):
+class InboundSession(_SessionLockMixin, olm.InboundSession, _SessionExpirationMixin):
     def __new__(cls, *args):
         return super().__new__(cls, *args)
 
@@ -91,14 +168,18 @@ class InboundSession(olm.InboundSession, _SessionExpirationMixin):
 
     def decrypt(self, ciphertext, unicode_errors="replace"):
         self.use_time = datetime.now()
-        return super().decrypt(ciphertext, unicode_errors)
+
+        with self.lock:
+            return super().decrypt(ciphertext, unicode_errors)
 
     def encrypt(self, plaintext):
         self.use_time = datetime.now()
-        return super().encrypt(plaintext)
+
+        with self.lock:
+            return super().encrypt(plaintext)
 
 
-class OutboundSession(olm.OutboundSession, _SessionExpirationMixin):
+class OutboundSession(_SessionLockMixin, olm.OutboundSession, _SessionExpirationMixin):
     def __new__(cls, *args):
         return super().__new__(cls, *args)
 
@@ -109,11 +190,15 @@ class OutboundSession(olm.OutboundSession, _SessionExpirationMixin):
 
     def decrypt(self, ciphertext, unicode_errors="replace"):
         self.use_time = datetime.now()
-        return super().decrypt(ciphertext, unicode_errors)
+
+        with self.lock:
+            return super().decrypt(ciphertext, unicode_errors)
 
     def encrypt(self, plaintext):
         self.use_time = datetime.now()
-        return super().encrypt(plaintext)
+
+        with self.lock:
+            return super().encrypt(plaintext)
 
 
 class InboundGroupSession(olm.InboundGroupSession):
@@ -193,6 +278,27 @@ class OutboundGroupSession(olm.OutboundGroupSession):
     def __new__(cls, **kwargs):
         return super().__new__(cls)
 
+    @classmethod
+    def from_pickle(
+        cls,
+        pickle: bytes,
+        creation_time: datetime,
+        message_count: int = 0,
+        shared: bool = False,
+        users_shared_with: Optional[Set[Tuple[str, str]]] = None,
+        users_ignored: Optional[Set[Tuple[str, str]]] = None,
+        passphrase: str = "",
+    ) -> OutboundGroupSession:
+        session = super().from_pickle(pickle, passphrase)
+        session.max_age = timedelta(days=7)
+        session.max_messages = 100
+        session.creation_time = creation_time
+        session.message_count = message_count
+        session.users_shared_with = users_shared_with or set()
+        session.users_ignored = users_ignored or set()
+        session.shared = shared
+        return session
+
     def mark_as_shared(self):
         self.shared = True
 
@@ -200,15 +306,20 @@ class OutboundGroupSession(olm.OutboundGroupSession):
     def expired(self):
         return self.should_rotate()
 
-    def should_rotate(self):
+    def should_rotate(self, margin: float = 0.0):
         """Should the session be rotated?
+
+        Args:
+            margin (float): The fraction of the message count and age limits
+                that the session should be rotated ahead of, e.g. 0.1 rotates
+                the session once 90% of either limit is reached.
+
         Returns:
             True if it should, False if not.
         """
-        if (
-            self.message_count >= self.max_messages
-            or datetime.now() - self.creation_time >= self.max_age
-        ):
+        if self.message_count >= self.max_messages * (
+            1 - margin
+        ) or datetime.now() - self.creation_time >= self.max_age * (1 - margin):
             return True
         return False
 
@@ -30,7 +30,7 @@ from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
 from ..api import PushRuleKind
 from ..schemas import Schemas
-from .misc import verify, verify_or_none
+from .misc import EventRegistry, verify, verify_or_none
 from .room_events import Event
 
 if TYPE_CHECKING:
@@ -41,18 +41,18 @@ if TYPE_CHECKING:
 class AccountDataEvent:
     """Abstract class for account data events."""
 
+    registry = EventRegistry()
+
     @classmethod
     @verify(Schemas.account_data)
     def parse_event(
         cls,
         event_dict: Dict[Any, Any],
     ):
-        if event_dict["type"] == "m.fully_read":
-            return FullyReadEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.tag":
-            return TagEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.push_rules":
-            return PushRulesEvent.from_dict(event_dict)
+        parser = AccountDataEvent.registry.get(event_dict["type"])
+
+        if parser is not None:
+            return parser(event_dict)
 
         return UnknownAccountDataEvent.from_dict(event_dict)
 
@@ -617,3 +617,8 @@ class UnknownAccountDataEvent(AccountDataEvent):
         """Construct an UnknownAccountDataEvent from a dictionary."""
         content = event_dict.pop("content")
         return cls(event_dict["type"], content)
+
+
+AccountDataEvent.registry.register("m.fully_read", FullyReadEvent)
+AccountDataEvent.registry.register("m.tag", TagEvent)
+AccountDataEvent.registry.register("m.push_rules", PushRulesEvent)
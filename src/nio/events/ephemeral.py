@@ -28,13 +28,15 @@ from typing import List, Optional
 
 from ..api import ReceiptType
 from ..schemas import Schemas
-from .misc import verify_or_none
+from .misc import EventRegistry, verify_or_none
 
 
 @dataclass
 class EphemeralEvent:
     """Base class for ephemeral events."""
 
+    registry = EventRegistry()
+
     @classmethod
     @verify_or_none(Schemas.ephemeral_event)
     def parse_event(cls, event_dict):
@@ -53,10 +55,10 @@ class EphemeralEvent:
             event_dict (dict): The dictionary representation of the event.
 
         """
-        if event_dict["type"] == "m.typing":
-            return TypingNoticeEvent.from_dict(event_dict)
-        if event_dict["type"] == "m.receipt":
-            return ReceiptEvent.from_dict(event_dict)
+        parser = EphemeralEvent.registry.get(event_dict["type"])
+
+        if parser is not None:
+            return parser(event_dict)
 
         return None
 
@@ -146,3 +148,7 @@ class ReceiptEvent(EphemeralEvent):
                         )
 
         return cls(event_receipts)
+
+
+EphemeralEvent.registry.register("m.typing", TypingNoticeEvent)
+EphemeralEvent.registry.register("m.receipt", ReceiptEvent)
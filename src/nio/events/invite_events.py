@@ -32,7 +32,7 @@ from dataclasses import dataclass, field
 from typing import Any, Dict, Optional, Union
 
 from ..schemas import Schemas
-from .misc import BadEventType, verify, verify_or_none
+from .misc import BadEventType, EventRegistry, verify, verify_or_none
 
 
 @dataclass
@@ -57,6 +57,8 @@ class InviteEvent:
     source: Dict = field()
     sender: str = field()
 
+    registry = EventRegistry()
+
     @classmethod
     @verify_or_none(Schemas.invite_event)
     def parse_event(
@@ -79,12 +81,10 @@ class InviteEvent:
             if "redacted_because" in event_dict["unsigned"]:
                 return None
 
-        if event_dict["type"] == "m.room.member":
-            return InviteMemberEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.canonical_alias":
-            return InviteAliasEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.name":
-            return InviteNameEvent.from_dict(event_dict)
+        parser = InviteEvent.registry.get(event_dict["type"])
+
+        if parser is not None:
+            return parser(event_dict)
 
         return None
 
@@ -197,3 +197,8 @@ class InviteNameEvent(InviteEvent):
         canonical_alias = parsed_dict["content"]["name"]
 
         return cls(parsed_dict, sender, canonical_alias)
+
+
+InviteEvent.registry.register("m.room.member", InviteMemberEvent)
+InviteEvent.registry.register("m.room.canonical_alias", InviteAliasEvent)
+InviteEvent.registry.register("m.room.name", InviteNameEvent)
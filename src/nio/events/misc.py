@@ -3,7 +3,7 @@ from __future__ import annotations
 import logging
 from dataclasses import dataclass, field
 from functools import wraps
-from typing import Any, Dict, Optional, Union
+from typing import Any, Callable, Dict, Optional, Union
 
 from jsonschema.exceptions import SchemaError, ValidationError
 
@@ -178,3 +178,97 @@ class BadEvent:
 
 
 BadEventType = Union[BadEvent, UnknownBadEvent]
+
+
+class EventRegistry:
+    """Mapping of event types to the parsers that handle them.
+
+    Every event family (room events, to-device events, account data...) has
+    its own registry, available as the ``registry`` attribute of the family's
+    base class, e.g. ``Event.registry``.
+
+    A parser is a callable taking the event dictionary and returning the
+    event object. If a class is registered, its ``from_dict()`` method is used
+    as the parser.
+
+    Parsers can be registered for an exact event type or for a dotted prefix,
+    e.g. ``m.call`` will handle ``m.call.invite`` if there isn't a more
+    specific parser registered for it.
+
+    Example:
+        >>> @Event.registry.register("org.example.custom")
+        ... @dataclass
+        ... class CustomEvent(Event):
+        ...     @classmethod
+        ...     def from_dict(cls, parsed_dict):
+        ...         return cls(parsed_dict)
+
+    """
+
+    def __init__(self) -> None:
+        self._types: Dict[str, Callable] = {}
+        self._prefixes: Dict[str, Callable] = {}
+
+    def register(
+        self,
+        event_type: str,
+        parser: Optional[Callable] = None,
+        prefix: bool = False,
+    ):
+        """Register a parser for the given event type.
+
+        Can be used as a class decorator if no parser is given.
+
+        Args:
+            event_type (str): The event type, or the dotted prefix of event
+                types, that the parser handles.
+            parser (Callable, optional): The event class or parsing function.
+            prefix (bool): Should the parser handle all event types that start
+                with the given prefix.
+        """
+        if parser is None:
+
+            def decorator(cls):
+                self.register(event_type, cls, prefix)
+                return cls
+
+            return decorator
+
+        if isinstance(parser, type):
+            parser = parser.from_dict
+
+        if prefix:
+            self._prefixes[event_type.rstrip(".")] = parser
+        else:
+            self._types[event_type] = parser
+
+        return parser
+
+    def unregister(self, event_type: str, prefix: bool = False) -> None:
+        """Remove the parser for the given event type or prefix."""
+        if prefix:
+            self._prefixes.pop(event_type.rstrip("."), None)
+        else:
+            self._types.pop(event_type, None)
+
+    def get(self, event_type: str) -> Optional[Callable]:
+        """Find the parser for an event type.
+
+        Returns None if no parser handles the event type.
+        """
+        parser = self._types.get(event_type)
+
+        if parser is not None or not self._prefixes:
+            return parser
+
+        while "." in event_type:
+            event_type = event_type.rsplit(".", 1)[0]
+            parser = self._prefixes.get(event_type)
+
+            if parser is not None:
+                return parser
+
+        return None
+
+    def __contains__(self, event_type: str) -> bool:
+        return self.get(event_type) is not None
@@ -21,7 +21,14 @@ from typing import Any, Dict, List, Optional, Union
 
 from ..event_builders import RoomKeyRequestMessage
 from ..schemas import Schemas
-from .misc import BadEvent, BadEventType, UnknownBadEvent, validate_or_badevent, verify
+from .misc import (
+    BadEvent,
+    BadEventType,
+    EventRegistry,
+    UnknownBadEvent,
+    validate_or_badevent,
+    verify,
+)
 
 
 @dataclass
@@ -65,6 +72,8 @@ class Event:
     session_id: Optional[str] = field(default=None, init=False)
     transaction_id: Optional[str] = field(default=None, init=False)
 
+    registry = EventRegistry()
+
     def __post_init__(self):
         self.event_id = self.source["event_id"]
         self.sender = self.source["sender"]
@@ -129,46 +138,10 @@ class Event:
             if "redacted_because" in event_dict["unsigned"]:
                 return RedactedEvent.from_dict(event_dict)
 
-        if event_dict["type"] == "m.room.message":
-            return RoomMessage.parse_event(event_dict)
-        elif event_dict["type"] == "m.room.create":
-            return RoomCreateEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.guest_access":
-            return RoomGuestAccessEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.join_rules":
-            return RoomJoinRulesEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.history_visibility":
-            return RoomHistoryVisibilityEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.member":
-            return RoomMemberEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.canonical_alias":
-            return RoomAliasEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.name":
-            return RoomNameEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.topic":
-            return RoomTopicEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.avatar":
-            return RoomAvatarEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.power_levels":
-            return PowerLevelsEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.encryption":
-            return RoomEncryptionEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.redaction":
-            return RedactionEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.tombstone":
-            return RoomUpgradeEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.space.parent":
-            return RoomSpaceParentEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.space.child":
-            return RoomSpaceChildEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.room.encrypted":
-            return Event.parse_encrypted_event(event_dict)
-        elif event_dict["type"] == "m.sticker":
-            return StickerEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.reaction":
-            return ReactionEvent.from_dict(event_dict)
-        elif event_dict["type"].startswith("m.call"):
-            return CallEvent.parse_event(event_dict)
+        parser = Event.registry.get(event_dict["type"])
+
+        if parser is not None:
+            return parser(event_dict)
 
         return UnknownEvent.from_dict(event_dict)
 
@@ -419,6 +392,8 @@ class CallEvent(Event):
     call_id: str = field()
     version: str = field()
 
+    registry = EventRegistry()
+
     @staticmethod
     def parse_event(event_dict):
         """Parse a Matrix event and create a higher level event object.
@@ -436,14 +411,10 @@ class CallEvent(Event):
             event_dict (dict): The raw matrix event dictionary.
 
         """
-        if event_dict["type"] == "m.call.candidates":
-            event = CallCandidatesEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.call.invite":
-            event = CallInviteEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.call.answer":
-            event = CallAnswerEvent.from_dict(event_dict)
-        elif event_dict["type"] == "m.call.hangup":
-            event = CallHangupEvent.from_dict(event_dict)
+        parser = CallEvent.registry.get(event_dict["type"])
+
+        if parser is not None:
+            event = parser(event_dict)
         else:
             event = UnknownEvent.from_dict(event_dict)
 
@@ -1619,3 +1590,30 @@ class RoomUpgradeEvent(Event):
             body,
             replacement_room,
         )
+
+
+CallEvent.registry.register("m.call.candidates", CallCandidatesEvent)
+CallEvent.registry.register("m.call.invite", CallInviteEvent)
+CallEvent.registry.register("m.call.answer", CallAnswerEvent)
+CallEvent.registry.register("m.call.hangup", CallHangupEvent)
+
+Event.registry.register("m.room.message", RoomMessage.parse_event)
+Event.registry.register("m.room.create", RoomCreateEvent)
+Event.registry.register("m.room.guest_access", RoomGuestAccessEvent)
+Event.registry.register("m.room.join_rules", RoomJoinRulesEvent)
+Event.registry.register("m.room.history_visibility", RoomHistoryVisibilityEvent)
+Event.registry.register("m.room.member", RoomMemberEvent)
+Event.registry.register("m.room.canonical_alias", RoomAliasEvent)
+Event.registry.register("m.room.name", RoomNameEvent)
+Event.registry.register("m.room.topic", RoomTopicEvent)
+Event.registry.register("m.room.avatar", RoomAvatarEvent)
+Event.registry.register("m.room.power_levels", PowerLevelsEvent)
+Event.registry.register("m.room.encryption", RoomEncryptionEvent)
+Event.registry.register("m.room.redaction", RedactionEvent)
+Event.registry.register("m.room.tombstone", RoomUpgradeEvent)
+Event.registry.register("m.space.parent", RoomSpaceParentEvent)
+Event.registry.register("m.space.child", RoomSpaceChildEvent)
+Event.registry.register("m.room.encrypted", Event.parse_encrypted_event)
+Event.registry.register("m.sticker", StickerEvent)
+Event.registry.register("m.reaction", ReactionEvent)
+Event.registry.register("m.call", CallEvent.parse_event, prefix=True)
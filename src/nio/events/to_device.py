@@ -37,7 +37,7 @@ from .common import (
     KeyVerificationMacMixin,
     KeyVerificationStartMixin,
 )
-from .misc import BadEventType, logger, verify
+from .misc import BadEventType, EventRegistry, logger, verify
 
 
 @dataclass
@@ -55,6 +55,8 @@ class ToDeviceEvent:
     source: Dict[str, Any] = field()
     sender: str = field()
 
+    registry = EventRegistry()
+
     @classmethod
     @verify(Schemas.to_device)
     def parse_event(
@@ -77,20 +79,10 @@ class ToDeviceEvent:
         if not event_dict["content"]:
             return None
 
-        if event_dict["type"] == "m.room.encrypted":
-            return ToDeviceEvent.parse_encrypted_event(event_dict)
-        elif event_dict["type"] == "m.key.verification.start":
-            return KeyVerificationStart.from_dict(event_dict)
-        elif event_dict["type"] == "m.key.verification.accept":
-            return KeyVerificationAccept.from_dict(event_dict)
-        elif event_dict["type"] == "m.key.verification.key":
-            return KeyVerificationKey.from_dict(event_dict)
-        elif event_dict["type"] == "m.key.verification.mac":
-            return KeyVerificationMac.from_dict(event_dict)
-        elif event_dict["type"] == "m.key.verification.cancel":
-            return KeyVerificationCancel.from_dict(event_dict)
-        elif event_dict["type"] == "m.room_key_request":
-            return BaseRoomKeyRequest.parse_event(event_dict)
+        parser = ToDeviceEvent.registry.get(event_dict["type"])
+
+        if parser is not None:
+            return parser(event_dict)
 
         return UnknownToDeviceEvent.from_dict(event_dict)
 
@@ -538,3 +530,12 @@ class UnknownToDeviceEvent(ToDeviceEvent):
             event_dict["sender"],
             event_dict["type"],
         )
+
+
+ToDeviceEvent.registry.register("m.room.encrypted", ToDeviceEvent.parse_encrypted_event)
+ToDeviceEvent.registry.register("m.key.verification.start", KeyVerificationStart)
+ToDeviceEvent.registry.register("m.key.verification.accept", KeyVerificationAccept)
+ToDeviceEvent.registry.register("m.key.verification.key", KeyVerificationKey)
+ToDeviceEvent.registry.register("m.key.verification.mac", KeyVerificationMac)
+ToDeviceEvent.registry.register("m.key.verification.cancel", KeyVerificationCancel)
+ToDeviceEvent.registry.register("m.room_key_request", BaseRoomKeyRequest.parse_event)
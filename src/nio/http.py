@@ -14,7 +14,6 @@
 
 from __future__ import annotations
 
-import json
 import logging
 import pprint
 import time
@@ -27,6 +26,8 @@ import h2.connection
 import h2.events
 import h11
 
+from . import json
+
 logger = logging.getLogger(__name__)
 
 USER_AGENT = "nio"
@@ -113,9 +114,7 @@ class HttpRequest(TransportRequest):
     @classmethod
     def _post_or_put(cls, method, host, target, data, headers=None, timeout=0):
         request_data = (
-            json.dumps(data, separators=(",", ":"))
-            if isinstance(data, dict)
-            else "" if data is None else data
+            json.dumps(data) if isinstance(data, dict) else "" if data is None else data
         )
 
         request_data = bytes(request_data, "utf-8")
@@ -176,9 +175,7 @@ class Http2Request(TransportRequest):
     @classmethod
     def _post_or_put(cls, method, host, target, data, headers, timeout):
         request_data = (
-            json.dumps(data, separators=(",", ":"))
-            if isinstance(data, dict)
-            else "" if data is None else data
+            json.dumps(data) if isinstance(data, dict) else "" if data is None else data
         )
 
         request_data = bytes(request_data, "utf-8")
@@ -0,0 +1,148 @@
+"""JSON encoding and decoding backends.
+
+nio uses the standard library json module by default, if orjson is installed
+it's used instead since it's considerably faster at both encoding and decoding.
+
+Canonical JSON, which is used for signatures, is guaranteed to be byte
+identical between the backends. Values orjson can't encode the same way as the
+standard library are encoded using the standard library.
+
+Example:
+    >>> from nio import json
+    >>> json.canonical_dumps({"b": 1, "a": "ü"})
+    '{"a":"ü","b":1}'
+    >>> json.set_backend("json")
+"""
+
+import json
+import re
+from typing import Any, Dict, Type, Union
+
+from ._compat import package_installed
+
+JSONDecodeError = json.JSONDecodeError
+
+# Floats are the only JSON values orjson formats differently, e.g. "1e16"
+# instead of "1e+16". Canonical JSON doesn't allow floats, so objects
+# containing them are rare and can be left to the standard library. This errs
+# on the side of caution and might match inside of strings as well, which only
+# costs us a fallback.
+_FLOAT_NUMBER = re.compile(rb"(?:^|[:,\[])-?\d+[.eE]")
+
+
+class JsonBackend:
+    """JSON backend using the standard library json module."""
+
+    name = "json"
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """Decode a JSON document."""
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> str:
+        """Encode an object to compact JSON."""
+        return json.dumps(obj, separators=(",", ":"))
+
+    def canonical_dumps(self, obj: Any) -> str:
+        """Encode an object to canonical JSON."""
+        return json.dumps(
+            obj,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            sort_keys=True,
+        )
+
+
+BACKENDS: Dict[str, Type[JsonBackend]] = {"json": JsonBackend}
+
+if package_installed("orjson"):
+    import orjson
+
+    class OrjsonBackend(JsonBackend):
+        """JSON backend using orjson.
+
+        Documents and objects orjson rejects, e.g. integers that don't fit
+        into 64 bits, NaN or dictionaries with non-string keys, are handled by
+        the standard library instead.
+        """
+
+        name = "orjson"
+
+        def loads(self, data: Union[str, bytes]) -> Any:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                return super().loads(data)
+
+        def dumps(self, obj: Any) -> str:
+            try:
+                return orjson.dumps(obj).decode()
+            except TypeError:
+                return super().dumps(obj)
+
+        def canonical_dumps(self, obj: Any) -> str:
+            try:
+                data = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+            except TypeError:
+                return super().canonical_dumps(obj)
+
+            if _FLOAT_NUMBER.search(data):
+                return super().canonical_dumps(obj)
+
+            return data.decode()
+
+    BACKENDS["orjson"] = OrjsonBackend
+
+DEFAULT_BACKEND = "orjson" if "orjson" in BACKENDS else "json"
+
+_backend: JsonBackend = BACKENDS[DEFAULT_BACKEND]()
+
+
+def get_backend() -> str:
+    """Get the name of the JSON backend that is in use."""
+    return _backend.name
+
+
+def set_backend(name: str) -> None:
+    """Select the JSON backend.
+
+    Args:
+        name (str): The name of the backend, either "json" or "orjson".
+
+    Raises a ValueError if the backend isn't available.
+    """
+    global _backend
+
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name} is not available")
+
+    _backend = BACKENDS[name]()
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Decode a JSON document.
+
+    Args:
+        data (str, bytes): The JSON document, bytes need to be UTF-8 encoded.
+
+    Raises a JSONDecodeError if the document isn't valid JSON.
+    """
+    return _backend.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Encode an object to compact JSON.
+
+    The exact output, e.g. the escaping of non-ASCII characters, depends on
+    the backend, use canonical_dumps() if the output needs to be stable.
+    """
+    return _backend.dumps(obj)
+
+
+def canonical_dumps(obj: Any) -> str:
+    """Encode an object to canonical JSON.
+
+    Keys are sorted, the separators are compact and non-ASCII characters
+    aren't escaped. The output is the same for every backend.
+    """
+    return _backend.canonical_dumps(obj)
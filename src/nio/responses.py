@@ -17,10 +17,24 @@ from __future__ import annotations
 
 import logging
 import os
+import re
+from collections.abc import MutableSequence
 from dataclasses import dataclass, field
 from datetime import datetime
 from functools import wraps
-from typing import Any, Dict, Generator, List, Optional, Set, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from jsonschema.exceptions import SchemaError, ValidationError
 
@@ -35,7 +49,7 @@ from .events import (
 )
 from .events.presence import PresenceEvent
 from .http import TransportResponse
-from .schemas import Schemas, validate_json
+from .schemas import RoomRegex, Schemas, validate_json
 
 logger = logging.getLogger(__name__)
 
@@ -69,6 +83,7 @@ __all__ = [
     "JoinError",
     "JoinedMembersResponse",
     "JoinedMembersError",
+    "LazyEventList",
     "JoinedRoomsResponse",
     "JoinedRoomsError",
     "KeysClaimResponse",
@@ -201,6 +216,101 @@ def verify(schema, error_class, pass_arguments=True):
     return decorator
 
 
+_UNPARSED = object()
+
+
+class LazyEventList(MutableSequence):
+    """A list of events that are parsed on first access.
+
+    The raw event dictionaries are kept around and every event is parsed the
+    first time it's accessed, the result is cached. Apart from that the list
+    behaves like a normal list of events.
+
+    Args:
+        sources (List[Dict]): The raw event dictionaries.
+        parser (Callable): The function that turns a raw event dictionary into
+            an event object.
+    """
+
+    def __init__(
+        self,
+        sources: List[Dict[Any, Any]],
+        parser: Callable[[Dict[Any, Any]], Any],
+    ):
+        self._sources: List[Optional[Dict[Any, Any]]] = list(sources)
+        self._events: List[Any] = [_UNPARSED] * len(self._sources)
+        self._parser = parser
+
+    def _parse(self, index: int) -> Any:
+        event = self._events[index]
+
+        if event is _UNPARSED:
+            event = self._parser(self._sources[index])
+            self._events[index] = event
+
+        return event
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._parse(i) for i in range(*index.indices(len(self)))]
+
+        return self._parse(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            raise TypeError("LazyEventList doesn't support slice assignment")
+
+        self._events[index] = value
+
+    def __delitem__(self, index):
+        del self._sources[index]
+        del self._events[index]
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(len(self._events)):
+            yield self._parse(index)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, LazyEventList)):
+            return list(self) == list(other)
+
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"LazyEventList({list(self)!r})"
+
+    def insert(self, index: int, value: Any) -> None:
+        self._sources.insert(index, None)
+        self._events.insert(index, value)
+
+    @property
+    def parsed_count(self) -> int:
+        """The number of events that have been parsed so far."""
+        return sum(event is not _UNPARSED for event in self._events)
+
+    def source(self, index: int) -> Optional[Dict[Any, Any]]:
+        """Get the raw dictionary of the event at the given index.
+
+        Returns None if the event was put into the list directly.
+        """
+        return self._sources[index]
+
+    def iter_types(self, event_types: Collection[str]) -> Iterator[Any]:
+        """Iterate over the events with the given types.
+
+        Only the matching events will be parsed. Events that were put into
+        the list directly or have a malformed source are always included.
+        """
+        for index, source in enumerate(self._sources):
+            if isinstance(source, dict) and source.get("type") not in event_types:
+                continue
+
+            yield self._parse(index)
+
+
 @dataclass
 class Rooms:
     invite: Dict[str, InviteInfo] = field()
@@ -255,8 +365,11 @@ class RoomInfo:
     unread_notifications: Optional[UnreadNotifications] = None
 
     @staticmethod
-    def parse_account_data(event_dict):
+    def parse_account_data(event_dict, lazy: bool = False):
         """Parse the account data dictionary and produce a list of events."""
+        if lazy:
+            return LazyEventList(event_dict, AccountDataEvent.parse_event)
+
         return [AccountDataEvent.parse_event(event) for event in event_dict]
 
 
@@ -408,7 +521,7 @@ class _ErrorWithRoomId(ErrorResponse):
     room_id: str = ""
 
     @classmethod
-    def from_dict(cls, parsed_dict, room_id):
+    def from_dict(cls, parsed_dict, room_id=""):
         try:
             validate_json(parsed_dict, Schemas.error)
         except (SchemaError, ValidationError):
@@ -601,7 +714,13 @@ class ThumbnailError(ErrorResponse):
 
 @dataclass
 class ShareGroupSessionError(_ErrorWithRoomId):
-    """Response representing unsuccessful group sessions sharing request."""
+    """Response representing unsuccessful group sessions sharing request.
+
+    Attributes:
+        users_shared_with (Set[Tuple[str, str]]): A set containing a tuple of
+            user id device id pairs with whom the group session couldn't be
+            shared.
+    """
 
     users_shared_with: Set[Tuple[str, str]] = field(default_factory=set)
 
@@ -610,10 +729,17 @@ class ShareGroupSessionError(_ErrorWithRoomId):
         try:
             validate_json(parsed_dict, Schemas.error)
         except (SchemaError, ValidationError):
-            return cls("unknown error")
+            return cls(
+                "unknown error", room_id=room_id, users_shared_with=users_shared_with
+            )
 
         return cls(
-            parsed_dict["error"], parsed_dict["errcode"], room_id, users_shared_with
+            parsed_dict["error"],
+            parsed_dict["errcode"],
+            parsed_dict.get("retry_after_ms"),
+            parsed_dict.get("soft_logout", False),
+            room_id,
+            users_shared_with,
         )
 
 
@@ -1819,9 +1945,15 @@ class ToDeviceError(ErrorResponse):
         try:
             validate_json(parsed_dict, Schemas.error)
         except (SchemaError, ValidationError):
-            return cls("unknown error", None, message)
+            return cls("unknown error", to_device_message=message)
 
-        return cls(parsed_dict["error"], parsed_dict["errcode"], message)
+        return cls(
+            parsed_dict["error"],
+            parsed_dict["errcode"],
+            parsed_dict.get("retry_after_ms"),
+            parsed_dict.get("soft_logout", False),
+            message,
+        )
 
 
 @dataclass
@@ -1933,7 +2065,11 @@ class SyncResponse(Response):
     @staticmethod
     def _get_room_events(
         parsed_dict: List[Dict[Any, Any]],
+        lazy: bool = False,
     ) -> List[Union[Event, BadEventType]]:
+        if lazy:
+            return LazyEventList(parsed_dict, Event.parse_event)
+
         events: List[Union[Event, BadEventType]] = []
 
         for event_dict in parsed_dict:
@@ -1952,21 +2088,21 @@ class SyncResponse(Response):
         ]
 
     @staticmethod
-    def _get_timeline(parsed_dict: Dict[Any, Any]) -> Timeline:
+    def _get_timeline(parsed_dict: Dict[Any, Any], lazy: bool = False) -> Timeline:
         validate_json(parsed_dict, Schemas.room_timeline)
 
-        events = SyncResponse._get_room_events(parsed_dict.get("events", []))
+        events = SyncResponse._get_room_events(parsed_dict.get("events", []), lazy)
 
         return Timeline(
             events, parsed_dict.get("limited", False), parsed_dict.get("prev_batch")
         )
 
     @staticmethod
-    def _get_state(parsed_dict: Dict[Any, Any]) -> List[Union[Event, BadEventType]]:
+    def _get_state(
+        parsed_dict: Dict[Any, Any], lazy: bool = False
+    ) -> List[Union[Event, BadEventType]]:
         validate_json(parsed_dict, Schemas.sync_room_state)
-        events = SyncResponse._get_room_events(
-            parsed_dict.get("events", []),
-        )
+        events = SyncResponse._get_room_events(parsed_dict.get("events", []), lazy)
 
         return events
 
@@ -2003,10 +2139,11 @@ class SyncResponse(Response):
         summary_events: Dict[str, Any],
         unread_notification_events: Dict[str, Any],
         account_data_events: List[Any],
+        lazy: bool = False,
     ) -> RoomInfo:
-        state = SyncResponse._get_room_events(state_events)
+        state = SyncResponse._get_room_events(state_events, lazy)
 
-        events = SyncResponse._get_room_events(timeline_events)
+        events = SyncResponse._get_room_events(timeline_events, lazy)
         timeline = Timeline(events, limited, prev_batch)
 
         ephemeral_event_list = SyncResponse._get_ephemeral_events(ephemeral_events)
@@ -2022,7 +2159,7 @@ class SyncResponse(Response):
             unread_notification_events.get("highlight_count"),
         )
 
-        account_data = RoomInfo.parse_account_data(account_data_events)
+        account_data = RoomInfo.parse_account_data(account_data_events, lazy)
 
         return RoomInfo(
             timeline,
@@ -2034,24 +2171,24 @@ class SyncResponse(Response):
         )
 
     @staticmethod
-    def _get_room_info(parsed_dict: Dict[Any, Any]) -> Rooms:
-        joined_rooms: Dict[str, RoomInfo] = {}
-        invited_rooms: Dict[str, InviteInfo] = {}
-        left_rooms: Dict[str, RoomInfo] = {}
-
-        for room_id, room_dict in parsed_dict.get("invite", {}).items():
+    def _get_room(
+        rooms: Rooms,
+        section: str,
+        room_id: str,
+        room_dict: Dict[Any, Any],
+        lazy: bool = False,
+    ) -> None:
+        if section == "invite":
             state = SyncResponse._get_invite_state(room_dict.get("invite_state", {}))
-            invite_info = InviteInfo(state)
-            invited_rooms[room_id] = invite_info
+            rooms.invite[room_id] = InviteInfo(state)
 
-        for room_id, room_dict in parsed_dict.get("leave", {}).items():
-            state = SyncResponse._get_state(room_dict.get("state", {}))
-            timeline = SyncResponse._get_timeline(room_dict.get("timeline", {}))
-            leave_info = RoomInfo(timeline, state, [], [])
-            left_rooms[room_id] = leave_info
+        elif section == "leave":
+            state = SyncResponse._get_state(room_dict.get("state", {}), lazy)
+            timeline = SyncResponse._get_timeline(room_dict.get("timeline", {}), lazy)
+            rooms.leave[room_id] = RoomInfo(timeline, state, [], [])
 
-        for room_id, room_dict in parsed_dict.get("join", {}).items():
-            join_info = SyncResponse._get_join_info(
+        elif section == "join":
+            rooms.join[room_id] = SyncResponse._get_join_info(
                 room_dict.get("state", {}).get("events", []),
                 room_dict.get("timeline", {}).get("events", []),
                 room_dict.get("timeline", {}).get("prev_batch"),
@@ -2060,11 +2197,51 @@ class SyncResponse(Response):
                 room_dict.get("summary", {}),
                 room_dict.get("unread_notifications", {}),
                 room_dict.get("account_data", {}).get("events", []),
+                lazy,
             )
 
-            joined_rooms[room_id] = join_info
+    @staticmethod
+    def add_streamed_room(
+        rooms: Rooms,
+        section: str,
+        room_id: str,
+        room_dict: Dict[Any, Any],
+        lazy: bool = False,
+    ) -> None:
+        """Validate and parse a single room of a streamed sync response.
+
+        Args:
+            rooms (Rooms): The rooms object the parsed room will be added to.
+            section (str): The section of the sync response the room was in,
+                one of "join", "invite" or "leave".
+            room_id (str): The id of the room.
+            room_dict (dict): The dictionary representation of the room.
+            lazy (bool): Should the events of the room be parsed lazily.
+
+        Raises a ValidationError if the room doesn't match the sync schema.
+        """
+        section_schema = Schemas.sync["properties"]["rooms"]["properties"][section]
+
+        # Just like in the full sync schema, rooms with invalid ids are left
+        # unchecked.
+        if re.search(RoomRegex, room_id):
+            validate_json(room_dict, section_schema["patternProperties"][RoomRegex])
 
-        return Rooms(invited_rooms, joined_rooms, left_rooms)
+        SyncResponse._get_room(rooms, section, room_id, room_dict, lazy)
+
+    @staticmethod
+    def _get_room_info(
+        parsed_dict: Dict[Any, Any],
+        lazy: bool = False,
+        rooms: Optional[Rooms] = None,
+    ) -> Rooms:
+        rooms = rooms or Rooms({}, {}, {})
+
+        for section in ("invite", "leave", "join"):
+            for room_id, room_dict in parsed_dict.get(section, {}).items():
+                SyncResponse._get_room(rooms, section, room_id, room_dict, lazy)
+
+        return rooms
 
     @staticmethod
     def _get_presence(parsed_dict) -> List[PresenceEvent]:
@@ -2085,7 +2262,19 @@ class SyncResponse(Response):
     def from_dict(
         cls,
         parsed_dict: Dict[Any, Any],
+        lazy: bool = False,
+        rooms: Optional[Rooms] = None,
     ) -> Union[SyncResponse, ErrorResponse]:
+        """Create a SyncResponse from a dictionary.
+
+        Args:
+            parsed_dict (dict): The dictionary representation of the response.
+            lazy (bool): If True, the room state, timeline and account data
+                events are parsed on first access, see LazyEventList.
+            rooms (Rooms, optional): Rooms that were already parsed while the
+                response was streamed, the rooms in the dictionary will be
+                added to them.
+        """
         to_device = cls._get_to_device(parsed_dict.get("to_device", {}))
 
         key_count_dict = parsed_dict.get("device_one_time_keys_count", {})
@@ -2100,7 +2289,7 @@ class SyncResponse(Response):
 
         presence_events = SyncResponse._get_presence(parsed_dict)
 
-        rooms = SyncResponse._get_room_info(parsed_dict.get("rooms", {}))
+        rooms = SyncResponse._get_room_info(parsed_dict.get("rooms", {}), lazy, rooms)
 
         return SyncResponse(
             parsed_dict["next_batch"],
@@ -63,6 +63,27 @@ __all__ = [
 class MatrixRoom:
     """Represents a Matrix room."""
 
+    # The state event types that handle_event() and handle_membership() make
+    # use of.
+    STATE_EVENT_TYPES = frozenset(
+        {
+            "m.room.create",
+            "m.room.guest_access",
+            "m.room.history_visibility",
+            "m.room.join_rules",
+            "m.room.name",
+            "m.room.canonical_alias",
+            "m.room.topic",
+            "m.room.avatar",
+            "m.room.encryption",
+            "m.room.tombstone",
+            "m.room.power_levels",
+            "m.space.parent",
+            "m.space.child",
+            "m.room.member",
+        }
+    )
+
     def __init__(self, room_id: str, own_user_id: str, encrypted: bool = False) -> None:
         """Initialize a MatrixRoom object."""
         # yapf: disable
@@ -14,7 +14,9 @@
 # CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
+import numbers
 import re
+from typing import Any, Callable, Dict, List, Optional
 
 from jsonschema import Draft4Validator, FormatChecker, validators
 
@@ -62,8 +64,291 @@ def check_http_url(value: str) -> bool:
     return True
 
 
+class _FastCheckCompiler:
+    """Generate a straight-line Python check function from a JSON schema.
+
+    The generated function returns True if the instance is valid and False if
+    it isn't, or if it can't tell. It applies the same defaults the extended
+    validator applies, in the same keyword order, so a successful fast check
+    leaves the instance exactly as a full validation would.
+
+    Only the subset of Draft 4 that our schemas use is supported, for anything
+    else compilation fails with a NotImplementedError.
+    """
+
+    SUPPORTED = {
+        "additionalProperties",
+        "enum",
+        "format",
+        "items",
+        "minimum",
+        "not",
+        "pattern",
+        "patternProperties",
+        "properties",
+        "required",
+        "type",
+    }
+
+    TYPE_CHECKS = {
+        "object": "isinstance({v}, dict)",
+        "array": "isinstance({v}, list)",
+        "string": "isinstance({v}, str)",
+        "integer": "(isinstance({v}, int) and not isinstance({v}, bool))",
+        "number": "_is_number({v})",
+        "boolean": "isinstance({v}, bool)",
+        "null": "{v} is None",
+    }
+
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self.namespace: Dict[str, Any] = {
+            "_is_number": _is_number,
+            "_checker": Checker,
+        }
+        self.counter = 0
+
+    def _name(self, prefix: str) -> str:
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    def _const(self, value: Any) -> str:
+        name = self._name("c")
+        self.namespace[name] = value
+        return name
+
+    def _emit(self, line: str, indent: int) -> None:
+        self.lines.append("    " * indent + line)
+
+    def compile(self, schema: Dict[str, Any]) -> Callable[[Any], bool]:
+        self._emit("def fast_check(v0):", 0)
+        self._schema(schema, "v0", 1)
+        self._emit("return True", 1)
+
+        code = compile("\n".join(self.lines), "<nio.schemas fast check>", "exec")
+        exec(code, self.namespace)
+
+        return self.namespace["fast_check"]
+
+    def _schema(self, schema: Dict[str, Any], var: str, indent: int) -> None:
+        if not isinstance(schema, dict):
+            raise NotImplementedError(f"Unsupported schema {schema!r}")
+
+        for keyword, value in schema.items():
+            if keyword not in Validator.VALIDATORS:
+                # Unknown keywords (default, const, ...) are ignored by the
+                # Draft 4 validator as well.
+                continue
+
+            if keyword not in self.SUPPORTED:
+                raise NotImplementedError(f"Unsupported keyword {keyword}")
+
+            getattr(self, "_" + keyword.lower())(value, schema, var, indent)
+
+    def _type(self, value, schema, var, indent):
+        types = [value] if isinstance(value, str) else value
+        checks = " or ".join(self.TYPE_CHECKS[t].format(v=var) for t in types)
+        self._emit(f"if not ({checks}):", indent)
+        self._emit("return False", indent + 1)
+
+    def _properties(self, value, schema, var, indent):
+        defaults = {
+            name: subschema["default"]
+            for name, subschema in value.items()
+            if "default" in subschema
+        }
+
+        if defaults:
+            # The extended validator calls setdefault() on anything it is
+            # given, leave non-objects to it so the behaviour stays the same.
+            self._emit(f"if not isinstance({var}, dict):", indent)
+            self._emit("return False", indent + 1)
+        else:
+            self._emit(f"if isinstance({var}, dict):", indent)
+            indent += 1
+
+        for name, default in defaults.items():
+            self._emit(f"{var}.setdefault({name!r}, {self._const(default)})", indent)
+
+        for name, subschema in value.items():
+            child = self._name("v")
+            self._emit(f"if {name!r} in {var}:", indent)
+            self._emit(f"{child} = {var}[{name!r}]", indent + 1)
+            self._schema(subschema, child, indent + 1)
+
+        self._emit("pass", indent)
+
+    def _patternproperties(self, value, schema, var, indent):
+        self._emit(f"if isinstance({var}, dict):", indent)
+
+        for pattern, subschema in value.items():
+            key, child = self._name("k"), self._name("v")
+            regex = self._const(re.compile(pattern))
+            self._emit(f"for {key}, {child} in {var}.items():", indent + 1)
+            self._emit(f"if {regex}.search({key}):", indent + 2)
+            self._schema(subschema, child, indent + 3)
+            self._emit("pass", indent + 3)
+
+        self._emit("pass", indent + 1)
+
+    def _additionalproperties(self, value, schema, var, indent):
+        if value is True:
+            return
+
+        properties = self._const(frozenset(schema.get("properties", {})))
+        patterns = self._const(
+            [re.compile(p) for p in schema.get("patternProperties", {})]
+        )
+        key, child = self._name("k"), self._name("v")
+
+        self._emit(f"if isinstance({var}, dict):", indent)
+        self._emit(f"for {key}, {child} in {var}.items():", indent + 1)
+        self._emit(
+            f"if {key} in {properties} or "
+            f"any(p.search({key}) for p in {patterns}):",
+            indent + 2,
+        )
+        self._emit("continue", indent + 3)
+
+        if value is False:
+            self._emit("return False", indent + 2)
+        else:
+            self._schema(value, child, indent + 2)
+
+    def _required(self, value, schema, var, indent):
+        required = self._const(tuple(value))
+        self._emit(
+            f"if isinstance({var}, dict) and "
+            f"not all(r in {var} for r in {required}):",
+            indent,
+        )
+        self._emit("return False", indent + 1)
+
+    def _items(self, value, schema, var, indent):
+        if not isinstance(value, dict):
+            raise NotImplementedError("Only single schema items are supported")
+
+        item = self._name("v")
+        self._emit(f"if isinstance({var}, list):", indent)
+        self._emit(f"for {item} in {var}:", indent + 1)
+        self._schema(value, item, indent + 2)
+        self._emit("pass", indent + 2)
+
+    def _enum(self, value, schema, var, indent):
+        # Equality between strings can't be confused with the bool/int
+        # equality corner cases of the full validator.
+        if not all(isinstance(e, str) for e in value):
+            raise NotImplementedError("Only string enums are supported")
+
+        self._emit(f"if {var} not in {self._const(tuple(value))}:", indent)
+        self._emit("return False", indent + 1)
+
+    def _minimum(self, value, schema, var, indent):
+        op = "<=" if schema.get("exclusiveMinimum", False) else "<"
+        self._emit(f"if _is_number({var}) and {var} {op} {value!r}:", indent)
+        self._emit("return False", indent + 1)
+
+    def _pattern(self, value, schema, var, indent):
+        regex = self._const(re.compile(value))
+        self._emit(f"if isinstance({var}, str) and not {regex}.search({var}):", indent)
+        self._emit("return False", indent + 1)
+
+    def _format(self, value, schema, var, indent):
+        if value not in Checker.checkers:
+            return
+
+        self._emit(
+            f"if not isinstance({var}, str) or "
+            f"not _checker.conforms({var}, {value!r}):",
+            indent,
+        )
+        self._emit("return False", indent + 1)
+
+    def _not(self, value, schema, var, indent):
+        if set(value) != {"required"}:
+            raise NotImplementedError("Only not-required schemas are supported")
+
+        required = self._const(tuple(value["required"]))
+        self._emit(
+            f"if not isinstance({var}, dict) or "
+            f"all(r in {var} for r in {required}):",
+            indent,
+        )
+        self._emit("return False", indent + 1)
+
+
+def _is_number(instance: Any) -> bool:
+    return isinstance(instance, numbers.Number) and not isinstance(instance, bool)
+
+
+def compile_fast_check(schema: Dict[str, Any]) -> Optional[Callable[[Any], bool]]:
+    """Compile a fast check function for the given schema.
+
+    Returns None if the schema uses features the fast path doesn't support.
+    """
+    try:
+        return _FastCheckCompiler().compile(schema)
+    except NotImplementedError:
+        return None
+
+
+class SchemaValidator:
+    """A precompiled validator for a single schema.
+
+    The fast check, if there is one, is tried first. Only if it fails is the
+    full jsonschema validator run, which produces the usual ValidationError.
+    """
+
+    def __init__(self, schema: Dict[str, Any], fast_path: bool = True) -> None:
+        self.schema = schema
+        self.validator = Validator(schema, format_checker=Checker)
+        self.fast_check = compile_fast_check(schema) if fast_path else None
+
+    def validate(self, instance: Any) -> None:
+        if self.fast_check is not None and self.fast_check(instance):
+            return
+
+        self.validator.validate(instance)
+
+
+class ValidatorRegistry:
+    """Cache of SchemaValidator objects, one per schema.
+
+    Schemas are looked up by identity, the registry keeps a reference to every
+    schema it has seen, so it's meant for long-lived schemas like the ones in
+    the Schemas class.
+
+    Args:
+        fast_path (bool): Should the generated fast checks be used.
+    """
+
+    def __init__(self, fast_path: bool = True) -> None:
+        self.fast_path = fast_path
+        self._validators: Dict[int, SchemaValidator] = {}
+
+    def get(self, schema: Dict[str, Any]) -> SchemaValidator:
+        validator = self._validators.get(id(schema))
+
+        if validator is None:
+            validator = SchemaValidator(schema, self.fast_path)
+            self._validators[id(schema)] = validator
+
+        return validator
+
+    def set_fast_path(self, enabled: bool) -> None:
+        """Enable or disable the generated fast checks."""
+        self.fast_path = enabled
+        self._validators.clear()
+
+    def clear(self) -> None:
+        self._validators.clear()
+
+
+validator_registry = ValidatorRegistry()
+
+
 def validate_json(instance, schema):
-    Validator(schema, format_checker=Checker).validate(instance)
+    validator_registry.get(schema).validate(instance)
 
 
 class Schemas:
@@ -3,12 +3,14 @@
 This module contains storage classes that are used to store encryption devices,
 encryption keys and the trust state of devices.
 
-The module contains three store implementations one using a Sqlite database and
+The module contains four store implementations one using a Sqlite database and
 plaintext files to store keys and the truststate of devices, one that uses a
-pure Sqlite database and one that stores the Sqlite database in memory.
+pure Sqlite database, one that stores the Sqlite database in memory and one
+that keeps everything in memory and persists it in a single snapshot file.
 
 User provided store types can be implemented by overriding the methods
-provided in the MatrixStore base class.
+provided in the MatrixStore base class, or by implementing the CryptoStore
+protocol.
 
 isort:skip_file
 """
@@ -28,7 +30,9 @@ if package_installed("olm"):
         ForwardedChains,
         Keys,
         MegolmInboundSessions,
+        MegolmOutboundSessions,
         OlmSessions,
+        OutboundSessionDevices,
         OutgoingKeyRequests,
         StoreVersion,
         SyncTokens,
@@ -38,6 +42,11 @@ if package_installed("olm"):
         MatrixStore,
         SqliteMemoryStore,
         SqliteStore,
+        StoreMaintenanceResult,
+        StoreProfile,
         use_database,
         use_database_atomic,
     )
+    from .async_store import AsyncMatrixStore, ThreadedStore
+    from .protocol import CryptoStore
+    from .snapshot import SnapshotStore
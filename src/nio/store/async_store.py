@@ -0,0 +1,516 @@
+"""Run a store on a dedicated database thread.
+
+Every MatrixStore method does blocking database I/O. The AsyncMatrixStore
+moves that I/O onto a single database thread that works through a queue, so
+the event loop doesn't stall on a slow disk.
+
+Example:
+    >>> store = AsyncMatrixStore(SqliteStore(user_id, device_id, store_path))
+    >>> await store.save_sync_token(token)
+    >>> devices = await store.load_device_keys()
+    >>> await store.close()
+"""
+
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+from functools import wraps
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from olm import Session as _OlmSession
+
+from ..crypto import (
+    DeviceStore,
+    InboundGroupSession,
+    LazyGroupSessionStore,
+    OlmAccount,
+    OlmDevice,
+    OutboundGroupSession,
+    Session,
+    TrustState,
+)
+from .database import MatrixStore, database_lock
+from .log import logger
+
+# Methods that don't return anything, the ThreadedStore queues them and
+# returns right away.
+QUEUED_WRITES = frozenset(
+    {
+        "add_outgoing_key_request",
+        "delete_encrypted_room",
+        "flush",
+        "remove_outbound_group_session",
+        "remove_outgoing_key_request",
+        "save_account",
+        "save_device_keys",
+        "save_encrypted_rooms",
+        "save_inbound_group_session",
+        "save_outbound_group_session",
+        "save_session",
+        "save_sessions",
+        "save_sync_token",
+    }
+)
+
+# Methods that can't run inside of the transaction of a batch.
+UNBATCHED = frozenset({"prune", "vacuum"})
+
+# Methods that change the trust state of the devices they are given.
+TRUST_CHANGES = frozenset(
+    {
+        "blacklist_device",
+        "ignore_device",
+        "ignore_devices",
+        "unblacklist_device",
+        "unignore_device",
+        "unverify_device",
+        "verify_device",
+    }
+)
+
+
+class _Job(NamedTuple):
+    function: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    future: Future
+    batched: bool
+
+
+def _copy_olm_object(value: Any, pickle_key: str) -> Any:
+    """Copy the libolm objects in the arguments of a store call.
+
+    The store pickles the objects it's given on the database thread while the
+    caller might keep using them, the libolm calls release the GIL so the
+    database thread gets copies instead. Lists and tuples, e.g. the arguments
+    of save_sessions(), are copied as well.
+
+    Copying pickles and unpickles the objects on the calling thread, which
+    costs about as much as the store pickling them.
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_olm_object(v, pickle_key) for v in value)
+
+    if isinstance(value, OlmAccount):
+        return OlmAccount.from_pickle(
+            value.pickle(pickle_key), pickle_key, value.shared
+        )
+
+    if isinstance(value, _OlmSession):
+        return Session.from_pickle(
+            value.pickle(pickle_key),
+            value.creation_time,
+            pickle_key,
+            value.use_time,
+        )
+
+    if isinstance(value, InboundGroupSession):
+        return InboundGroupSession.from_pickle(
+            value.pickle(pickle_key),
+            value.ed25519,
+            value.sender_key,
+            value.room_id,
+            pickle_key,
+            list(value.forwarding_chain),
+        )
+
+    if isinstance(value, OutboundGroupSession):
+        return OutboundGroupSession.from_pickle(
+            value.pickle(pickle_key),
+            value.creation_time,
+            value.message_count,
+            value.shared,
+            set(value.users_shared_with),
+            set(value.users_ignored),
+            pickle_key,
+        )
+
+    return value
+
+
+class AsyncMatrixStore:
+    """A store whose methods run on a dedicated database thread.
+
+    Every public method of the wrapped store is available as a coroutine, the
+    calls are queued and run one after the other on the database thread in
+    the order they were made. Calls that are queued while the thread is busy
+    are run in a single transaction once it's done, each call in a savepoint
+    of its own so a failing call doesn't roll back the others. A call returns
+    once its transaction is committed.
+
+    Olm objects passed to the store are copied before the call is queued,
+    the caller can keep using them. The copy is made on the calling thread,
+    saving an Olm object costs the event loop a pickle and an unpickle of it
+    instead of a database write.
+
+    Write-behind is turned off for the wrapped store, the pending writes are
+    flushed first. Queued writes are committed in groups which gives the same
+    benefit without holding the writes back. The wrapped store shouldn't be
+    used directly while the AsyncMatrixStore is open.
+
+    In-memory databases can't be used since SQLite gives every thread its own
+    in-memory database.
+
+    Args:
+        store (MatrixStore): The store that will be run on the database
+            thread.
+        max_batch_size (int): The maximal number of queued calls that are run
+            in a single transaction.
+    """
+
+    def __init__(self, store: MatrixStore, max_batch_size: int = 100) -> None:
+        if store.database.database == ":memory:":
+            raise ValueError("In-memory stores can't be used from another thread")
+
+        store.flush()
+        store.write_behind = False
+        # The database thread opens a connection of its own.
+        store.database.close()
+
+        self.store = store
+        self.max_batch_size = max_batch_size
+
+        self._queue: queue.SimpleQueue[Optional[_Job]] = queue.SimpleQueue()
+        self._closed = False
+        self._write_error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, name="nio-store", daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        method = getattr(self.store, name)
+
+        if name.startswith("_") or not callable(method):
+            raise AttributeError(name)
+
+        @wraps(method)
+        async def call(*args, **kwargs):
+            result = await asyncio.wrap_future(self._submit(name, args, kwargs))
+            return self._adopt(result)
+
+        return call
+
+    async def iter_inbound_group_sessions(
+        self, room_id: Optional[str] = None
+    ) -> AsyncIterator[InboundGroupSession]:
+        """Iterate over the Megolm inbound group sessions in the database.
+
+        The sessions are loaded in pages on the database thread, see
+        MatrixStore.iter_inbound_group_sessions().
+
+        Args:
+            room_id (str, optional): Only load the sessions of this room.
+        """
+        last_id = None
+
+        while True:
+            page = await asyncio.wrap_future(
+                self._submit("_load_inbound_group_session_page", (room_id, last_id), {})
+            )
+
+            if not page:
+                return
+
+            for session in page:
+                yield session
+
+            last_id = page[-1].id
+
+    def threaded_store(self) -> ThreadedStore:
+        """Get a synchronous interface to the store.
+
+        The interface can be used in place of the wrapped store by code that
+        isn't async, e.g. the Olm machine.
+        """
+        return ThreadedStore(self)
+
+    async def flush(self) -> None:
+        """Wait until all the calls that were queued so far are committed.
+
+        Raises the first error of a write that was queued through a
+        ThreadedStore since the last flush.
+        """
+        await asyncio.wrap_future(self._submit("flush", (), {}))
+
+        error, self._write_error = self._write_error, None
+
+        if error:
+            raise error
+
+    async def close(self) -> None:
+        """Run the queued calls and stop the database thread."""
+        if self._closed:
+            return
+
+        await self.flush()
+
+        self._closed = True
+        self._queue.put(None)
+
+        await asyncio.get_event_loop().run_in_executor(None, self._thread.join)
+
+    def _adopt(self, result: Any) -> Any:
+        # A lazy group session store loads the sessions from the store it
+        # was created by, it needs to go through the database thread as well.
+        if isinstance(result, LazyGroupSessionStore):
+            result.store = self.threaded_store()
+
+        return result
+
+    def _submit(self, name: str, args: tuple, kwargs: dict) -> Future:
+        return self._submit_function(
+            getattr(self.store, name), args, kwargs, name not in UNBATCHED
+        )
+
+    def _submit_function(
+        self,
+        function: Callable[..., Any],
+        args: tuple,
+        kwargs: dict,
+        batched: bool = True,
+    ) -> Future:
+        if self._closed:
+            raise RuntimeError("The store is closed")
+
+        pickle_key = self.store.pickle_key
+        job = _Job(
+            function,
+            _copy_olm_object(args, pickle_key),
+            {k: _copy_olm_object(v, pickle_key) for k, v in kwargs.items()},
+            Future(),
+            batched,
+        )
+        self._queue.put(job)
+
+        return job.future
+
+    def _queue_write(self, name: str, args: tuple, kwargs: dict) -> None:
+        future = self._submit(name, args, kwargs)
+        future.add_done_callback(self._check_write)
+
+    def _check_write(self, future: Future) -> None:
+        error = future.exception()
+
+        if error:
+            logger.warning("Error writing to the store: %s", error)
+            self._write_error = self._write_error or error
+
+    def _run(self) -> None:
+        while True:
+            batch: List[_Job] = []
+            job = self._queue.get()
+
+            while job is not None:
+                if not job.batched:
+                    if batch:
+                        self._run_batch(batch)
+                        batch = []
+
+                    self._run_job(job)
+                else:
+                    batch.append(job)
+
+                if len(batch) >= self.max_batch_size:
+                    self._run_batch(batch)
+                    batch = []
+
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._run_batch(batch)
+
+            if job is None:
+                self.store.database.close()
+                return
+
+    def _run_job(self, job: _Job) -> None:
+        if not job.future.set_running_or_notify_cancel():
+            return
+
+        try:
+            with database_lock:
+                result = job.function(*job.args, **job.kwargs)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+    def _run_batch(self, batch: List[_Job]) -> None:
+        database = self.store.database
+        batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+        results = []
+
+        try:
+            # The transaction only uses the connection of the store, the lock
+            # that guards the binding of the models is taken for every call
+            # so other stores aren't blocked for the whole batch.
+            with database.atomic():
+                for job in batch:
+                    try:
+                        with database_lock, database.atomic():
+                            results.append(
+                                (job.function(*job.args, **job.kwargs), None)
+                            )
+                    except Exception as e:  # noqa: PERF203
+                        results.append((None, e))
+        except Exception as e:
+            # The transaction failed, none of the calls went through.
+            results = [(None, error or e) for _, error in results]
+            results.extend((None, e) for _ in batch[len(results) :])
+
+        for job, (result, error) in zip(batch, results):
+            if error:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+
+def _load_trust_state(store: MatrixStore, device: OlmDevice) -> TrustState:
+    if store.is_device_verified(device):
+        return TrustState.verified
+    if store.is_device_blacklisted(device):
+        return TrustState.blacklisted
+    if store.is_device_ignored(device):
+        return TrustState.ignored
+
+    return TrustState.unset
+
+
+class ThreadedStore:
+    """Synchronous interface to an AsyncMatrixStore.
+
+    Writes that don't return anything are queued and return right away, an
+    error is logged and raised by the next AsyncMatrixStore.flush(). Every
+    other method waits for the database thread, it sees the writes that were
+    queued before it.
+
+    The Olm machine checks the trust state of every device it shares a group
+    session with, the trust states are kept in memory so the checks don't
+    wait for the database thread. They are taken from load_device_keys() and
+    kept up to date by the trust changes made through the ThreadedStore, the
+    trust state of other devices is loaded once.
+
+    Args:
+        async_store (AsyncMatrixStore): The store the calls are queued on.
+    """
+
+    def __init__(self, async_store: AsyncMatrixStore) -> None:
+        self.async_store = async_store
+        self._trust_states: Dict[Tuple[str, str, str], TrustState] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        method = getattr(self.async_store.store, name)
+
+        if name.startswith("_") or not callable(method):
+            return method
+
+        @wraps(method)
+        def call(*args, **kwargs):
+            if name in QUEUED_WRITES:
+                self.async_store._queue_write(name, args, kwargs)
+                return None
+
+            if name not in TRUST_CHANGES:
+                result = self.async_store._submit(name, args, kwargs).result()
+                return self.async_store._adopt(result)
+
+            devices = (*args, *kwargs.values())[0]
+
+            if isinstance(devices, OlmDevice):
+                devices = [devices]
+
+            # The trust states are loaded again if the change fails.
+            for device in devices:
+                self._trust_states.pop(self._trust_key(device), None)
+
+            result = self.async_store._submit(name, args, kwargs).result()
+
+            # The store updated the trust state of the devices.
+            for device in devices:
+                self._trust_states[self._trust_key(device)] = device.trust_state
+
+            return result
+
+        return call
+
+    @staticmethod
+    def _trust_key(device: OlmDevice) -> Tuple[str, str, str]:
+        return device.user_id, device.id, device.ed25519
+
+    def _get_trust_state(self, device: OlmDevice) -> TrustState:
+        key = self._trust_key(device)
+
+        if key not in self._trust_states:
+            self._trust_states[key] = self.async_store._submit_function(
+                _load_trust_state, (self.async_store.store, device), {}
+            ).result()
+
+        return self._trust_states[key]
+
+    def load_device_keys(self) -> DeviceStore:
+        """Load all the device keys from the database.
+
+        See MatrixStore.load_device_keys().
+        """
+        device_store = self.async_store._submit("load_device_keys", (), {}).result()
+        self._trust_states = {
+            self._trust_key(device): device.trust_state for device in device_store
+        }
+
+        return device_store
+
+    def is_device_verified(self, device: OlmDevice) -> bool:
+        """Check if a device is verified, without waiting for the database."""
+        return self._get_trust_state(device) == TrustState.verified
+
+    def is_device_blacklisted(self, device: OlmDevice) -> bool:
+        """Check if a device is blacklisted, without waiting for the database."""
+        return self._get_trust_state(device) == TrustState.blacklisted
+
+    def is_device_ignored(self, device: OlmDevice) -> bool:
+        """Check if a device is ignored, without waiting for the database."""
+        return self._get_trust_state(device) == TrustState.ignored
+
+    def prune(self, *args, **kwargs):
+        """Delete data that isn't needed anymore from the database.
+
+        See MatrixStore.prune(), the trust states of the deleted devices are
+        forgotten.
+        """
+        self._trust_states = {}
+        return self.async_store._submit("prune", args, kwargs).result()
+
+    def iter_inbound_group_sessions(
+        self, room_id: Optional[str] = None
+    ) -> Iterator[InboundGroupSession]:
+        """Iterate over the Megolm inbound group sessions in the database.
+
+        See MatrixStore.iter_inbound_group_sessions().
+        """
+        last_id = None
+
+        while True:
+            page = self.async_store._submit(
+                "_load_inbound_group_session_page", (room_id, last_id), {}
+            ).result()
+
+            if not page:
+                return
+
+            yield from page
+            last_id = page[-1].id
@@ -14,19 +14,23 @@ from __future__ import annotations
 
 import os
 import sqlite3
+import threading
+import time
 from dataclasses import dataclass, field
 from functools import wraps
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from peewee import DoesNotExist, SqliteDatabase
+from peewee import JOIN, DoesNotExist, SqliteDatabase, prefetch
 from playhouse.sqliteq import SqliteQueueDatabase
 
 from ..crypto import (
     DeviceStore,
     GroupSessionStore,
     InboundGroupSession,
+    LazyGroupSessionStore,
     OlmAccount,
     OlmDevice,
+    OutboundGroupSession,
     OutgoingKeyRequest,
     Session,
     SessionStore,
@@ -43,12 +47,32 @@ from . import (
     Keys,
     KeyStore,
     MegolmInboundSessions,
+    MegolmOutboundSessions,
     OlmSessions,
+    OutboundSessionDevices,
     OutgoingKeyRequests,
     StoreVersion,
     SyncTokens,
 )
 
+# The models are bound to the database of a single store at a time. Stores
+# that are used from more than one thread, see AsyncMatrixStore, hold this lock
+# while they use the models so they don't end up using another database.
+database_lock = threading.RLock()
+
+
+def bind_models(store):
+    """Bind the models of the store to the database of the store.
+
+    The binding persists, binding the models and their references is
+    expensive compared to a simple query so the models are only bound again
+    if another store has bound them to its database in the meantime.
+    """
+    for model in store.models:
+        if model._meta.database is not store.database:
+            store.database.bind(store.models)
+            return
+
 
 def use_database(fn):
     """
@@ -57,7 +81,8 @@ def use_database(fn):
 
     @wraps(fn)
     def inner(self, *args, **kwargs):
-        with self.database.bind_ctx(self.models):
+        with database_lock:
+            bind_models(self)
             return fn(self, *args, **kwargs)
 
     return inner
@@ -72,7 +97,9 @@ def use_database_atomic(fn):
 
     @wraps(fn)
     def inner(self, *args, **kwargs):
-        with self.database.bind_ctx(self.models):
+        with database_lock:
+            bind_models(self)
+
             if isinstance(self.database, SqliteQueueDatabase):
                 return fn(self, *args, **kwargs)
             else:
@@ -82,14 +109,136 @@ def use_database_atomic(fn):
     return inner
 
 
+@dataclass(frozen=True)
+class StoreProfile:
+    """SQLite performance profile of a store.
+
+    The default profile is the secure one, the database is synced to disk
+    after every transaction and deleted data doesn't linger in a write-ahead
+    log. The high_throughput() profile trades some durability for speed, a
+    power loss might lose the last transactions but won't corrupt the
+    database.
+
+    The journal mode is stored in the database file, a database that is
+    opened in WAL mode can't be switched back while another connection has it
+    open. Every store using the same database should use the same profile.
+
+    Attributes:
+        journal_mode (str): The SQLite journal mode, e.g. "delete" or "wal".
+        synchronous (str): How often SQLite syncs to disk, "full", "normal"
+            or "off".
+        mmap_size (int): The number of bytes of the database that will be
+            memory mapped, 0 disables memory mapping.
+        cache_size (int): The size of the page cache, in pages if positive or
+            in KiB if negative.
+        temp_store (str): Where temporary tables and indices are kept,
+            "default", "file" or "memory".
+    """
+
+    journal_mode: str = "delete"
+    synchronous: str = "full"
+    mmap_size: int = 0
+    cache_size: int = -2000
+    temp_store: str = "default"
+
+    @classmethod
+    def secure(cls) -> StoreProfile:
+        """The default profile, durable and without a write-ahead log."""
+        return cls()
+
+    @classmethod
+    def high_throughput(cls) -> StoreProfile:
+        """A profile using a write-ahead log and fewer disk syncs."""
+        return cls(
+            journal_mode="wal",
+            synchronous="normal",
+            mmap_size=256 * 1024 * 1024,
+            cache_size=-64 * 1024,
+            temp_store="memory",
+        )
+
+    def pragmas(self) -> Dict[str, Any]:
+        """Get the SQLite pragmas of this profile."""
+        return {
+            "journal_mode": self.journal_mode,
+            "synchronous": self.synchronous,
+            "mmap_size": self.mmap_size,
+            "cache_size": self.cache_size,
+            "temp_store": self.temp_store,
+        }
+
+
+@dataclass
+class StoreMaintenanceResult:
+    """What a maintenance run of a store removed.
+
+    Attributes:
+        olm_sessions (int): The number of Olm sessions that were deleted.
+        device_keys (int): The number of devices whose keys were deleted.
+        forwarded_chains (int): The number of forwarding chain entries of
+            Megolm sessions that don't exist anymore that were deleted.
+        reclaimed_bytes (int): The number of bytes the database file shrunk
+            by.
+    """
+
+    olm_sessions: int = 0
+    device_keys: int = 0
+    forwarded_chains: int = 0
+    reclaimed_bytes: int = 0
+
+
 @dataclass
 class MatrixStore:
-    """Storage class for matrix state."""
+    """Storage class for matrix state.
+
+    The store can defer the writes of the Olm account, Olm sessions, Megolm
+    inbound sessions and the sync token, see the write_behind attribute.
+    Deferred writes are coalesced, a session that is saved many times is
+    pickled and written only once, and written out in a single transaction by
+    flush().
+
+    Since all the deferred writes are committed atomically the database always
+    contains a consistent snapshot of the state as of the last flush. If the
+    process dies before a flush the changes since the previous one are lost,
+    including the sync token. The server will then send the events that
+    created the lost changes again, e.g. the to-device messages containing
+    room keys. The changes can't be partially written, so an Olm account that
+    lost a one-time key is never stored without the session created from it.
+
+    Changes that are older than write_behind_delay are written out with the
+    next deferred write, which might happen while a sync response is being
+    handled. The sync token is left out of such a write and only written by
+    flush(), the clients call it once a response was handled, so a sync token
+    is never committed before the changes of its sync. The delay is only
+    checked when a change is deferred, a store that isn't written to keeps
+    its pending changes until the next flush().
+
+    Megolm outbound sessions and Olm sessions that were used to encrypt a
+    message, see save_sessions(), are never deferred. Restoring an older
+    ratchet state of them after a crash would encrypt messages with message
+    indices or chain keys that were already used. Saving them writes out the
+    pending changes as well, except for the sync token.
+
+    Attributes:
+        profile (StoreProfile): The SQLite performance profile of the
+            database.
+        write_behind (bool): Defer the writes until flush() is called or
+            write_behind_delay seconds passed since the oldest pending change.
+        write_behind_delay (float): The maximal age in seconds of a pending
+            change before it's written out with the next deferred write.
+        lazy_group_sessions (bool): Make load_inbound_group_sessions() return
+            a LazyGroupSessionStore that loads the Megolm inbound sessions on
+            demand instead of loading all of them.
+        group_session_cache_size (int): The maximal number of Megolm inbound
+            sessions a lazy group session store keeps in memory.
+    """
 
     models = [
         Accounts,
         OlmSessions,
         MegolmInboundSessions,
+        MegolmOutboundSessions,
+        OutboundSessionDevices,
         ForwardedChains,
         DeviceKeys,
         EncryptedRooms,
@@ -98,22 +247,48 @@ class MatrixStore:
         Keys,
         SyncTokens,
     ]
-    store_version = 2
+    store_version = 3
 
     user_id: str = field()
     device_id: str = field()
     store_path: str = field()
     pickle_key: str = ""
     database_name: str = ""
+    profile: StoreProfile = StoreProfile()
     database_path: str = field(init=False)
     database: SqliteDatabase = field(init=False)
+    write_behind: bool = field(default=False, init=False)
+    write_behind_delay: float = field(default=5.0, init=False)
+    lazy_group_sessions: bool = field(default=False, init=False)
+    group_session_cache_size: int = field(default=1000, init=False)
+
+    _pending_account: Optional[OlmAccount] = field(default=None, init=False, repr=False)
+    _pending_sessions: Dict[Tuple[str, str], Tuple[str, Session]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _pending_group_sessions: Dict[Tuple[str, str, str], InboundGroupSession] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _pending_outbound_sessions: Dict[str, OutboundGroupSession] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _pending_sync_token: Optional[str] = field(default=None, init=False, repr=False)
+    _pending_since: Optional[float] = field(default=None, init=False, repr=False)
+
+    # The devices of every outbound group session that are in the database,
+    # by session id, so only new ones need to be written.
+    _outbound_session_devices: Dict[
+        str, Tuple[Set[Tuple[str, str]], Set[Tuple[str, str]]]
+    ] = field(default_factory=dict, init=False, repr=False)
 
     def _create_database(self):
         return SqliteDatabase(
             self.database_path,
             pragmas={
+                "auto_vacuum": "incremental",
                 "foreign_keys": 1,
                 "secure_delete": 1,
+                **self.profile.pragmas(),
             },
         )
 
@@ -131,20 +306,30 @@ class MatrixStore:
             self.database.create_tables([DeviceKeys, DeviceTrustState])
         self._update_version(2)
 
+    def upgrade_to_v3(self):
+        # Version 3 only adds indexes, creating the tables again is a no-op
+        # for the tables themselves but creates the missing indexes.
+        with self.database.bind_ctx(self.models):
+            self.database.create_tables([OlmSessions, MegolmInboundSessions])
+        self._update_version(3)
+
     def __post_init__(self):
         self.database_name = self.database_name or f"{self.user_id}_{self.device_id}.db"
         self.database_path = os.path.join(self.store_path, self.database_name)
         self.database = self._create_database()
         self.database.connect()
 
-        store_version = self._get_store_version()
+        with database_lock:
+            store_version = self._get_store_version()
 
-        # Update the store if it's an old version here.
-        if store_version == 1:
-            self.upgrade_to_v2()
+            # Update the store if it's an old version here.
+            if store_version < 2:
+                self.upgrade_to_v2()
+            if store_version < 3:
+                self.upgrade_to_v3()
 
-        with self.database.bind_ctx(self.models):
-            self.database.create_tables(self.models)
+            with self.database.bind_ctx(self.models):
+                self.database.create_tables(self.models)
 
     def _get_store_version(self):
         with self.database.bind_ctx([StoreVersion]):
@@ -158,6 +343,74 @@ class MatrixStore:
             v.version = new_version
             v.save()
 
+    def _write_through(self):
+        # The pending changes are written out with the change that can't be
+        # deferred so an Olm session never ends up in the database before the
+        # account it was created with.
+        self._pending_since = self._pending_since or time.monotonic()
+        self._flush(sync_token=False)
+
+    def _defer_write(self):
+        now = time.monotonic()
+
+        if self._pending_since is None:
+            self._pending_since = now
+        elif now - self._pending_since >= self.write_behind_delay:
+            # This might run while a response is being handled, the sync
+            # token stays pending until the next flush() so it's never
+            # committed before the rest of the changes of its sync.
+            self._flush(sync_token=False)
+
+    @property
+    def has_pending_writes(self) -> bool:
+        """Are there deferred writes that weren't flushed yet."""
+        return self._pending_since is not None
+
+    def flush(self) -> None:
+        """Write all the deferred changes to the database.
+
+        The changes are written in a single transaction, if writing fails
+        nothing is written and the changes stay pending.
+        """
+        self._flush(sync_token=True)
+
+    @use_database_atomic
+    def _flush(self, sync_token: bool) -> None:
+        if not self.has_pending_writes:
+            return
+
+        if self._pending_account:
+            self._write_account(self._pending_account)
+
+        if self._pending_sessions:
+            self._write_sessions(self._pending_sessions.values())
+
+        for session in self._pending_group_sessions.values():
+            self._write_inbound_group_session(session)
+
+        try:
+            for room_id, outbound_session in self._pending_outbound_sessions.items():
+                self._write_outbound_group_session(room_id, outbound_session)
+
+            if sync_token and self._pending_sync_token is not None:
+                self._write_sync_token(self._pending_sync_token)
+        except BaseException:
+            # The devices written out are rolled back, forget that they were
+            # written so they are written again with the next flush.
+            self._outbound_session_devices.clear()
+            raise
+
+        self._pending_account = None
+        self._pending_sessions = {}
+        self._pending_group_sessions = {}
+        self._pending_outbound_sessions = {}
+
+        if sync_token or self._pending_sync_token is None:
+            self._pending_sync_token = None
+            self._pending_since = None
+        else:
+            self._pending_since = time.monotonic()
+
     @use_database
     def _get_account(self):
         try:
@@ -175,6 +428,7 @@ class MatrixStore:
                 current device_id.
 
         """
+        self.flush()
         account = self._get_account()
 
         if not account:
@@ -182,7 +436,6 @@ class MatrixStore:
 
         return OlmAccount.from_pickle(account.account, self.pickle_key, account.shared)
 
-    @use_database
     def save_account(self, account):
         """Save the provided Olm account to the database.
 
@@ -190,6 +443,14 @@ class MatrixStore:
             account (OlmAccount): The olm account that will be pickled and
                 saved in the database.
         """
+        if self.write_behind:
+            self._pending_account = account
+            self._defer_write()
+        else:
+            self._write_account(account)
+
+    @use_database
+    def _write_account(self, account):
         Accounts.insert(
             user_id=self.user_id,
             device_id=self.device_id,
@@ -214,6 +475,7 @@ class MatrixStore:
             ``SessionStore`` object, containing all the loaded sessions.
 
         """
+        self.flush()
         session_store = SessionStore()
 
         account = self._get_account()
@@ -221,41 +483,98 @@ class MatrixStore:
         if not account:
             return session_store
 
-        for s in account.olm_sessions:
-            session = Session.from_pickle(s.session, s.creation_time, self.pickle_key)
+        sessions = account.olm_sessions.order_by(OlmSessions.last_usage_date.desc())
+
+        for s in sessions:
+            session = Session.from_pickle(
+                s.session, s.creation_time, self.pickle_key, s.last_usage_date
+            )
             session_store.add(s.sender_key, session)
 
         return session_store
 
-    @use_database
-    def save_session(self, curve_key, session):
+    def save_session(self, curve_key, session, sent=False):
         """Save the provided Olm session to the database.
 
         Args:
             curve_key (str): The curve key that owns the Olm session.
             session (Session): The Olm session that will be pickled and
                 saved in the database.
+            sent (bool): The session was used to encrypt a message, see
+                save_sessions().
         """
+        self.save_sessions([(curve_key, session)], sent)
+
+    def save_sessions(
+        self, sessions: List[Tuple[str, Session]], sent: bool = False
+    ) -> None:
+        """Save multiple Olm sessions to the database in a single transaction.
+
+        Args:
+            sessions (List[Tuple[str, Session]]): A list of (curve_key,
+                session) tuples.
+            sent (bool): The sessions were used to encrypt messages, they are
+                written out right away even if write_behind is set.
+        """
+        if not sessions:
+            return
+
+        if self.write_behind:
+            for curve_key, session in sessions:
+                self._pending_sessions[(curve_key, session.id)] = (curve_key, session)
+
+            if sent:
+                self._write_through()
+            else:
+                self._defer_write()
+        else:
+            self._write_sessions(sessions)
+
+    @use_database_atomic
+    def _write_sessions(self, sessions):
         account = self._get_account()
         assert account
 
-        OlmSessions.replace(
-            account=account,
-            sender_key=curve_key,
-            session=session.pickle(self.pickle_key),
-            session_id=session.id,
-            creation_time=session.creation_time,
-            last_usage_date=session.use_time,
-        ).execute()
+        sessions = list(sessions)
+
+        # The query is built by hand, see save_device_keys().
+        for idx in range(0, len(sessions), 100):
+            chunk = sessions[idx : idx + 100]
+
+            self.database.execute_sql(
+                "INSERT OR REPLACE INTO olmsessions "
+                "(account_id, sender_key, session, session_id, creation_time, "
+                "last_usage_date) "
+                f"VALUES {','.join(['(?, ?, ?, ?, ?, ?)'] * len(chunk))}",
+                [
+                    value
+                    for curve_key, session in chunk
+                    for value in (
+                        account.id,
+                        curve_key,
+                        session.pickle(self.pickle_key),
+                        session.id,
+                        OlmSessions.creation_time.db_value(session.creation_time),
+                        OlmSessions.last_usage_date.db_value(session.use_time),
+                    )
+                ],
+            )
 
     @use_database
     def load_inbound_group_sessions(self) -> GroupSessionStore:
         """Load all Olm sessions from the database.
 
+        If lazy_group_sessions is set the sessions aren't loaded, a
+        LazyGroupSessionStore that loads them on demand is returned instead.
+
         Returns:
             ``GroupSessionStore`` object, containing all the loaded sessions.
 
         """
+        if self.lazy_group_sessions:
+            return LazyGroupSessionStore(self, self.group_session_cache_size)
+
+        self.flush()
         store = GroupSessionStore()
 
         account = self._get_account()
@@ -264,25 +583,118 @@ class MatrixStore:
             return store
 
         for s in account.inbound_group_sessions:
-            session = InboundGroupSession.from_pickle(
-                s.session,
-                s.fp_key,
-                s.sender_key,
-                s.room_id,
-                self.pickle_key,
-                [chain.sender_key for chain in s.forwarded_chains],
-            )
-            store.add(session)
+            store.add(self._unpickle_inbound_group_session(s))
 
         return store
 
+    def _unpickle_inbound_group_session(self, s):
+        return InboundGroupSession.from_pickle(
+            s.session,
+            s.fp_key,
+            s.sender_key,
+            s.room_id,
+            self.pickle_key,
+            [chain.sender_key for chain in s.forwarded_chains],
+        )
+
+    @use_database
+    def load_inbound_group_session(
+        self, room_id: str, sender_key: str, session_id: str
+    ) -> Optional[InboundGroupSession]:
+        """Load a single Megolm inbound group session from the database.
+
+        Args:
+            room_id (str): The room id of the room the session belongs to.
+            sender_key (str): The curve25519 key of the session creator.
+            session_id (str): The unique id of the session.
+
+        Returns the InboundGroupSession or None if no such session was found.
+        """
+        pending = self._pending_group_sessions.get((room_id, sender_key, session_id))
+
+        if pending:
+            return pending
+
+        try:
+            s = (
+                MegolmInboundSessions.select()
+                .join(Accounts)
+                .where(
+                    Accounts.user_id == self.user_id,
+                    Accounts.device_id == self.device_id,
+                    MegolmInboundSessions.session_id == session_id,
+                    MegolmInboundSessions.room_id == room_id,
+                    MegolmInboundSessions.sender_key == sender_key,
+                )
+                .get()
+            )
+        except DoesNotExist:
+            return None
+
+        return self._unpickle_inbound_group_session(s)
+
+    def iter_inbound_group_sessions(
+        self, room_id: Optional[str] = None
+    ) -> Iterator[InboundGroupSession]:
+        """Iterate over the Megolm inbound group sessions in the database.
+
+        The sessions are loaded in pages, only a page of them is held in
+        memory at a time.
+
+        Args:
+            room_id (str, optional): Only load the sessions of this room.
+        """
+        self.flush()
+        last_id = None
+
+        while True:
+            page = self._load_inbound_group_session_page(room_id, last_id)
+
+            if not page:
+                return
+
+            yield from page
+            last_id = page[-1].id
+
     @use_database
+    def _load_inbound_group_session_page(self, room_id, last_id, page_size=500):
+        account = self._get_account()
+
+        if not account:
+            return []
+
+        query = MegolmInboundSessions.select().where(
+            MegolmInboundSessions.account == account
+        )
+
+        if room_id:
+            query = query.where(MegolmInboundSessions.room_id == room_id)
+
+        if last_id:
+            query = query.where(MegolmInboundSessions.session_id > last_id)
+
+        query = query.order_by(MegolmInboundSessions.session_id).limit(page_size)
+
+        return [
+            self._unpickle_inbound_group_session(s)
+            for s in prefetch(query, ForwardedChains)
+        ]
+
     def save_inbound_group_session(self, session):
         """Save the provided Megolm inbound group session to the database.
 
         Args:
             session (InboundGroupSession): The session to save.
         """
+        if self.write_behind:
+            key = (session.room_id, session.sender_key, session.id)
+            self._pending_group_sessions[key] = session
+            self._defer_write()
+        else:
+            self._write_inbound_group_session(session)
+
+    @use_database
+    def _write_inbound_group_session(self, session):
         account = self._get_account()
         assert account
 
@@ -315,19 +727,52 @@ class MatrixStore:
         if not account:
             return store
 
-        for d in account.device_keys:
-            store.add(
-                OlmDevice(
-                    d.user_id,
-                    d.device_id,
-                    {k.key_type: k.key for k in d.keys},
-                    display_name=d.display_name,
-                    deleted=d.deleted,
-                )
-            )
+        for device in self._load_olm_devices(account).values():
+            store.add(device)
 
         return store
 
+    def _load_olm_devices(self, account) -> Dict[int, OlmDevice]:
+        """Load the devices of an account, keyed by their database id.
+
+        The devices and their keys are fetched with a single query and
+        without creating model instances, this matters for accounts that
+        know about hundreds of thousands of devices.
+        """
+        devices: Dict[int, OlmDevice] = {}
+
+        query = (
+            DeviceKeys.select(
+                DeviceKeys.id,
+                DeviceKeys.user_id,
+                DeviceKeys.device_id,
+                DeviceKeys.display_name,
+                DeviceKeys.deleted,
+                Keys.key_type,
+                Keys.key,
+            )
+            .join(Keys, JOIN.LEFT_OUTER)
+            .where(DeviceKeys.account == account)
+            .tuples()
+        )
+
+        for row_id, user_id, device_id, display_name, deleted, key_type, key in query:
+            device = devices.get(row_id)
+
+            if not device:
+                device = devices[row_id] = OlmDevice(
+                    user_id,
+                    device_id,
+                    {},
+                    display_name=display_name,
+                    deleted=deleted,
+                )
+
+            if key_type:
+                device.keys[key_type] = key
+
+        return devices
+
     @use_database_atomic
     def save_device_keys(self, device_keys):
         """Save the provided device keys to the database.
@@ -339,40 +784,396 @@ class MatrixStore:
         """
         account = self._get_account()
         assert account
-        rows = []
-
-        for user_id, devices_dict in device_keys.items():
-            for device_id, device in devices_dict.items():
-                rows.append(
-                    {
-                        "account": account,
-                        "user_id": user_id,
-                        "device_id": device_id,
-                        "display_name": device.display_name,
-                        "deleted": device.deleted,
-                    }
-                )
 
-        if not rows:
+        devices = [
+            (user_id, device_id, device)
+            for user_id, devices_dict in device_keys.items()
+            for device_id, device in devices_dict.items()
+        ]
+
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            self._legacy_save_device_keys(account, devices)
             return
 
+        # The queries are built by hand, generating the SQL for big inserts
+        # with peewee takes a lot longer than running them.
+        for idx in range(0, len(devices), 100):
+            chunk = devices[idx : idx + 100]
+
+            self.database.execute_sql(
+                "INSERT INTO devicekeys "
+                "(account_id, user_id, device_id, display_name, deleted) "
+                f"VALUES {','.join(['(?, ?, ?, ?, ?)'] * len(chunk))} "
+                "ON CONFLICT (account_id, user_id, device_id) "
+                "DO UPDATE SET deleted = excluded.deleted",
+                [
+                    value
+                    for user_id, device_id, device in chunk
+                    for value in (
+                        account.id,
+                        user_id,
+                        device_id,
+                        device.display_name,
+                        device.deleted,
+                    )
+                ],
+            )
+
+            user_ids = list({user_id for user_id, _, _ in chunk})
+            device_ids = list({device_id for _, device_id, _ in chunk})
+
+            # This might select some rows that aren't part of the chunk, if
+            # the device ids of different users are mixed up, they are
+            # simply ignored.
+            cursor = self.database.execute_sql(
+                "SELECT id, user_id, device_id FROM devicekeys "
+                "WHERE account_id = ? "
+                f"AND user_id IN ({','.join(['?'] * len(user_ids))}) "
+                f"AND device_id IN ({','.join(['?'] * len(device_ids))})",
+                [account.id, *user_ids, *device_ids],
+            )
+            row_ids = {
+                (user_id, device_id): row_id
+                for row_id, user_id, device_id in cursor.fetchall()
+            }
+
+            keys = [
+                value
+                for user_id, device_id, device in chunk
+                for key_type, key in device.keys.items()
+                for value in (row_ids[(user_id, device_id)], key_type, key)
+            ]
+
+            for key_idx in range(0, len(keys), 900):
+                data = keys[key_idx : key_idx + 900]
+
+                self.database.execute_sql(
+                    "INSERT INTO keys (device_id, key_type, key) "
+                    f"VALUES {','.join(['(?, ?, ?)'] * (len(data) // 3))} "
+                    "ON CONFLICT (device_id, key_type) "
+                    "DO UPDATE SET key = excluded.key",
+                    data,
+                )
+
+    def _legacy_save_device_keys(self, account, devices):
+        rows = [
+            {
+                "account": account,
+                "user_id": user_id,
+                "device_id": device_id,
+                "display_name": device.display_name,
+                "deleted": device.deleted,
+            }
+            for user_id, device_id, device in devices
+        ]
+
         for idx in range(0, len(rows), 100):
             data = rows[idx : idx + 100]
             DeviceKeys.insert_many(data).on_conflict_ignore().execute()
 
-        for user_id, devices_dict in device_keys.items():
-            for device_id, device in devices_dict.items():
-                d = DeviceKeys.get(
-                    (DeviceKeys.account == account)
-                    & (DeviceKeys.user_id == user_id)
-                    & (DeviceKeys.device_id == device_id)
-                )
+        for user_id, device_id, device in devices:
+            d = DeviceKeys.get(
+                (DeviceKeys.account == account)
+                & (DeviceKeys.user_id == user_id)
+                & (DeviceKeys.device_id == device_id)
+            )
+
+            d.deleted = device.deleted
+            d.save()
+
+            for key_type, key in device.keys.items():
+                Keys.replace(key_type=key_type, key=key, device=d).execute()
+
+    @use_database
+    def load_outbound_group_sessions(self) -> Dict[str, OutboundGroupSession]:
+        """Load the Megolm outbound sessions of this account.
+
+        Returns a dictionary mapping a room id to the outbound session of the
+        room.
+        """
+        self.flush()
+        account = self._get_account()
+
+        if not account:
+            return {}
+
+        sessions = {}
+
+        query = MegolmOutboundSessions.select().where(
+            MegolmOutboundSessions.account == account
+        )
+
+        for row in prefetch(query, OutboundSessionDevices):
+            shared_with = set()
+            ignored = set()
+
+            for device in row.devices:
+                devices = ignored if device.ignored else shared_with
+                devices.add((device.user_id, device.device_id))
+
+            sessions[row.room_id] = OutboundGroupSession.from_pickle(
+                row.session,
+                row.creation_time,
+                row.message_count,
+                row.shared,
+                set(shared_with),
+                set(ignored),
+                self.pickle_key,
+            )
+            self._outbound_session_devices[row.session_id] = (shared_with, ignored)
+
+        return sessions
+
+    def save_outbound_group_session(
+        self, room_id: str, session: OutboundGroupSession
+    ) -> None:
+        """Save the Megolm outbound session of a room.
+
+        Replaces the previously saved session of the room. Only the devices
+        the session was shared with, or ignored, since the session was last
+        saved are written out. The session is written out right away even if
+        write_behind is set.
+
+        Args:
+            room_id (str): The room the session belongs to.
+            session (OutboundGroupSession): The session to save.
+        """
+        if self.write_behind:
+            self._pending_outbound_sessions[room_id] = session
+            self._write_through()
+        else:
+            self._write_outbound_group_session(room_id, session)
+
+    @use_database_atomic
+    def _write_outbound_group_session(
+        self, room_id: str, session: OutboundGroupSession
+    ) -> None:
+        account = self._get_account()
+        assert account
+
+        row = MegolmOutboundSessions.get_or_none(
+            MegolmOutboundSessions.account == account,
+            MegolmOutboundSessions.room_id == room_id,
+        )
+
+        if row and row.session_id != session.id:
+            self._outbound_session_devices.pop(row.session_id, None)
+            row.delete_instance()
+            row = None
+
+        if row is None:
+            row = MegolmOutboundSessions(
+                room_id=room_id, account=account, session_id=session.id
+            )
+
+        row.session = session.pickle(self.pickle_key)
+        row.creation_time = session.creation_time
+        row.message_count = session.message_count
+        row.shared = session.shared
+        row.save()
+
+        saved_shared, saved_ignored = self._outbound_session_devices.setdefault(
+            session.id, (set(), set())
+        )
+        shared_with = session.users_shared_with - saved_shared
+        ignored = session.users_ignored - saved_ignored
+
+        rows = [(user_id, device_id, False, row) for user_id, device_id in shared_with]
+        rows.extend((user_id, device_id, True, row) for user_id, device_id in ignored)
+
+        for idx in range(0, len(rows), 200):
+            OutboundSessionDevices.insert_many(
+                rows[idx : idx + 200],
+                fields=[
+                    OutboundSessionDevices.user_id,
+                    OutboundSessionDevices.device_id,
+                    OutboundSessionDevices.ignored,
+                    OutboundSessionDevices.session,
+                ],
+            ).on_conflict_ignore().execute()
+
+        saved_shared.update(shared_with)
+        saved_ignored.update(ignored)
+
+    @use_database
+    def remove_outbound_group_session(self, room_id: str) -> None:
+        """Remove the Megolm outbound session of a room from the store."""
+        self._pending_outbound_sessions.pop(room_id, None)
+
+        account = self._get_account()
+
+        if not account:
+            return
+
+        row = MegolmOutboundSessions.get_or_none(
+            MegolmOutboundSessions.account == account,
+            MegolmOutboundSessions.room_id == room_id,
+        )
+
+        if row:
+            self._outbound_session_devices.pop(row.session_id, None)
+            row.delete_instance()
+
+    def prune(
+        self,
+        max_olm_sessions: int,
+        users: Iterable[str] = (),
+        compact: bool = True,
+    ) -> StoreMaintenanceResult:
+        """Delete data that isn't needed anymore from the database.
+
+        Pending writes are flushed first. Then old Olm sessions, the device
+        keys of the given users and orphaned forwarding chains are deleted.
+
+        Args:
+            max_olm_sessions (int): The number of most recently used Olm
+                sessions that are kept for every device.
+            users (Iterable[str]): The users whose device keys should be
+                deleted, e.g. users that we don't share an encrypted room
+                with anymore.
+            compact (bool): Give the freed space back to the file system
+                using an incremental vacuum, see vacuum().
+
+        Returns a StoreMaintenanceResult describing what was removed.
+        """
+        self.flush()
+
+        result = StoreMaintenanceResult(
+            olm_sessions=self.prune_olm_sessions(max_olm_sessions),
+            device_keys=self.prune_device_keys(users),
+            forwarded_chains=self.prune_forwarded_chains(),
+        )
+
+        if compact:
+            result.reclaimed_bytes = self.vacuum(incremental=True)
+
+        return result
+
+    @use_database_atomic
+    def prune_olm_sessions(self, max_sessions: int) -> int:
+        """Delete all but the most recently used Olm sessions of every device.
+
+        Args:
+            max_sessions (int): The number of sessions that are kept for
+                every sender key.
+
+        Returns the number of deleted sessions.
+        """
+        account = self._get_account()
+
+        if not account:
+            return 0
+
+        query = (
+            OlmSessions.select(OlmSessions.sender_key, OlmSessions.session_id)
+            .where(OlmSessions.account == account)
+            .order_by(OlmSessions.sender_key, OlmSessions.last_usage_date.desc())
+            .tuples()
+        )
+
+        stale = []
+        kept: Dict[str, int] = {}
+
+        for sender_key, session_id in query:
+            kept[sender_key] = kept.get(sender_key, 0) + 1
 
-                d.deleted = device.deleted
-                d.save()
+            if kept[sender_key] > max_sessions:
+                stale.append(session_id)
 
-                for key_type, key in device.keys.items():
-                    Keys.replace(key_type=key_type, key=key, device=d).execute()
+        for i in range(0, len(stale), 500):
+            OlmSessions.delete().where(
+                OlmSessions.session_id.in_(stale[i : i + 500])
+            ).execute()
+
+        return len(stale)
+
+    @use_database_atomic
+    def prune_device_keys(self, users: Iterable[str]) -> int:
+        """Delete the devices, and their keys, of the given users.
+
+        Args:
+            users (Iterable[str]): The users whose devices should be deleted.
+
+        Returns the number of deleted devices.
+        """
+        account = self._get_account()
+        users = list(users)
+
+        if not account or not users:
+            return 0
+
+        deleted = 0
+
+        for i in range(0, len(users), 500):
+            devices = DeviceKeys.select(DeviceKeys.id).where(
+                DeviceKeys.account == account,
+                DeviceKeys.user_id.in_(users[i : i + 500]),
+            )
+            self._delete_device_references(devices)
+            Keys.delete().where(Keys.device.in_(devices)).execute()
+            deleted += DeviceKeys.delete().where(DeviceKeys.id.in_(devices)).execute()
+
+        return deleted
+
+    def _delete_device_references(self, devices) -> None:
+        """Delete rows of store specific tables that reference the devices."""
+
+    @use_database
+    def prune_forwarded_chains(self) -> int:
+        """Delete forwarding chains whose Megolm session doesn't exist.
+
+        Returns the number of deleted forwarding chain entries.
+        """
+        sessions = MegolmInboundSessions.select(MegolmInboundSessions.session_id)
+
+        return (
+            ForwardedChains.delete()
+            .where(ForwardedChains.session.not_in(sessions))
+            .execute()
+        )
+
+    @use_database
+    def vacuum(self, incremental: bool = True) -> int:
+        """Give the free space of the database file back to the file system.
+
+        An incremental vacuum only releases the pages that deleted data left
+        behind, it is fast but needs a database that was created in the
+        incremental auto-vacuum mode, which is the case for every database
+        created by this version of the store. Otherwise it does nothing.
+
+        A full vacuum rebuilds the database file, which takes a while for
+        large databases and temporarily needs as much free disk space as the
+        database takes up. It also switches older databases to the
+        incremental auto-vacuum mode.
+
+        Neither can run inside of a transaction.
+
+        Args:
+            incremental (bool): Do an incremental vacuum instead of a full
+                one.
+
+        Returns the number of bytes the database file shrunk by.
+        """
+
+        def database_size() -> int:
+            page_size = self.database.pragma("page_size")
+            return self.database.pragma("page_count") * page_size
+
+        self.flush()
+        size = database_size()
+
+        if incremental:
+            # The pragma does nothing unless the database is in the
+            # incremental auto-vacuum mode.
+            if self.database.pragma("auto_vacuum") == 2:
+                # The sqlite3 module only runs a single step of the pragma
+                # when it's executed as a statement, which frees one page. As
+                # a script it runs until all the free pages are released.
+                self.database.connection().executescript("PRAGMA incremental_vacuum;")
+        else:
+            self.database.execute_sql("VACUUM")
+
+        return size - database_size()
 
     @use_database
     def load_encrypted_rooms(self):
@@ -450,9 +1251,16 @@ class MatrixStore:
                 rows, fields=[EncryptedRooms.room_id, EncryptedRooms.account]
             ).on_conflict_ignore().execute()
 
-    @use_database
     def save_sync_token(self, token: str) -> None:
         """Save the given token"""
+        if self.write_behind:
+            self._pending_sync_token = token
+            self._defer_write()
+        else:
+            self._write_sync_token(token)
+
+    @use_database
+    def _write_sync_token(self, token: str) -> None:
         account = self._get_account()
         assert account
 
@@ -460,6 +1268,7 @@ class MatrixStore:
 
     @use_database
     def load_sync_token(self) -> Optional[str]:
+        self.flush()
         account = self._get_account()
 
         if not account:
@@ -608,6 +1417,8 @@ class DefaultStore(MatrixStore):
             encryption keys while they are in storage.
         database_name (str, optional): The file-name of the database that
             should be used.
+        profile (StoreProfile, optional): The SQLite performance profile of
+            the database, defaults to the secure profile.
     """
 
     trust_db: KeyStore = field(init=False)
@@ -705,15 +1516,7 @@ class DefaultStore(MatrixStore):
         if not account:
             return store
 
-        for d in account.device_keys:
-            device = OlmDevice(
-                d.user_id,
-                d.device_id,
-                {k.key_type: k.key for k in d.keys},
-                display_name=d.display_name,
-                deleted=d.deleted,
-            )
-
+        for device in self._load_olm_devices(account).values():
             trust_state = TrustState.unset
             key = Key.from_olmdevice(device)
 
@@ -738,6 +1541,11 @@ class SqliteStore(MatrixStore):
     This store uses an Sqlite database as the main storage format as well as
     the store format for the trust state.
 
+    The trust states are loaded into memory once, either by
+    load_device_keys() or by the first trust check, and written through on
+    every change. Trust checks don't query the database, which means that
+    changes made to the database by another store object aren't seen.
+
     Args:
         user_id (str): The fully-qualified ID of the user that owns the store.
         device_id (str): The device id of the user's device.
@@ -746,10 +1554,55 @@ class SqliteStore(MatrixStore):
             encryption keys while they are in storage.
         database_name (str, optional): The file-name of the database that
             should be used.
+        profile (StoreProfile, optional): The SQLite performance profile of
+            the database, defaults to the secure profile.
     """
 
     models = MatrixStore.models + [DeviceTrustState]
 
+    _trust_states: Optional[Dict[Tuple[str, str], TrustState]] = field(
+        default=None, init=False, repr=False
+    )
+
+    def _get_trust_state(self, device: OlmDevice) -> TrustState:
+        if self._trust_states is None:
+            self._trust_states = self._load_trust_states()
+
+        return self._trust_states.get((device.user_id, device.id), TrustState.unset)
+
+    def _delete_device_references(self, devices) -> None:
+        DeviceTrustState.delete().where(DeviceTrustState.device.in_(devices)).execute()
+        self._trust_states = None
+
+    @use_database
+    def _load_trust_states(self) -> Dict[Tuple[str, str], TrustState]:
+        account = self._get_account()
+
+        if not account:
+            return {}
+
+        query = (
+            DeviceTrustState.select(
+                DeviceKeys.user_id, DeviceKeys.device_id, DeviceTrustState.state
+            )
+            .join(DeviceKeys)
+            .where(DeviceKeys.account == account)
+            .tuples()
+        )
+
+        return {(user_id, device_id): state for user_id, device_id, state in query}
+
+    def _set_trust_state(self, device: OlmDevice, trust_state: TrustState) -> None:
+        d = self._get_device(device)
+        assert d
+
+        DeviceTrustState.replace(device=d, state=trust_state).execute()
+
+        device.trust_state = trust_state
+
+        if self._trust_states is not None:
+            self._trust_states[(device.user_id, device.id)] = trust_state
+
     def _get_device(self, device):
         acc = self._get_account()
 
@@ -770,12 +1623,7 @@ class SqliteStore(MatrixStore):
         if self.is_device_verified(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.verified).execute()
-
-        device.trust_state = TrustState.verified
+        self._set_trust_state(device, TrustState.verified)
 
         return True
 
@@ -784,40 +1632,19 @@ class SqliteStore(MatrixStore):
         if not self.is_device_verified(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.unset).execute()
-
-        device.trust_state = TrustState.unset
+        self._set_trust_state(device, TrustState.unset)
 
         return True
 
-    @use_database
     def is_device_verified(self, device: OlmDevice) -> bool:
-        d = self._get_device(device)
-
-        if not d:
-            return False
-
-        try:
-            trust_state = d.trust_state[0].state
-        except IndexError:
-            return False
-
-        return trust_state == TrustState.verified
+        return self._get_trust_state(device) == TrustState.verified
 
     @use_database
     def blacklist_device(self, device: OlmDevice) -> bool:
         if self.is_device_blacklisted(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.blacklisted).execute()
-
-        device.trust_state = TrustState.blacklisted
+        self._set_trust_state(device, TrustState.blacklisted)
 
         return True
 
@@ -826,40 +1653,19 @@ class SqliteStore(MatrixStore):
         if not self.is_device_blacklisted(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.unset).execute()
-
-        device.trust_state = TrustState.unset
+        self._set_trust_state(device, TrustState.unset)
 
         return True
 
-    @use_database
     def is_device_blacklisted(self, device: OlmDevice) -> bool:
-        d = self._get_device(device)
-
-        if not d:
-            return False
-
-        try:
-            trust_state = d.trust_state[0].state
-        except IndexError:
-            return False
-
-        return trust_state == TrustState.blacklisted
+        return self._get_trust_state(device) == TrustState.blacklisted
 
     @use_database
     def ignore_device(self, device: OlmDevice) -> bool:
         if self.is_device_ignored(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.ignored).execute()
-
-        device.trust_state = TrustState.ignored
+        self._set_trust_state(device, TrustState.ignored)
 
         return True
 
@@ -868,12 +1674,7 @@ class SqliteStore(MatrixStore):
         if not self.is_device_ignored(device):
             return False
 
-        d = self._get_device(device)
-        assert d
-
-        DeviceTrustState.replace(device=d, state=TrustState.unset).execute()
-
-        device.trust_state = TrustState.unset
+        self._set_trust_state(device, TrustState.unset)
 
         return True
 
@@ -942,19 +1743,11 @@ class SqliteStore(MatrixStore):
         for device in devices:
             device.trust_state = TrustState.ignored
 
-    @use_database
-    def is_device_ignored(self, device: OlmDevice) -> bool:
-        d = self._get_device(device)
-
-        if not d:
-            return False
-
-        try:
-            trust_state = d.trust_state[0].state
-        except IndexError:
-            return False
+            if self._trust_states is not None:
+                self._trust_states[(device.user_id, device.id)] = TrustState.ignored
 
-        return trust_state == TrustState.ignored
+    def is_device_ignored(self, device: OlmDevice) -> bool:
+        return self._get_trust_state(device) == TrustState.ignored
 
     @use_database
     def load_device_keys(self) -> DeviceStore:
@@ -964,22 +1757,24 @@ class SqliteStore(MatrixStore):
         if not account:
             return store
 
-        for d in account.device_keys:
-            try:
-                trust_state = d.trust_state[0].state
-            except IndexError:
-                trust_state = TrustState.unset
-
-            store.add(
-                OlmDevice(
-                    d.user_id,
-                    d.device_id,
-                    {k.key_type: k.key for k in d.keys},
-                    display_name=d.display_name,
-                    deleted=d.deleted,
-                    trust_state=trust_state,
-                )
-            )
+        devices = self._load_olm_devices(account)
+
+        trust_states = (
+            DeviceTrustState.select(DeviceTrustState.device, DeviceTrustState.state)
+            .join(DeviceKeys)
+            .where(DeviceKeys.account == account)
+            .tuples()
+        )
+
+        self._trust_states = {}
+
+        for row_id, trust_state in trust_states:
+            device = devices[row_id]
+            device.trust_state = trust_state
+            self._trust_states[(device.user_id, device.id)] = trust_state
+
+        for device in devices.values():
+            store.add(device)
 
         return store
 
@@ -996,16 +1791,20 @@ class SqliteMemoryStore(SqliteStore):
         device_id (str): The device id of the user's device.
         pickle_key (str, optional): A passphrase that will be used to encrypt
             encryption keys while they are in storage.
+        profile (StoreProfile, optional): The SQLite performance profile of
+            the database, defaults to the secure profile.
     """
 
-    def __init__(self, user_id, device_id, pickle_key=""):
-        super().__init__(user_id, device_id, "", pickle_key=pickle_key)
+    def __init__(self, user_id, device_id, pickle_key="", profile=StoreProfile()):
+        super().__init__(user_id, device_id, "", pickle_key=pickle_key, profile=profile)
 
     def _create_database(self):
         return SqliteDatabase(
             ":memory:",
             pragmas={
+                "auto_vacuum": "incremental",
                 "foreign_keys": 1,
                 "secure_delete": 1,
+                **self.profile.pragmas(),
             },
         )
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import os
+from contextlib import contextmanager
 from functools import wraps
-from typing import Any, Iterator, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from atomicwrites import atomic_write
 
@@ -64,14 +66,49 @@ class Ed25519Key(Key):
 
 
 class KeyStore:
+    """A file backed store of device keys.
+
+    The keys are indexed by the user and device id of the device they belong
+    to. The file is used as an append-only journal, every added key appends a
+    line to it. Once the journal contains considerably more lines than there
+    are keys in the store it's compacted, the file is atomically replaced by
+    one containing only the current keys.
+
+    Removing a key always compacts the file. Removals are rare and this keeps
+    the file readable by older versions, which only know about lines that add
+    a key. A last line without a newline is the remainder of an append that
+    was interrupted, it's ignored and the file is compacted with the next
+    change.
+
+    Changes can be grouped using the batch() context manager, all the changes
+    made inside of it are written out at once when it exits.
+
+    Args:
+        filename (str): The path of the file the keys are stored in.
+    """
+
+    compaction_threshold = 1000
+
     def __init__(self, filename: str):
-        self._entries: List[Key] = []
+        self._entries: Dict[Tuple[str, str], Key] = {}
         self._filename: str = filename
 
+        self._journal_length = 0
+        self._unsaved: List[str] = []
+        self._removed = False
+        self._batch_depth = 0
+        self._missing_newline = False
+
         self._load(filename)
 
     def __iter__(self) -> Iterator[Key]:
-        yield from self._entries
+        yield from list(self._entries.values())
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, Key) and self.check(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
     def __repr__(self) -> str:
         return f"KeyStore object, file: {self._filename}"
@@ -79,7 +116,16 @@ class KeyStore:
     def _load(self, filename: str):
         try:
             with open(filename) as f:
-                for line in f:
+                for number, line in enumerate(f, 1):
+                    if not line.endswith("\n"):
+                        # Only the last line can lack the newline.
+                        logger.warning(
+                            f"Ignoring the incomplete last line of {filename}: "
+                            f"{line!r}"
+                        )
+                        self._missing_newline = True
+                        continue
+
                     line = line.strip()
 
                     if not line or line.startswith("#"):
@@ -88,33 +134,84 @@ class KeyStore:
                     entry = Key.from_line(line)
 
                     if not entry:
+                        logger.warning(
+                            f"Ignoring invalid line {number} of {filename}: "
+                            f"{line!r}"
+                        )
                         continue
 
-                    self._entries.append(entry)
+                    self._journal_length += 1
+                    self._entries[(entry.user_id, entry.device_id)] = entry
         except FileNotFoundError:
             pass
 
     def get_key(self, user_id: str, device_id: str) -> Optional[Key]:
-        for entry in self._entries:
-            if user_id == entry.user_id and device_id == entry.device_id:
-                return entry
-
-        return None
+        return self._entries.get((user_id, device_id))
 
     def _save_store(f):
         @wraps(f)
         def decorated(self, *args, **kwargs):
-            ret = f(self, *args, **kwargs)
-            self._save()
-            return ret
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                if not self._batch_depth:
+                    self._save()
 
         return decorated
 
+    @contextmanager
+    def batch(self) -> Iterator[KeyStore]:
+        """Group changes so that they are written out at once.
+
+        The changes made inside the context are appended to the file with a
+        single write and fsync once the outermost batch exits.
+
+        Example:
+            >>> with key_store.batch():
+            ...     for key in keys:
+            ...         key_store.add(key)
+        """
+        self._batch_depth += 1
+
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+
+            if not self._batch_depth:
+                self._save()
+
     def _save(self):
+        lines, self._unsaved = self._unsaved, []
+        self._journal_length += len(lines)
+
+        # The incomplete last line is dropped by compacting the file,
+        # completing it with a newline would turn it into a wrong key.
+        if (
+            self._removed
+            or self._missing_newline
+            or self._journal_length
+            > max(self.compaction_threshold, 2 * len(self._entries))
+        ):
+            self._compact()
+            return
+
+        if not lines:
+            return
+
+        with open(self._filename, "a") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
         with atomic_write(self._filename, overwrite=True) as f:
-            for entry in self._entries:
-                line = entry.to_line()
-                f.write(line)
+            for entry in self._entries.values():
+                f.write(entry.to_line())
+
+        self._journal_length = len(self._entries)
+        self._missing_newline = False
+        self._removed = False
 
     @_save_store  # type: ignore
     def add_many(self, keys: List[Key]):
@@ -125,39 +222,47 @@ class KeyStore:
         existing_key = self.get_key(key.user_id, key.device_id)
 
         if existing_key:
-            if (
-                existing_key.user_id == key.user_id
-                and existing_key.device_id == key.device_id
-                and type(existing_key) is type(key)
-            ):
-                if existing_key.key != key.key:
-                    message = (
-                        f"Error: adding existing device to trust store with "
-                        f"mismatching fingerprint {key.key} {existing_key.key}"
-                    )
-                    logger.error(message)
-                    raise OlmTrustError(message)
-
-        self._entries.append(key)
+            if type(existing_key) is type(key) and existing_key.key != key.key:
+                message = (
+                    f"Error: adding existing device to trust store with "
+                    f"mismatching fingerprint {key.key} {existing_key.key}"
+                )
+                logger.error(message)
+                raise OlmTrustError(message)
+
+            if existing_key == key:
+                return True
+
+        self._entries[(key.user_id, key.device_id)] = key
+        self._unsaved.append(key.to_line())
         return True
 
     @_save_store  # type: ignore
     def add(self, key: Key) -> bool:
         return self._add_without_save(key)
 
+    def _remove_entry(self, key: Key) -> bool:
+        if not self.check(key):
+            return False
+
+        del self._entries[(key.user_id, key.device_id)]
+        return True
+
+    def _remove_without_save(self, key: Key) -> bool:
+        if not self._remove_entry(key):
+            return False
+
+        self._removed = True
+        return True
+
     @_save_store  # type: ignore
     def remove_many(self, keys: List[Key]):
         for key in keys:
-            if key in self._entries:
-                self._entries.remove(key)
+            self._remove_without_save(key)
 
     @_save_store  # type: ignore
     def remove(self, key: Key) -> bool:
-        if key in self._entries:
-            self._entries.remove(key)
-            return True
-
-        return False
+        return self._remove_without_save(key)
 
     def check(self, key: Key) -> bool:
-        return key in self._entries
+        return self._entries.get((key.user_id, key.device_id)) == key
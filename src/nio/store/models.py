@@ -88,6 +88,9 @@ class OlmSessions(Model):
     session = ByteField()
     session_id = TextField(primary_key=True)
 
+    class Meta:
+        indexes = ((("account", "last_usage_date"), False),)
+
 
 class DeviceKeys_v1(Model):
     sender_key = TextField()
@@ -158,6 +161,42 @@ class MegolmInboundSessions(Model):
     session = ByteField()
     session_id = TextField(primary_key=True)
 
+    class Meta:
+        indexes = ((("account", "room_id", "session_id"), False),)
+
+
+class MegolmOutboundSessions(Model):
+    room_id = TextField()
+    account = ForeignKeyField(
+        model=Accounts,
+        column_name="account_id",
+        backref="outbound_group_sessions",
+        on_delete="CASCADE",
+    )
+    session = ByteField()
+    session_id = TextField()
+    creation_time = DateField()
+    message_count = IntegerField()
+    shared = BooleanField()
+
+    class Meta:
+        constraints = [SQL("UNIQUE(account_id,room_id)")]
+
+
+class OutboundSessionDevices(Model):
+    user_id = TextField()
+    device_id = TextField()
+    ignored = BooleanField()
+    session = ForeignKeyField(
+        model=MegolmOutboundSessions,
+        column_name="session_id",
+        backref="devices",
+        on_delete="CASCADE",
+    )
+
+    class Meta:
+        constraints = [SQL("UNIQUE(session_id,user_id,device_id,ignored)")]
+
 
 class ForwardedChains(Model):
     sender_key = TextField()
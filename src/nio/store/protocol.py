@@ -0,0 +1,154 @@
+"""The interface of the encryption stores.
+
+The Olm machine and the clients only use the methods and attributes of the
+CryptoStore protocol, any class implementing it can be used as a store. The
+MatrixStore family stores everything in a SQLite database, the SnapshotStore
+keeps everything in memory and persists it in a single file.
+
+A store is expected to behave like the MatrixStore, see its documentation
+for the details of every method. The conformance tests in the test suite
+check a store against the expected behaviour.
+"""
+
+from __future__ import annotations
+
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    runtime_checkable,
+)
+
+from ..crypto import (
+    DeviceStore,
+    GroupSessionStore,
+    InboundGroupSession,
+    OlmAccount,
+    OlmDevice,
+    OutboundGroupSession,
+    OutgoingKeyRequest,
+    Session,
+    SessionStore,
+)
+from .database import StoreMaintenanceResult
+
+
+@runtime_checkable
+class CryptoStore(Protocol):
+    """Protocol of the stores that hold the encryption state of a device.
+
+    Attributes:
+        user_id (str): The fully-qualified ID of the user that owns the store.
+        device_id (str): The device id of the user's device.
+        pickle_key (str): The passphrase the encryption keys are pickled
+            with.
+        write_behind (bool): Defer the writes until flush() is called or
+            write_behind_delay seconds passed since the oldest pending change.
+        write_behind_delay (float): The maximal age in seconds of a pending
+            change.
+        lazy_group_sessions (bool): Return a LazyGroupSessionStore from
+            load_inbound_group_sessions() that loads the sessions on demand.
+        group_session_cache_size (int): The number of sessions a
+            LazyGroupSessionStore keeps in memory.
+    """
+
+    user_id: str
+    device_id: str
+    pickle_key: str
+    write_behind: bool
+    write_behind_delay: float
+    lazy_group_sessions: bool
+    group_session_cache_size: int
+
+    @property
+    def has_pending_writes(self) -> bool: ...
+
+    def flush(self) -> None: ...
+
+    def load_account(self) -> Optional[OlmAccount]: ...
+
+    def save_account(self, account: OlmAccount) -> None: ...
+
+    def load_sessions(self) -> SessionStore: ...
+
+    def save_session(
+        self, curve_key: str, session: Session, sent: bool = False
+    ) -> None: ...
+
+    def save_sessions(
+        self, sessions: List[Tuple[str, Session]], sent: bool = False
+    ) -> None: ...
+
+    def load_inbound_group_sessions(self) -> GroupSessionStore: ...
+
+    def load_inbound_group_session(
+        self, room_id: str, sender_key: str, session_id: str
+    ) -> Optional[InboundGroupSession]: ...
+
+    def iter_inbound_group_sessions(
+        self, room_id: Optional[str] = None
+    ) -> Iterator[InboundGroupSession]: ...
+
+    def save_inbound_group_session(self, session: InboundGroupSession) -> None: ...
+
+    def load_outbound_group_sessions(self) -> Dict[str, OutboundGroupSession]: ...
+
+    def save_outbound_group_session(
+        self, room_id: str, session: OutboundGroupSession
+    ) -> None: ...
+
+    def remove_outbound_group_session(self, room_id: str) -> None: ...
+
+    def load_device_keys(self) -> DeviceStore: ...
+
+    def save_device_keys(
+        self, device_keys: Dict[str, Dict[str, OlmDevice]]
+    ) -> None: ...
+
+    def verify_device(self, device: OlmDevice) -> bool: ...
+
+    def unverify_device(self, device: OlmDevice) -> bool: ...
+
+    def is_device_verified(self, device: OlmDevice) -> bool: ...
+
+    def blacklist_device(self, device: OlmDevice) -> bool: ...
+
+    def unblacklist_device(self, device: OlmDevice) -> bool: ...
+
+    def is_device_blacklisted(self, device: OlmDevice) -> bool: ...
+
+    def ignore_device(self, device: OlmDevice) -> bool: ...
+
+    def unignore_device(self, device: OlmDevice) -> bool: ...
+
+    def ignore_devices(self, devices: List[OlmDevice]) -> None: ...
+
+    def is_device_ignored(self, device: OlmDevice) -> bool: ...
+
+    def load_encrypted_rooms(self) -> Set[str]: ...
+
+    def save_encrypted_rooms(self, rooms: Iterable[str]) -> None: ...
+
+    def delete_encrypted_room(self, room: str) -> None: ...
+
+    def load_outgoing_key_requests(self) -> Dict[str, OutgoingKeyRequest]: ...
+
+    def add_outgoing_key_request(self, key_request: OutgoingKeyRequest) -> None: ...
+
+    def remove_outgoing_key_request(self, key_request: OutgoingKeyRequest) -> None: ...
+
+    def load_sync_token(self) -> Optional[str]: ...
+
+    def save_sync_token(self, token: str) -> None: ...
+
+    def prune(
+        self,
+        max_olm_sessions: int,
+        users: Iterable[str] = (),
+        compact: bool = True,
+    ) -> StoreMaintenanceResult: ...
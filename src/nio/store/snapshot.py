@@ -0,0 +1,918 @@
+"""A store that keeps the encryption state in memory and in a single file.
+
+The SnapshotStore holds its data in dictionaries, the pickles of the Olm
+objects are kept as the raw bytes they are written as. The file is used as an
+append-only journal of binary records, every change appends a record. Once
+the journal contains considerably more records than there are entries in the
+store it's compacted, the file is atomically replaced by a snapshot
+containing only the current entries.
+
+On startup the file is memory mapped and the records are replayed, nothing
+is unpickled until it's loaded from the store.
+
+A record consists of a header followed by the key, the metadata encoded as
+JSON and the pickle::
+
+    crc32 | operation | table | key length | metadata length | pickle length
+
+The CRC covers everything after it. A damaged record at the end of the file,
+e.g. from a write that was interrupted, ends the replay and the file is
+compacted. A damaged record that is followed by other records means that the
+file was corrupted, a copy of the file is kept next to it before the damaged
+record is skipped and the file is compacted.
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+import shutil
+import struct
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import (
+    Any,
+    ClassVar,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from atomicwrites import atomic_write
+
+from .. import json
+from ..crypto import (
+    DeviceStore,
+    GroupSessionStore,
+    InboundGroupSession,
+    LazyGroupSessionStore,
+    OlmAccount,
+    OlmDevice,
+    OutboundGroupSession,
+    OutgoingKeyRequest,
+    Session,
+    SessionStore,
+    TrustState,
+)
+from .database import StoreMaintenanceResult
+from .log import logger
+
+_CRC = struct.Struct("<I")
+_HEADER = struct.Struct("<BBIII")
+_RECORD_HEADER_SIZE = _CRC.size + _HEADER.size
+
+_PUT = 0
+_DELETE = 1
+
+# The tables of the store, the number is stored in the records.
+_ACCOUNT = 0
+_OLM_SESSIONS = 1
+_INBOUND_GROUP_SESSIONS = 2
+_OUTBOUND_GROUP_SESSIONS = 3
+_OUTBOUND_SESSION_DEVICES = 4
+_DEVICE_KEYS = 5
+_TRUST_STATES = 6
+_ENCRYPTED_ROOMS = 7
+_OUTGOING_KEY_REQUESTS = 8
+_SYNC_TOKEN = 9
+
+_TABLE_COUNT = 10
+
+# Separates the parts of composite keys, it can't be part of a Matrix id.
+_SEPARATOR = "\x00"
+
+
+def _encode_record(
+    operation: int, table: int, key: str, metadata: Any = None, pickle: bytes = b""
+) -> bytes:
+    key_data = key.encode()
+    metadata_data = json.dumps(metadata).encode() if operation == _PUT else b""
+
+    record = b"".join(
+        (
+            _HEADER.pack(
+                operation, table, len(key_data), len(metadata_data), len(pickle)
+            ),
+            key_data,
+            metadata_data,
+            pickle,
+        )
+    )
+
+    return _CRC.pack(zlib.crc32(record)) + record
+
+
+def _check_record(data: mmap.mmap, offset: int) -> Tuple[int, bool]:
+    """Check the record at the given offset.
+
+    Returns the end of the record, or the end of the data if the record is
+    cut off, and whether the record is intact.
+    """
+    end = offset + _RECORD_HEADER_SIZE
+
+    if end > len(data):
+        return len(data), False
+
+    operation, table, key_length, metadata_length, pickle_length = _HEADER.unpack_from(
+        data, offset + _CRC.size
+    )
+    end += key_length + metadata_length + pickle_length
+
+    if end > len(data):
+        return len(data), False
+
+    intact = (
+        operation in (_PUT, _DELETE)
+        and table < _TABLE_COUNT
+        and zlib.crc32(data[offset + _CRC.size : end])
+        == _CRC.unpack_from(data, offset)[0]
+    )
+
+    return end, intact
+
+
+def _find_record(data: mmap.mmap, offset: int, end: int) -> Optional[int]:
+    """Find the next intact record after the damaged record at offset.
+
+    The record at the end of the damaged one is tried first, the header of
+    the damaged record might be damaged as well so every following offset is
+    tried after that.
+
+    Returns the offset of the record or None if no intact record follows.
+    """
+    if end < len(data) and _check_record(data, end)[1]:
+        return end
+
+    for position in range(offset + 1, len(data) - _RECORD_HEADER_SIZE + 1):
+        if _check_record(data, position)[1]:
+            return position
+
+    return None
+
+
+@dataclass
+class SnapshotStore:
+    """Store that keeps the encryption state in memory and in a single file.
+
+    Implements the CryptoStore protocol without a database, see the module
+    documentation for the file format. Loading the store only reads the file,
+    Olm objects are unpickled when they are loaded from the store.
+
+    Every change is appended to the file and synced to disk, unless
+    write_behind is set, in which case the changes are appended at once when
+    flush() is called or write_behind_delay seconds passed since the oldest
+    pending change. Like for the MatrixStore, Megolm outbound sessions and
+    Olm sessions that were used to encrypt a message are never deferred and
+    the sync token is only written by flush().
+
+    Args:
+        user_id (str): The fully-qualified ID of the user that owns the store.
+        device_id (str): The device id of the user's device.
+        store_path (str): The path where the store should be stored.
+        pickle_key (str, optional): A passphrase that will be used to encrypt
+            encryption keys while they are in storage.
+        database_name (str, optional): The file-name of the snapshot file
+            that should be used.
+    """
+
+    compaction_threshold: ClassVar[int] = 1000
+
+    user_id: str = field()
+    device_id: str = field()
+    store_path: str = field()
+    pickle_key: str = ""
+    database_name: str = ""
+    database_path: str = field(init=False)
+    write_behind: bool = field(default=False, init=False)
+    write_behind_delay: float = field(default=5.0, init=False)
+    lazy_group_sessions: bool = field(default=False, init=False)
+    group_session_cache_size: int = field(default=1000, init=False)
+
+    _tables: List[Dict[str, Tuple[Any, bytes]]] = field(
+        default_factory=lambda: [{} for _ in range(_TABLE_COUNT)],
+        init=False,
+        repr=False,
+    )
+    # The keys of the device records of every outbound group session.
+    _outbound_session_devices: DefaultDict[str, Set[str]] = field(
+        default_factory=lambda: defaultdict(set), init=False, repr=False
+    )
+    _unsaved: List[bytes] = field(default_factory=list, init=False, repr=False)
+    # The sync token is held back until flush(), see the MatrixStore.
+    _unsaved_sync_token: Optional[bytes] = field(default=None, init=False, repr=False)
+    _saved_sync_token: Optional[Tuple[Any, bytes]] = field(
+        default=None, init=False, repr=False
+    )
+    _pending_since: Optional[float] = field(default=None, init=False, repr=False)
+    _journal_length: int = field(default=0, init=False, repr=False)
+    _needs_compaction: bool = field(default=False, init=False, repr=False)
+    _corrupted: bool = field(default=False, init=False, repr=False)
+
+    def __post_init__(self):
+        self.database_name = (
+            self.database_name or f"{self.user_id}_{self.device_id}.snapshot"
+        )
+        self.database_path = os.path.join(self.store_path, self.database_name)
+
+        self._load()
+        self._saved_sync_token = self._tables[_SYNC_TOKEN].get("")
+
+        if self._corrupted:
+            backup_path = f"{self.database_path}.{time.strftime('%Y%m%d%H%M%S')}"
+            shutil.copyfile(self.database_path, backup_path)
+            logger.error(
+                "Skipped damaged records in %s, kept a copy of it as %s",
+                self.database_path,
+                backup_path,
+            )
+
+        if self._needs_compaction:
+            self._compact()
+
+    def _load(self) -> None:
+        try:
+            with open(self.database_path, "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    self._replay(data)
+        except FileNotFoundError:
+            pass
+
+    def _replay(self, data: mmap.mmap) -> None:
+        offset = 0
+
+        while offset < len(data):
+            end, intact = _check_record(data, offset)
+
+            if not intact:
+                self._needs_compaction = True
+                next_offset = _find_record(data, offset, end)
+
+                if next_offset is None:
+                    logger.warning(
+                        "Ignoring a damaged record at the end of %s",
+                        self.database_path,
+                    )
+                    return
+
+                # Other records follow, this isn't an interrupted write.
+                self._corrupted = True
+                offset = next_offset
+                continue
+
+            operation, table, key_length, metadata_length, _ = _HEADER.unpack_from(
+                data, offset + _CRC.size
+            )
+            position = offset + _RECORD_HEADER_SIZE
+            key = data[position : position + key_length].decode()
+            position += key_length
+
+            if operation == _PUT:
+                metadata = json.loads(data[position : position + metadata_length])
+                pickle = data[position + metadata_length : end]
+                self._tables[table][key] = (metadata, pickle)
+
+                if table == _OUTBOUND_SESSION_DEVICES:
+                    session_id = key.split(_SEPARATOR, 1)[0]
+                    self._outbound_session_devices[session_id].add(key)
+            else:
+                self._tables[table].pop(key, None)
+
+                if table == _OUTBOUND_SESSION_DEVICES:
+                    session_id = key.split(_SEPARATOR, 1)[0]
+                    self._outbound_session_devices[session_id].discard(key)
+
+            self._journal_length += 1
+            offset = end
+
+    def _put(self, table: int, key: str, metadata: Any, pickle: bytes = b"") -> None:
+        self._tables[table][key] = (metadata, pickle)
+        record = _encode_record(_PUT, table, key, metadata, pickle)
+
+        if table == _SYNC_TOKEN:
+            self._unsaved_sync_token = record
+        else:
+            self._unsaved.append(record)
+
+    def _delete(self, table: int, key: str) -> bool:
+        if self._tables[table].pop(key, None) is None:
+            return False
+
+        self._unsaved.append(_encode_record(_DELETE, table, key))
+        return True
+
+    def _changed(self, write_through: bool = False) -> None:
+        if not self.write_behind:
+            self._save()
+            return
+
+        if write_through:
+            self._save(sync_token=False)
+            return
+
+        now = time.monotonic()
+
+        if self._pending_since is None:
+            self._pending_since = now
+        elif now - self._pending_since >= self.write_behind_delay:
+            # Like for the MatrixStore, the sync token waits for flush().
+            self._save(sync_token=False)
+
+    @property
+    def has_pending_writes(self) -> bool:
+        """Are there deferred writes that weren't flushed yet."""
+        return bool(self._unsaved or self._unsaved_sync_token)
+
+    def flush(self) -> None:
+        """Write all the deferred changes to the file."""
+        if self.has_pending_writes:
+            self._save()
+
+    def _save(self, sync_token: bool = True) -> None:
+        records = self._unsaved
+
+        if sync_token and self._unsaved_sync_token:
+            records = [*records, self._unsaved_sync_token]
+
+        entries = sum(len(table) for table in self._tables)
+
+        if self._needs_compaction or self._journal_length + len(records) > max(
+            self.compaction_threshold, 2 * entries
+        ):
+            self._compact(sync_token)
+            return
+
+        if records:
+            try:
+                with open(self.database_path, "ab") as f:
+                    f.write(b"".join(records))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                # Part of the records might have been written, records
+                # appended after them would be lost. The snapshot is written
+                # from scratch the next time instead.
+                self._needs_compaction = True
+                raise
+
+        self._journal_length += len(records)
+        self._saved(sync_token)
+
+    def _compact(self, sync_token: bool = True) -> None:
+        journal_length = 0
+
+        with atomic_write(self.database_path, mode="wb", overwrite=True) as f:
+            for table, entries in enumerate(self._tables):
+                if table == _SYNC_TOKEN and not sync_token:
+                    # Keep the sync token that was written last.
+                    saved = self._saved_sync_token
+                    entries = {"": saved} if saved else {}
+
+                for key, (metadata, pickle) in entries.items():
+                    f.write(_encode_record(_PUT, table, key, metadata, pickle))
+
+                journal_length += len(entries)
+
+        self._journal_length = journal_length
+        self._needs_compaction = False
+        self._saved(sync_token)
+
+    def _saved(self, sync_token: bool) -> None:
+        self._unsaved = []
+
+        if sync_token:
+            self._unsaved_sync_token = None
+            self._saved_sync_token = self._tables[_SYNC_TOKEN].get("")
+
+        self._pending_since = time.monotonic() if self._unsaved_sync_token else None
+
+    def load_account(self) -> Optional[OlmAccount]:
+        """Load the Olm account from the store.
+
+        Returns the OlmAccount or None if no account was saved.
+        """
+        entry = self._tables[_ACCOUNT].get("")
+
+        if not entry:
+            return None
+
+        metadata, pickle = entry
+        return OlmAccount.from_pickle(pickle, self.pickle_key, metadata["shared"])
+
+    def save_account(self, account: OlmAccount) -> None:
+        """Save the provided Olm account to the store."""
+        self._put(
+            _ACCOUNT, "", {"shared": account.shared}, account.pickle(self.pickle_key)
+        )
+        self._changed()
+
+    def load_sessions(self) -> SessionStore:
+        """Load all Olm sessions from the store.
+
+        Returns a SessionStore containing the sessions.
+        """
+        store = SessionStore()
+        sessions = sorted(
+            self._tables[_OLM_SESSIONS].values(),
+            key=lambda entry: entry[0]["use_time"],
+            reverse=True,
+        )
+
+        for metadata, pickle in sessions:
+            session = Session.from_pickle(
+                pickle,
+                datetime.fromtimestamp(metadata["creation_time"]),
+                self.pickle_key,
+                datetime.fromtimestamp(metadata["use_time"]),
+            )
+            store.add(metadata["sender_key"], session)
+
+        return store
+
+    def save_session(
+        self, curve_key: str, session: Session, sent: bool = False
+    ) -> None:
+        """Save the provided Olm session to the store.
+
+        Args:
+            curve_key (str): The curve key that owns the Olm session.
+            session (Session): The Olm session that will be saved.
+            sent (bool): The session was used to encrypt a message, see
+                save_sessions().
+        """
+        self.save_sessions([(curve_key, session)], sent)
+
+    def save_sessions(
+        self, sessions: List[Tuple[str, Session]], sent: bool = False
+    ) -> None:
+        """Save multiple Olm sessions to the store at once.
+
+        Args:
+            sessions (List[Tuple[str, Session]]): A list of (curve_key,
+                session) tuples.
+            sent (bool): The sessions were used to encrypt messages, they are
+                written out right away even if write_behind is set.
+        """
+        for curve_key, session in sessions:
+            metadata = {
+                "sender_key": curve_key,
+                "creation_time": session.creation_time.timestamp(),
+                "use_time": session.use_time.timestamp(),
+            }
+            self._put(
+                _OLM_SESSIONS, session.id, metadata, session.pickle(self.pickle_key)
+            )
+
+        self._changed(sent)
+
+    def _unpickle_inbound_group_session(
+        self, metadata: Dict[str, Any], pickle: bytes
+    ) -> InboundGroupSession:
+        return InboundGroupSession.from_pickle(
+            pickle,
+            metadata["ed25519"],
+            metadata["sender_key"],
+            metadata["room_id"],
+            self.pickle_key,
+            metadata["forwarding_chain"],
+        )
+
+    def load_inbound_group_sessions(self) -> GroupSessionStore:
+        """Load all Megolm inbound group sessions from the store.
+
+        If lazy_group_sessions is set the sessions aren't loaded, a
+        LazyGroupSessionStore that loads them on demand is returned instead.
+        """
+        if self.lazy_group_sessions:
+            return LazyGroupSessionStore(self, self.group_session_cache_size)
+
+        store = GroupSessionStore()
+
+        for session in self.iter_inbound_group_sessions():
+            store.add(session)
+
+        return store
+
+    def load_inbound_group_session(
+        self, room_id: str, sender_key: str, session_id: str
+    ) -> Optional[InboundGroupSession]:
+        """Load a single Megolm inbound group session from the store.
+
+        Returns the InboundGroupSession or None if no such session was found.
+        """
+        entry = self._tables[_INBOUND_GROUP_SESSIONS].get(session_id)
+
+        if not entry:
+            return None
+
+        metadata, pickle = entry
+
+        if metadata["room_id"] != room_id or metadata["sender_key"] != sender_key:
+            return None
+
+        return self._unpickle_inbound_group_session(metadata, pickle)
+
+    def iter_inbound_group_sessions(
+        self, room_id: Optional[str] = None
+    ) -> Iterator[InboundGroupSession]:
+        """Iterate over the Megolm inbound group sessions in the store.
+
+        Args:
+            room_id (str, optional): Only load the sessions of this room.
+        """
+        for metadata, pickle in list(self._tables[_INBOUND_GROUP_SESSIONS].values()):
+            if room_id and metadata["room_id"] != room_id:
+                continue
+
+            yield self._unpickle_inbound_group_session(metadata, pickle)
+
+    def save_inbound_group_session(self, session: InboundGroupSession) -> None:
+        """Save the provided Megolm inbound group session to the store."""
+        metadata = {
+            "sender_key": session.sender_key,
+            "ed25519": session.ed25519,
+            "room_id": session.room_id,
+            "forwarding_chain": session.forwarding_chain,
+        }
+        self._put(
+            _INBOUND_GROUP_SESSIONS,
+            session.id,
+            metadata,
+            session.pickle(self.pickle_key),
+        )
+        self._changed()
+
+    def load_outbound_group_sessions(self) -> Dict[str, OutboundGroupSession]:
+        """Load the Megolm outbound sessions of every room from the store.
+
+        Returns a dictionary mapping room ids to their session.
+        """
+        sessions = {}
+        devices = self._tables[_OUTBOUND_SESSION_DEVICES]
+
+        for room_id, (metadata, pickle) in self._tables[
+            _OUTBOUND_GROUP_SESSIONS
+        ].items():
+            shared_with = set()
+            ignored = set()
+
+            for key in self._outbound_session_devices.get(metadata["session_id"], ()):
+                user_id, device_id = key.split(_SEPARATOR)[1:]
+                target = ignored if devices[key][0] else shared_with
+                target.add((user_id, device_id))
+
+            sessions[room_id] = OutboundGroupSession.from_pickle(
+                pickle,
+                datetime.fromtimestamp(metadata["creation_time"]),
+                metadata["message_count"],
+                metadata["shared"],
+                shared_with,
+                ignored,
+                self.pickle_key,
+            )
+
+        return sessions
+
+    def save_outbound_group_session(
+        self, room_id: str, session: OutboundGroupSession
+    ) -> None:
+        """Save the Megolm outbound session of a room.
+
+        Replaces the previously saved session of the room. Only the devices
+        the session was shared with, or ignored, since the session was last
+        saved are written out. The session is written out right away even if
+        write_behind is set.
+        """
+        entry = self._tables[_OUTBOUND_GROUP_SESSIONS].get(room_id)
+
+        if entry and entry[0]["session_id"] != session.id:
+            self._delete_outbound_session_devices(entry[0]["session_id"])
+
+        metadata = {
+            "session_id": session.id,
+            "creation_time": session.creation_time.timestamp(),
+            "message_count": session.message_count,
+            "shared": session.shared,
+        }
+        self._put(
+            _OUTBOUND_GROUP_SESSIONS,
+            room_id,
+            metadata,
+            session.pickle(self.pickle_key),
+        )
+
+        saved = self._outbound_session_devices[session.id]
+        devices = [(False, device) for device in session.users_shared_with]
+        devices.extend((True, device) for device in session.users_ignored)
+
+        for ignored, (user_id, device_id) in devices:
+            key = _SEPARATOR.join((session.id, user_id, device_id))
+
+            if key not in saved:
+                self._put(_OUTBOUND_SESSION_DEVICES, key, ignored)
+                saved.add(key)
+
+        self._changed(write_through=True)
+
+    def _delete_outbound_session_devices(self, session_id: str) -> None:
+        for key in self._outbound_session_devices.pop(session_id, ()):
+            self._delete(_OUTBOUND_SESSION_DEVICES, key)
+
+    def remove_outbound_group_session(self, room_id: str) -> None:
+        """Remove the Megolm outbound session of a room from the store."""
+        entry = self._tables[_OUTBOUND_GROUP_SESSIONS].get(room_id)
+
+        if not entry:
+            return
+
+        self._delete(_OUTBOUND_GROUP_SESSIONS, room_id)
+        self._delete_outbound_session_devices(entry[0]["session_id"])
+        self._changed()
+
+    def load_device_keys(self) -> DeviceStore:
+        """Load all the device keys from the store.
+
+        Returns a DeviceStore containing the devices and their trust state.
+        """
+        store = DeviceStore()
+        trust_states = self._tables[_TRUST_STATES]
+
+        for key, (metadata, _) in self._tables[_DEVICE_KEYS].items():
+            user_id, device_id = key.split(_SEPARATOR)
+            trust_state = trust_states.get(key)
+
+            store.add(
+                OlmDevice(
+                    user_id,
+                    device_id,
+                    dict(metadata["keys"]),
+                    display_name=metadata["display_name"],
+                    deleted=metadata["deleted"],
+                    trust_state=(
+                        TrustState(trust_state[0]) if trust_state else TrustState.unset
+                    ),
+                )
+            )
+
+        return store
+
+    def save_device_keys(self, device_keys: Dict[str, Dict[str, OlmDevice]]) -> None:
+        """Save the provided device keys to the store.
+
+        Args:
+            device_keys (Dict[str, Dict[str, OlmDevice]]): A dictionary
+                containing a mapping from a user id to a dictionary containing
+                a mapping of a device id to a OlmDevice.
+        """
+        saved = self._tables[_DEVICE_KEYS]
+
+        for user_id, devices in device_keys.items():
+            for device_id, device in devices.items():
+                key = _SEPARATOR.join((user_id, device_id))
+                metadata = {
+                    "keys": device.keys,
+                    "display_name": device.display_name,
+                    "deleted": device.deleted,
+                }
+                entry = saved.get(key)
+
+                if not entry or entry[0] != metadata:
+                    self._put(_DEVICE_KEYS, key, metadata)
+
+        self._changed()
+
+    def _get_trust_state(self, device: OlmDevice) -> TrustState:
+        entry = self._tables[_TRUST_STATES].get(
+            _SEPARATOR.join((device.user_id, device.id))
+        )
+        return TrustState(entry[0]) if entry else TrustState.unset
+
+    def _set_trust_state(self, device: OlmDevice, trust_state: TrustState) -> None:
+        key = _SEPARATOR.join((device.user_id, device.id))
+
+        if trust_state == TrustState.unset:
+            self._delete(_TRUST_STATES, key)
+        else:
+            self._put(_TRUST_STATES, key, trust_state.value)
+
+        device.trust_state = trust_state
+
+    def _change_trust_state(
+        self, device: OlmDevice, old: TrustState, new: TrustState
+    ) -> bool:
+        if self._get_trust_state(device) != old:
+            return False
+
+        self._set_trust_state(device, new)
+        self._changed()
+
+        return True
+
+    def verify_device(self, device: OlmDevice) -> bool:
+        """Mark a device as verified.
+
+        Returns True if the device was verified, False if it already was.
+        """
+        if self.is_device_verified(device):
+            return False
+
+        self._set_trust_state(device, TrustState.verified)
+        self._changed()
+
+        return True
+
+    def unverify_device(self, device: OlmDevice) -> bool:
+        """Unmark a device as verified.
+
+        Returns True if the device was unverified, False if it wasn't
+        verified.
+        """
+        return self._change_trust_state(device, TrustState.verified, TrustState.unset)
+
+    def is_device_verified(self, device: OlmDevice) -> bool:
+        """Check if a device is verified."""
+        return self._get_trust_state(device) == TrustState.verified
+
+    def blacklist_device(self, device: OlmDevice) -> bool:
+        """Mark a device as blacklisted.
+
+        Returns True if the device was blacklisted, False if it already was.
+        """
+        if self.is_device_blacklisted(device):
+            return False
+
+        self._set_trust_state(device, TrustState.blacklisted)
+        self._changed()
+
+        return True
+
+    def unblacklist_device(self, device: OlmDevice) -> bool:
+        """Unmark a device as blacklisted.
+
+        Returns True if the device was unblacklisted, False if it wasn't
+        blacklisted.
+        """
+        return self._change_trust_state(
+            device, TrustState.blacklisted, TrustState.unset
+        )
+
+    def is_device_blacklisted(self, device: OlmDevice) -> bool:
+        """Check if a device is blacklisted."""
+        return self._get_trust_state(device) == TrustState.blacklisted
+
+    def ignore_device(self, device: OlmDevice) -> bool:
+        """Mark a device as ignored.
+
+        Returns True if the device was ignored, False if it already was.
+        """
+        if self.is_device_ignored(device):
+            return False
+
+        self._set_trust_state(device, TrustState.ignored)
+        self._changed()
+
+        return True
+
+    def unignore_device(self, device: OlmDevice) -> bool:
+        """Unmark a device as ignored.
+
+        Returns True if the device was unignored, False if it wasn't ignored.
+        """
+        return self._change_trust_state(device, TrustState.ignored, TrustState.unset)
+
+    def ignore_devices(self, devices: List[OlmDevice]) -> None:
+        """Mark a list of devices as ignored."""
+        for device in devices:
+            self._set_trust_state(device, TrustState.ignored)
+
+        self._changed()
+
+    def is_device_ignored(self, device: OlmDevice) -> bool:
+        """Check if a device is ignored."""
+        return self._get_trust_state(device) == TrustState.ignored
+
+    def load_encrypted_rooms(self) -> Set[str]:
+        """Load the set of encrypted rooms."""
+        return set(self._tables[_ENCRYPTED_ROOMS])
+
+    def save_encrypted_rooms(self, rooms: Iterable[str]) -> None:
+        """Add the given rooms to the set of encrypted rooms."""
+        saved = self._tables[_ENCRYPTED_ROOMS]
+
+        for room_id in rooms:
+            if room_id not in saved:
+                self._put(_ENCRYPTED_ROOMS, room_id, None)
+
+        self._changed()
+
+    def delete_encrypted_room(self, room: str) -> None:
+        """Remove a room from the set of encrypted rooms."""
+        if self._delete(_ENCRYPTED_ROOMS, room):
+            self._changed()
+
+    def load_outgoing_key_requests(self) -> Dict[str, OutgoingKeyRequest]:
+        """Load the outgoing key requests, keyed by their request id."""
+        return {
+            request_id: OutgoingKeyRequest(
+                request_id,
+                metadata["session_id"],
+                metadata["room_id"],
+                metadata["algorithm"],
+            )
+            for request_id, (metadata, _) in self._tables[
+                _OUTGOING_KEY_REQUESTS
+            ].items()
+        }
+
+    def add_outgoing_key_request(self, key_request: OutgoingKeyRequest) -> None:
+        """Add an outgoing key request to the store."""
+        if key_request.request_id in self._tables[_OUTGOING_KEY_REQUESTS]:
+            return
+
+        metadata = {
+            "session_id": key_request.session_id,
+            "room_id": key_request.room_id,
+            "algorithm": key_request.algorithm,
+        }
+        self._put(_OUTGOING_KEY_REQUESTS, key_request.request_id, metadata)
+        self._changed()
+
+    def remove_outgoing_key_request(self, key_request: OutgoingKeyRequest) -> None:
+        """Remove an active outgoing key request from the store."""
+        if self._delete(_OUTGOING_KEY_REQUESTS, key_request.request_id):
+            self._changed()
+
+    def load_sync_token(self) -> Optional[str]:
+        """Load the sync token, None if no token was saved."""
+        entry = self._tables[_SYNC_TOKEN].get("")
+        return entry[0] if entry else None
+
+    def save_sync_token(self, token: str) -> None:
+        """Save the given sync token."""
+        self._put(_SYNC_TOKEN, "", token)
+        self._changed()
+
+    def prune(
+        self,
+        max_olm_sessions: int,
+        users: Iterable[str] = (),
+        compact: bool = True,
+    ) -> StoreMaintenanceResult:
+        """Delete data that isn't needed anymore from the store.
+
+        Old Olm sessions and the device keys of the given users are deleted,
+        see MatrixStore.prune().
+
+        Args:
+            max_olm_sessions (int): The number of most recently used Olm
+                sessions that are kept for every device.
+            users (Iterable[str]): The users whose device keys should be
+                deleted.
+            compact (bool): Write a new snapshot of the store, dropping the
+                journal.
+
+        Returns a StoreMaintenanceResult describing what was removed.
+        """
+        result = StoreMaintenanceResult()
+        sessions: DefaultDict[str, List[Tuple[float, str]]] = defaultdict(list)
+
+        for session_id, (metadata, _) in self._tables[_OLM_SESSIONS].items():
+            sessions[metadata["sender_key"]].append((metadata["use_time"], session_id))
+
+        for device_sessions in sessions.values():
+            device_sessions.sort(reverse=True)
+
+            for _, session_id in device_sessions[max_olm_sessions:]:
+                self._delete(_OLM_SESSIONS, session_id)
+                result.olm_sessions += 1
+
+        users = set(users)
+
+        for key in list(self._tables[_DEVICE_KEYS]):
+            if key.split(_SEPARATOR, 1)[0] in users:
+                self._delete(_DEVICE_KEYS, key)
+                self._delete(_TRUST_STATES, key)
+                result.device_keys += 1
+
+        if compact:
+            try:
+                size = os.path.getsize(self.database_path)
+            except FileNotFoundError:
+                size = 0
+
+            self._compact(sync_token=False)
+            result.reclaimed_bytes = max(size - os.path.getsize(self.database_path), 0)
+        else:
+            self._changed()
+
+        return result
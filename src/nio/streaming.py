@@ -0,0 +1,194 @@
+"""Incremental parsing of sync response bodies.
+
+Sync responses can get very big, parsing them the usual way requires the
+whole body to be downloaded and then turned into a single big dictionary.
+
+The SyncStreamParser consumes the body in chunks as they arrive and hands out
+the dictionary of every room as soon as it's complete, the rest of the
+response is returned at the end without the rooms in it.
+"""
+
+import codecs
+import json
+import re
+from json.decoder import JSONDecodeError
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+_SKIP = object()
+
+RoomPart = Tuple[str, str, Any]
+
+
+class SyncStreamParser:
+    """Incremental parser for the body of a sync response.
+
+    Example:
+        >>> parser = SyncStreamParser()
+        >>> for chunk in chunks:
+        ...     for section, room_id, room_dict in parser.feed(chunk):
+        ...         handle_room(section, room_id, room_dict)
+        >>> for section, room_id, room_dict in parser.close():
+        ...     handle_room(section, room_id, room_dict)
+        >>> rest = parser.result
+
+    The values of the rooms are parsed with the standard library JSON decoder
+    once they are complete, since a value can't be known to be complete before
+    it's parsed the decoding is retried each time the amount of buffered data
+    doubles.
+
+    Raises a JSONDecodeError if the body isn't valid JSON.
+    """
+
+    SECTIONS = ("join", "invite", "leave")
+
+    def __init__(self) -> None:
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._rooms: List[RoomPart] = []
+        self._parser = self._parse()
+
+        self.result: Optional[Dict[str, Any]] = None
+
+    def feed(self, data: bytes) -> List[RoomPart]:
+        """Feed a chunk of the body to the parser.
+
+        Returns a list of (section, room_id, room_dict) tuples for the rooms
+        that were completed by this chunk.
+        """
+        self._buffer += self._text_decoder.decode(data)
+        return self._run()
+
+    def close(self) -> List[RoomPart]:
+        """Signal the end of the body.
+
+        Returns the remaining completed rooms, the rest of the response is
+        available in the result attribute afterwards.
+        """
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        self._eof = True
+        rooms = self._run()
+
+        if self.result is None:
+            raise JSONDecodeError("Unexpected end of data", self._buffer, self._pos)
+
+        return rooms
+
+    def _run(self) -> List[RoomPart]:
+        if self.result is None:
+            try:
+                next(self._parser)
+            except StopIteration:
+                pass
+
+        rooms, self._rooms = self._rooms, []
+        return rooms
+
+    def _more(self) -> Generator[None, None, None]:
+        if self._eof:
+            raise JSONDecodeError("Unexpected end of data", self._buffer, self._pos)
+
+        # Everything before the current position is consumed, drop it.
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+
+        yield
+
+    def _next_char(self) -> Generator[None, None, str]:
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            yield from self._more()
+
+    def _expect(self, chars: str) -> Generator[None, None, str]:
+        char = yield from self._next_char()
+
+        if char not in chars:
+            raise JSONDecodeError(
+                f"Expecting one of {chars!r}", self._buffer, self._pos
+            )
+
+        self._pos += 1
+        return char
+
+    def _value(self) -> Generator[None, None, Any]:
+        yield from self._next_char()
+        attempted = 0
+
+        while True:
+            available = len(self._buffer) - self._pos
+
+            if self._eof or available >= 2 * attempted:
+                try:
+                    value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                except JSONDecodeError:
+                    if self._eof:
+                        raise
+                else:
+                    # Numbers at the end of the buffer might continue in the
+                    # next chunk.
+                    if end < len(self._buffer) or self._eof:
+                        self._pos = end
+                        return value
+
+                attempted = available
+
+            yield from self._more()
+
+    def _object(
+        self, parse_value: Callable[[str], Generator[None, None, Any]]
+    ) -> Generator[None, None, Dict[str, Any]]:
+        obj: Dict[str, Any] = {}
+
+        yield from self._expect("{")
+
+        if (yield from self._next_char()) == "}":
+            self._pos += 1
+            return obj
+
+        while True:
+            key = yield from self._value()
+
+            if not isinstance(key, str):
+                raise JSONDecodeError(
+                    "Expecting property name enclosed in double quotes",
+                    self._buffer,
+                    self._pos,
+                )
+
+            yield from self._expect(":")
+            value = yield from parse_value(key)
+
+            if value is not _SKIP:
+                obj[key] = value
+
+            if (yield from self._expect(",}")) == "}":
+                return obj
+
+    def _parse(self) -> Generator[None, None, None]:
+        self.result = yield from self._object(self._parse_top_level)
+
+    def _parse_top_level(self, key: str) -> Generator[None, None, Any]:
+        if key == "rooms" and (yield from self._next_char()) == "{":
+            return (yield from self._object(self._parse_section))
+
+        return (yield from self._value())
+
+    def _parse_section(self, section: str) -> Generator[None, None, Any]:
+        if section in self.SECTIONS and (yield from self._next_char()) == "{":
+
+            def parse_room(room_id):
+                room = yield from self._value()
+                self._rooms.append((section, room_id, room))
+                return _SKIP
+
+            return (yield from self._object(parse_room))
+
+        return (yield from self._value())
@@ -3,6 +3,7 @@ import json
 import math
 import re
 import sys
+import threading
 import time
 from datetime import datetime, timedelta
 from os import path
@@ -48,7 +49,10 @@ from nio import (
     JoinedRoomsResponse,
     JoinResponse,
     KeysClaimResponse,
+    KeysQueryError,
+    KeysQueryResponse,
     KeysUploadResponse,
+    LazyEventList,
     LocalProtocolError,
     LoginError,
     LoginInfoResponse,
@@ -114,13 +118,17 @@ from nio import (
     RoomUnbanResponse,
     SetPushRuleActionsResponse,
     SetPushRuleResponse,
+    ShareGroupSessionError,
     ShareGroupSessionResponse,
     SpaceGetHierarchyError,
     SpaceGetHierarchyResponse,
+    SyncError,
     SyncResponse,
     ThumbnailError,
     ThumbnailResponse,
     Timeline,
+    ToDeviceError,
+    ToDeviceMessage,
     TransferCancelledError,
     TransferMonitor,
     UpdateDeviceResponse,
@@ -133,6 +141,7 @@ from nio.api import (
     MATRIX_API_PATH_V3,
     MATRIX_LEGACY_MEDIA_API_PATH,
     MATRIX_MEDIA_API_PATH,
+    Api,
     EventFormat,
     RelationshipType,
     ResizingMethod,
@@ -141,8 +150,15 @@ from nio.api import (
     ThreadInclusion,
 )
 from nio.client.async_client import connect_wrapper, on_request_chunk_sent
-from nio.crypto import OlmDevice, Session, decrypt_attachment
+from nio.crypto import (
+    OlmAccount,
+    OlmDevice,
+    OutboundSession,
+    Session,
+    decrypt_attachment,
+)
 from nio.responses import PublicRoom, PublicRoomsResponse
+from nio.store import AsyncMatrixStore, SnapshotStore, StoreProfile, ThreadedStore
 
 BASE_URL_V1 = f"https://example.org{MATRIX_API_PATH_V1}"
 BASE_URL_V3 = f"https://example.org{MATRIX_API_PATH_V3}"
@@ -887,6 +903,113 @@ class TestClass:
         assert user.presence == "online"
         assert user.status_msg == "I am here."
 
+    async def test_sync_lazy(self, async_client, aioresponse):
+        async_client.config = AsyncClientConfig(lazy_sync_parsing=True)
+
+        aioresponse.get(
+            f"{BASE_URL_V3}/sync",
+            status=200,
+            payload=self.sync_response,
+        )
+
+        resp = await async_client.sync()
+        assert isinstance(resp, SyncResponse)
+
+        room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+        room_info = resp.rooms.join[room_id]
+        assert isinstance(room_info.state, LazyEventList)
+        assert isinstance(room_info.timeline.events, LazyEventList)
+
+        room = async_client.rooms[room_id]
+        assert room.topic
+        assert room.canonical_alias
+        assert "@example:localhost" in room.users
+
+        # The m.room.aliases event isn't used by the room, so it's not parsed.
+        assert room_info.state.parsed_count == len(room_info.state) - 1
+        assert room.users["@example:localhost"].presence == "online"
+
+    async def test_sync_streaming(self, async_client, aioresponse):
+        async_client.config = AsyncClientConfig(
+            streaming_sync_parsing=True, io_chunk_size=128
+        )
+
+        aioresponse.get(
+            f"{BASE_URL_V3}/sync",
+            status=200,
+            payload=self.sync_response,
+        )
+
+        resp = await async_client.sync()
+        assert isinstance(resp, SyncResponse)
+        assert resp.next_batch == self.sync_response["next_batch"]
+
+        room = async_client.rooms["!SVkFJHzfwvuaIEawgC:localhost"]
+        assert room.topic
+        assert room.users["@example:localhost"].presence == "online"
+
+        aioresponse.get(
+            re.compile(rf"^{BASE_URL_V3}/sync\?since=[\w\d_]*"), status=200, body="{"
+        )
+
+        resp = await async_client.sync()
+        assert isinstance(resp, SyncError)
+
+    @pytest.mark.parametrize("workers", [None, 0, 2])
+    async def test_sync_megolm_decryption(self, async_client_pair, workers):
+        alice, _ = async_client_pair
+        alice.config = AsyncClientConfig(
+            megolm_decryption_workers=workers, megolm_decryption_batch_size=2
+        )
+
+        alice.olm.create_outbound_group_session(TEST_ROOM_ID)
+        alice.olm.outbound_group_sessions[TEST_ROOM_ID].shared = True
+
+        events = []
+
+        for i in range(5):
+            message = {
+                "type": "m.room.message",
+                "content": {"msgtype": "m.text", "body": f"message {i}"},
+            }
+            events.append(
+                {
+                    "event_id": f"$event_{i}",
+                    "type": "m.room.encrypted",
+                    "sender": alice.user_id,
+                    "origin_server_ts": int(time.time()),
+                    "content": alice.olm.group_encrypt(TEST_ROOM_ID, message),
+                }
+            )
+
+        # An event of an unknown session stays encrypted.
+        events[2]["content"]["session_id"] = "unknown"
+
+        received = []
+
+        def event_cb(room, event):
+            received.append(event)
+
+        alice.add_event_callback(event_cb, (RoomMessageText, MegolmEvent))
+
+        sync = self.sync_with_room_event(events[0], "1")
+        sync["rooms"]["join"][TEST_ROOM_ID]["timeline"]["events"] = events
+        response = SyncResponse.from_dict(sync)
+
+        await alice.receive_response(response)
+
+        timeline = response.rooms.join[TEST_ROOM_ID].timeline.events
+
+        assert timeline == received
+        assert isinstance(timeline[2], MegolmEvent)
+        assert [event.body for event in timeline if event is not timeline[2]] == [
+            "message 0",
+            "message 1",
+            "message 3",
+            "message 4",
+        ]
+        assert all(event.verified for event in timeline if event is not timeline[2])
+
     async def test_sync_notification_counts(self, async_client, aioresponse):
         aioresponse.get(
             f"{BASE_URL_V3}/sync",
@@ -1039,6 +1162,168 @@ class TestClass:
         await unauthed_async_client.keys_query()
         assert not unauthed_async_client.should_query_keys
 
+    async def test_store_thread(self, tempdir):
+        client = AsyncClient(
+            "https://example.org",
+            "ephemeral",
+            "DEVICEID",
+            tempdir,
+            config=AsyncClientConfig(
+                max_timeouts=3, store_sync_tokens=True, store_thread=True
+            ),
+        )
+        await client.receive_response(LoginResponse.from_dict(self.login_response))
+
+        assert isinstance(client.async_store, AsyncMatrixStore)
+        assert isinstance(client.store, ThreadedStore)
+        assert client.olm.store is client.store
+
+        await client.receive_response(self.encryption_sync_response)
+
+        assert await client.async_store.load_sync_token() == client.next_batch
+        assert await client.async_store.load_encrypted_rooms() == {TEST_ROOM_ID}
+
+        async_store = client.async_store
+        await client.close()
+
+        assert client.async_store is None
+        assert not async_store._thread.is_alive()
+
+    async def test_store_maintenance_thread(self, tempdir):
+        client = AsyncClient(
+            "https://example.org",
+            "ephemeral",
+            "DEVICEID",
+            tempdir,
+            config=AsyncClientConfig(
+                max_timeouts=3, store_thread=True, store_max_olm_sessions=1
+            ),
+        )
+        await client.receive_response(LoginResponse.from_dict(self.login_response))
+
+        other = OlmAccount()
+        other.generate_one_time_keys(2)
+        curve_key = other.identity_keys["curve25519"]
+
+        for one_time_key in other.one_time_keys["curve25519"].values():
+            session = OutboundSession(client.olm.account, curve_key, one_time_key)
+            client.olm.session_store.add(curve_key, session)
+            client.store.save_session(curve_key, session)
+
+        threads = []
+        prune = client.async_store.store.prune
+
+        def recording_prune(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return prune(*args, **kwargs)
+
+        client.async_store.store.prune = recording_prune
+
+        task = client.prune_store_in_background()
+
+        assert task
+        assert not client.prune_store_in_background()
+
+        await task
+
+        # The store was pruned on the database thread.
+        assert threads == ["nio-store"]
+        assert len(client.olm.session_store[curve_key]) == 1
+        assert len((await client.async_store.load_sessions())[curve_key]) == 1
+
+        await client.close()
+
+    async def test_snapshot_store(self, tempdir):
+        client = AsyncClient(
+            "https://example.org",
+            "ephemeral",
+            "DEVICEID",
+            tempdir,
+            config=AsyncClientConfig(
+                store=SnapshotStore,
+                store_sync_tokens=True,
+                store_thread=True,
+                store_profile=StoreProfile.high_throughput(),
+            ),
+        )
+        await client.receive_response(LoginResponse.from_dict(self.login_response))
+
+        # Only the SQLite stores are moved to a database thread and have a
+        # profile.
+        assert isinstance(client.store, SnapshotStore)
+        assert not client.async_store
+
+        await client.receive_response(self.encryption_sync_response)
+        await client.close()
+
+        store = SnapshotStore(
+            client.user_id, client.device_id, tempdir, client.config.pickle_key
+        )
+
+        assert store.load_sync_token() == client.next_batch
+        assert store.load_encrypted_rooms() == {TEST_ROOM_ID}
+        assert store.load_account().identity_keys == client.olm.account.identity_keys
+
+    async def test_keys_query_chunking(self, async_client, aioresponse):
+        async_client.config = AsyncClientConfig(
+            max_timeouts=3, max_key_query_users=2, max_key_query_requests=2
+        )
+        async_client.next_batch = "s72595_4483_1934"
+
+        users = {f"@user{i}:example.org" for i in range(5)}
+        async_client.olm.users_for_key_query.update(users)
+
+        requests = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def keys_query_cb(url, data, **kwargs):
+            nonlocal in_flight, max_in_flight
+            body = json.loads(data)
+            queried = set(body["device_keys"])
+            requests.append((body["token"], queried))
+
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+
+            if "@user0:example.org" in queried and len(requests) <= 3:
+                return CallbackResult(
+                    status=500, payload={"errcode": "M_UNKNOWN", "error": "Oops"}
+                )
+
+            return CallbackResult(
+                status=200, payload={"device_keys": {user: {} for user in queried}}
+            )
+
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/query", callback=keys_query_cb, repeat=True
+        )
+
+        response = await async_client.keys_query()
+
+        assert isinstance(response, KeysQueryError)
+        assert len(requests) == 3
+        assert max_in_flight == 2
+        assert all(token == "s72595_4483_1934" for token, _ in requests)
+        assert set().union(*(queried for _, queried in requests)) == users
+
+        # Only the users of the failed chunk need to be queried again.
+        failed = next(
+            queried for _, queried in requests if "@user0:example.org" in queried
+        )
+        assert async_client.users_for_key_query == failed
+        assert users - failed <= async_client.olm.tracked_users
+
+        response = await async_client.keys_query()
+
+        assert isinstance(response, KeysQueryResponse)
+        assert requests[-1][1] == failed
+        assert set(response.device_keys) == failed
+        assert not async_client.should_query_keys
+        assert users <= async_client.olm.tracked_users
+
     async def test_message_sending(self, async_client, aioresponse):
         aioresponse.post(
             f"{BASE_URL_V3}/login",
@@ -1388,7 +1673,184 @@ class TestClass:
         assert not async_client.get_missing_sessions(TEST_ROOM_ID)
         assert async_client.olm.session_store.get(alice_device.curve25519)
 
-    async def test_session_sharing(self, alice_client, async_client, aioresponse):
+    @staticmethod
+    def _new_alice_device(client, device_id):
+        """Add a new device of Alice to the client.
+
+        Returns a signed one-time key of the device, as it would be claimed.
+        """
+        account = OlmAccount()
+        account.generate_one_time_keys(1)
+        key = {"key": next(iter(account.one_time_keys["curve25519"].values()))}
+        key["signatures"] = {
+            ALICE_ID: {f"ed25519:{device_id}": account.sign(Api.to_canonical_json(key))}
+        }
+        client.device_store.add(OlmDevice(ALICE_ID, device_id, account.identity_keys))
+
+        return {"signed_curve25519:AAAAAQ": key}
+
+    async def test_key_claiming_chunks(self, async_client, aioresponse):
+        async_client.config = AsyncClientConfig(
+            max_timeouts=3, max_key_claim_devices=2, max_key_claim_requests=2
+        )
+        await async_client.receive_response(self.encryption_sync_response)
+
+        one_time_keys = {
+            f"DEVICE{i}": self._new_alice_device(async_client, f"DEVICE{i}")
+            for i in range(5)
+        }
+
+        requests = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def keys_claim_cb(url, data, **kwargs):
+            nonlocal in_flight, max_in_flight
+            claimed = json.loads(data)["one_time_keys"][ALICE_ID]
+            missing = async_client.get_missing_sessions(TEST_ROOM_ID)
+            requests.append((claimed, len(missing.get(ALICE_ID, []))))
+
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+
+            return CallbackResult(
+                status=200,
+                payload={
+                    "one_time_keys": {
+                        ALICE_ID: {device: one_time_keys[device] for device in claimed}
+                    }
+                },
+            )
+
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim", callback=keys_claim_cb, repeat=True
+        )
+
+        missing = async_client.get_missing_sessions(TEST_ROOM_ID)
+        response = await async_client.keys_claim(missing)
+
+        assert isinstance(response, KeysClaimResponse)
+        assert [len(claimed) for claimed, _ in requests] == [2, 2, 1]
+        assert max_in_flight == 2
+        # The sessions of a chunk are created as soon as it returns.
+        assert requests[-1][1] < 5
+        assert set(response.one_time_keys[ALICE_ID]) == set(one_time_keys)
+        assert not async_client.get_missing_sessions(TEST_ROOM_ID)
+
+    async def test_one_time_key_preclaiming_error(self, async_client, aioresponse):
+        await async_client.receive_response(self.encryption_sync_response)
+        one_time_key = self._new_alice_device(async_client, "DEVICE0")
+
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim",
+            status=400,
+            payload={"errcode": "M_UNKNOWN", "error": "Unknown error"},
+        )
+
+        await async_client.preclaim_one_time_keys()
+
+        # The failed claim is retried.
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim",
+            status=200,
+            payload={
+                "one_time_keys": {ALICE_ID: {"DEVICE0": one_time_key}},
+                "failures": {},
+            },
+        )
+
+        task = async_client.preclaim_one_time_keys()
+        assert task
+        await task
+
+        assert not async_client.get_missing_sessions(TEST_ROOM_ID)
+        assert not async_client.preclaim_one_time_keys()
+
+    async def test_one_time_key_preclaiming(self, async_client, aioresponse):
+        await async_client.receive_response(self.encryption_sync_response)
+        async_client.olm.create_outbound_group_session(TEST_ROOM_ID)
+
+        one_time_keys = {
+            f"DEVICE{i}": self._new_alice_device(async_client, f"DEVICE{i}")
+            for i in range(3)
+        }
+
+        # Only the first claim succeeds, failed devices aren't claimed again
+        # in the background.
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim",
+            status=200,
+            payload={
+                "one_time_keys": {
+                    ALICE_ID: {"DEVICE0": one_time_keys["DEVICE0"]},
+                },
+                "failures": {},
+            },
+        )
+
+        task = async_client.preclaim_one_time_keys()
+        assert task
+        assert not async_client.preclaim_one_time_keys()
+        await task
+
+        assert async_client.get_missing_sessions(TEST_ROOM_ID) == {
+            ALICE_ID: ["DEVICE1", "DEVICE2"]
+        }
+        assert not async_client.preclaim_one_time_keys()
+
+        self._new_alice_device(async_client, "DEVICE3")
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim",
+            status=200,
+            payload={"one_time_keys": {}, "failures": {}},
+        )
+
+        task = async_client.preclaim_one_time_keys()
+        assert task
+
+        # Sharing the group session waits for the background claim before
+        # claiming the keys of the remaining devices itself.
+        aioresponse.post(
+            f"{BASE_URL_V3}/keys/claim",
+            status=200,
+            payload={
+                "one_time_keys": {
+                    ALICE_ID: {
+                        device: one_time_keys[device]
+                        for device in ("DEVICE1", "DEVICE2")
+                    },
+                },
+                "failures": {},
+            },
+        )
+        aioresponse.put(
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/sendToDevice/m\.room\.encrypted/[0-9a-f-]*"
+            ),
+            status=200,
+            payload={},
+            repeat=True,
+        )
+
+        response = await async_client.share_group_session(
+            TEST_ROOM_ID, ignore_unverified_devices=True
+        )
+
+        assert task.done()
+        assert isinstance(response, ShareGroupSessionResponse)
+        assert async_client.get_missing_sessions(TEST_ROOM_ID) == {
+            ALICE_ID: ["DEVICE3"]
+        }
+
+    @pytest.mark.parametrize("workers", [None, 0, 2])
+    async def test_session_sharing(
+        self, alice_client, async_client, aioresponse, workers
+    ):
+        async_client.config = AsyncClientConfig(
+            max_timeouts=3, olm_encryption_workers=workers
+        )
         await async_client.receive_response(self.encryption_sync_response)
 
         alice_client.load_store()
@@ -1423,7 +1885,9 @@ class TestClass:
         )
 
         aioresponse.put(
-            f"{BASE_URL_V3}/sendToDevice/m.room.encrypted/1",
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/sendToDevice/m\.room\.encrypted/[0-9a-f-]*"
+            ),
             status=200,
             payload={},
         )
@@ -1440,6 +1904,209 @@ class TestClass:
         assert not async_client.get_missing_sessions(TEST_ROOM_ID)
         assert async_client.olm.session_store.get(alice_device.curve25519)
 
+    @staticmethod
+    def _add_alice_devices(client, alice_client, count):
+        """Add devices of Alice that the client has an Olm session with.
+
+        All the sessions are copies of a single session with Alice's account.
+        """
+        alice_client.load_store()
+        alice_keys = alice_client.olm.account.identity_keys
+        one_time_key = next(
+            iter(alice_client.olm.share_keys()["one_time_keys"].values())
+        )["key"]
+        pickle = OutboundSession(
+            client.olm.account, alice_keys["curve25519"], one_time_key
+        ).pickle()
+
+        for i in range(count):
+            curve_key = f"curve25519_{i}"
+            client.device_store.add(
+                OlmDevice(
+                    ALICE_ID,
+                    f"DEVICE{i}",
+                    {"ed25519": alice_keys["ed25519"], "curve25519": curve_key},
+                )
+            )
+            client.olm.session_store.add(
+                curve_key, Session.from_pickle(pickle, datetime.now())
+            )
+
+    async def test_session_sharing_fan_out(
+        self, alice_client, async_client, aioresponse
+    ):
+        async_client.config = AsyncClientConfig(
+            max_timeouts=3, max_to_device_requests=2
+        )
+        await async_client.receive_response(self.encryption_sync_response)
+
+        # 45 devices that are shared with in three chunks.
+        self._add_alice_devices(async_client, alice_client, 45)
+
+        loop = asyncio.get_running_loop()
+        backoff = async_client._to_device_backoff
+        requests = []
+        in_flight = 0
+        max_in_flight = 0
+        fail = True
+
+        async def to_device_cb(url, data, **kwargs):
+            nonlocal in_flight, max_in_flight, fail
+
+            devices = set(json.loads(data)["messages"][ALICE_ID])
+            first = not requests
+            requests.append((loop.time(), devices))
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+            if first:
+                return CallbackResult(
+                    status=429,
+                    payload={
+                        "errcode": "M_LIMIT_EXCEEDED",
+                        "error": "Too many requests",
+                        "retry_after_ms": 50,
+                    },
+                )
+
+            if fail and "DEVICE44" in devices:
+                fail = False
+                return CallbackResult(
+                    status=500, payload={"errcode": "M_UNKNOWN", "error": "Oops"}
+                )
+
+            return CallbackResult(status=200, payload={})
+
+        aioresponse.put(
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/sendToDevice/m\.room\.encrypted/[0-9a-f-]*"
+            ),
+            callback=to_device_cb,
+            repeat=True,
+        )
+
+        progress = []
+        response = await async_client.share_group_session(
+            TEST_ROOM_ID, True, progress_callback=progress.append
+        )
+
+        # One chunk got rate limited and was retried once the shared backoff
+        # was over, no other chunk was sent in the meantime.
+        assert len(requests) == 4
+        assert max_in_flight == 2
+        limited_at = requests[0][0]
+        assert all(
+            start >= backoff.resume_at
+            for start, _ in requests
+            if start > limited_at + 0.01
+        )
+
+        failed = next(devices for _, devices in requests if "DEVICE44" in devices)
+        assert isinstance(response, ShareGroupSessionError)
+        assert response.users_shared_with == {(ALICE_ID, d) for d in failed}
+
+        assert len(progress) == 3
+        assert sum(isinstance(r, ShareGroupSessionError) for r in progress) == 1
+
+        session = async_client.olm.outbound_group_sessions[TEST_ROOM_ID]
+        assert not session.shared
+        assert len(session.users_shared_with) == 45 - len(failed)
+
+        # Resuming only shares the session with the devices of the failed chunk.
+        response = await async_client.share_group_session(TEST_ROOM_ID, True)
+
+        assert isinstance(response, ShareGroupSessionResponse)
+        assert response.users_shared_with == {(ALICE_ID, d) for d in failed}
+        assert requests[-1][1] == failed
+        assert async_client.olm.outbound_group_sessions[TEST_ROOM_ID] is session
+        assert session.shared
+
+    async def test_group_session_presharing(
+        self, alice_client, async_client, aioresponse
+    ):
+        async_client.config = AsyncClientConfig(
+            max_timeouts=3, group_session_presharing=True
+        )
+        await async_client.receive_response(self.encryption_sync_response)
+        self._add_alice_devices(async_client, alice_client, 3)
+
+        to_device_requests = 0
+
+        def to_device_cb(url, **kwargs):
+            nonlocal to_device_requests
+            to_device_requests += 1
+            return CallbackResult(status=200, payload={})
+
+        aioresponse.put(
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/sendToDevice/m\.room\.encrypted/[0-9a-f-]*"
+            ),
+            callback=to_device_cb,
+            repeat=True,
+        )
+        aioresponse.get(
+            f"{BASE_URL_V3}/rooms/{TEST_ROOM_ID}/joined_members",
+            status=200,
+            payload=self.joined_members_response,
+        )
+        aioresponse.put(
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/rooms/{TEST_ROOM_ID}/send/m\.room\.encrypted/[0-9a-f-]*"
+            ),
+            status=200,
+            payload={"event_id": "$1555:example.org"},
+            repeat=True,
+        )
+
+        # Rooms nothing was sent to are left alone.
+        assert not async_client.preshare_group_sessions()
+
+        async_client._room_activity[TEST_ROOM_ID] = (time.monotonic(), True)
+        await asyncio.gather(*async_client.preshare_group_sessions())
+
+        room = async_client.rooms[TEST_ROOM_ID]
+        session = async_client.olm.outbound_group_sessions[TEST_ROOM_ID]
+        assert room.members_synced
+        assert session.shared
+        assert to_device_requests == 1
+
+        # The session was shared ahead of time, sending only encrypts.
+        response = await async_client.room_send(
+            TEST_ROOM_ID,
+            "m.room.message",
+            {"body": "hello", "msgtype": "m.text"},
+            ignore_unverified_devices=True,
+        )
+        assert isinstance(response, RoomSendResponse)
+        assert to_device_requests == 1
+        assert not async_client.preshare_group_sessions()
+
+        # A member change invalidates the session, a new one is shared.
+        async_client.invalidate_outbound_session(TEST_ROOM_ID)
+        await asyncio.gather(*async_client.preshare_group_sessions())
+
+        assert async_client.olm.outbound_group_sessions[TEST_ROOM_ID] is not session
+        session = async_client.olm.outbound_group_sessions[TEST_ROOM_ID]
+        assert session.shared
+        assert to_device_requests == 2
+
+        # Sessions that are about to expire are rotated in advance.
+        session.message_count = session.max_messages - 5
+        assert not async_client.olm.should_share_group_session(TEST_ROOM_ID)
+        await asyncio.gather(*async_client.preshare_group_sessions())
+
+        assert async_client.olm.outbound_group_sessions[TEST_ROOM_ID] is not session
+        assert async_client.olm.outbound_group_sessions[TEST_ROOM_ID].shared
+        assert to_device_requests == 3
+
+        # Rooms that have been idle for too long are forgotten.
+        async_client.invalidate_outbound_session(TEST_ROOM_ID)
+        async_client._room_activity[TEST_ROOM_ID] = (time.monotonic() - 3601, True)
+        assert not async_client.preshare_group_sessions()
+        assert TEST_ROOM_ID not in async_client._room_activity
+
     async def test_session_sharing_2(self, alice_client, async_client, aioresponse):
         await async_client.receive_response(self.encryption_sync_response)
 
@@ -1462,6 +2129,64 @@ class TestClass:
             in async_client.outgoing_key_requests
         )
 
+    async def test_to_device_message_batching(self, async_client, aioresponse):
+        messages = [
+            ToDeviceMessage("m.test", f"@user{i}:example.org", "DEVICE", {"i": i})
+            for i in range(25)
+        ]
+        # A second message for the same device needs its own request.
+        messages.append(
+            ToDeviceMessage("m.test", "@user24:example.org", "DEVICE", {"i": 25})
+        )
+        messages.extend(
+            ToDeviceMessage("m.other", ALICE_ID, device_id, {})
+            for device_id in ("DEVICE1", "DEVICE2")
+        )
+        async_client.olm.outgoing_to_device_messages.extend(messages)
+
+        requests = []
+
+        def to_device_cb(url, data, **kwargs):
+            event_type = url.path.split("/")[-2]
+            body = json.loads(data)["messages"]
+            requests.append((event_type, sum(len(d) for d in body.values())))
+
+            if event_type == "m.other":
+                return CallbackResult(
+                    status=500, payload={"errcode": "M_UNKNOWN", "error": "Oops"}
+                )
+
+            return CallbackResult(status=200, payload={})
+
+        aioresponse.put(
+            re.compile(
+                rf"https://example\.org{MATRIX_API_PATH_V3}/sendToDevice/m\.[a-z]+/[0-9a-f-]*"
+            ),
+            callback=to_device_cb,
+            repeat=True,
+        )
+
+        responses = await async_client.send_to_device_messages()
+
+        assert sorted(requests) == [
+            ("m.other", 2),
+            ("m.test", 1),
+            ("m.test", 5),
+            ("m.test", 20),
+        ]
+        assert len(responses) == len(messages)
+        assert {r.to_device_message.content.get("i") for r in responses} == {
+            *range(26),
+            None,
+        }
+
+        errors = [r for r in responses if isinstance(r, ToDeviceError)]
+        assert len(errors) == 2
+        assert all(error.status_code == "M_UNKNOWN" for error in errors)
+
+        # Only the messages that couldn't be sent are still queued.
+        assert async_client.outgoing_to_device_messages == messages[-2:]
+
     async def test_get_openid_token(self, async_client, aioresponse):
         aioresponse.post(
             f"{BASE_URL_V3}/user/{ALICE_ID}/openid/request_token",
@@ -52,6 +52,7 @@ from nio import (
     TransportType,
     TypingNoticeEvent,
 )
+from nio.crypto import LazyGroupSessionStore, OutboundGroupSession
 from nio.event_builders import ToDeviceMessage
 
 HOST = "example.org"
@@ -724,6 +725,77 @@ class TestClass:
 
         assert session.shared
 
+    def test_outbound_group_session_restoring(self, client):
+        client.receive_response(self.login_response)
+        client.receive_response(self.sync_response)
+        client.receive_response(self.joined_members)
+        client.receive_response(self.keys_query_response)
+
+        room = client.rooms[TEST_ROOM_ID]
+        client.olm.share_group_session(TEST_ROOM_ID, room.users, True)
+        client.receive_response(
+            ShareGroupSessionResponse.from_dict({}, TEST_ROOM_ID, set())
+        )
+        client.olm.group_encrypt(TEST_ROOM_ID, {"type": "m.room.message"})
+
+        session = client.olm.outbound_group_sessions[TEST_ROOM_ID]
+        assert session.shared
+
+        client2 = Client(client.user, client.device_id, client.store_path)
+        client2.receive_response(self.login_response)
+
+        restored = client2.olm.outbound_group_sessions[TEST_ROOM_ID]
+        assert restored.id == session.id
+        assert restored.message_index == session.message_index
+        assert restored.message_count == 1
+        assert restored.creation_time == session.creation_time
+        assert restored.users_ignored == {(ALICE_ID, ALICE_DEVICE_ID)}
+        assert not client2.olm.should_share_group_session(TEST_ROOM_ID)
+
+        # An invalidated session is removed from the store as well.
+        client2.invalidate_outbound_session(TEST_ROOM_ID)
+
+        client3 = Client(client.user, client.device_id, client.store_path)
+        client3.receive_response(self.login_response)
+        assert TEST_ROOM_ID not in client3.olm.outbound_group_sessions
+
+    def test_store_pruning(self, tempdir):
+        config = ClientConfig(store_device_grace_period=3600)
+        client = Client("ephemeral", "DEVICEID", tempdir, config)
+
+        client.receive_response(self.login_response)
+        client.receive_response(self.sync_response)
+        client.receive_response(self.joined_members)
+        client.receive_response(self.keys_query_response)
+
+        devices = {}
+        for user_id in ("@dave:example.org", "@erin:example.org"):
+            devices[user_id] = {"DEVICE": faker.olm_device()}
+            devices[user_id]["DEVICE"].user_id = user_id
+            client.device_store.add(devices[user_id]["DEVICE"])
+
+        client.store.save_device_keys(devices)
+        client.verify_device(devices["@erin:example.org"]["DEVICE"])
+
+        result = client.prune_store()
+        assert not result.device_keys
+        assert "@dave:example.org" in client.device_store.users
+
+        # The grace period is over, only the verified devices are kept.
+        for user_id in client._untracked_users:
+            client._untracked_users[user_id] -= 3600
+
+        result = client.prune_store()
+        assert result.device_keys == 1
+        assert "@dave:example.org" not in client.device_store.users
+        assert "@erin:example.org" in client.device_store.users
+        assert ALICE_ID in client.device_store.users
+
+        client2 = Client(client.user, client.device_id, client.store_path)
+        client2.receive_response(self.login_response)
+        assert "@dave:example.org" not in client2.device_store.users
+        assert "@erin:example.org" in client2.device_store.users
+
     def test_storing_room_encryption_state(self, client):
         client.receive_response(self.login_response)
         assert not client.encrypted_rooms
@@ -1294,6 +1366,61 @@ class TestClass:
         client.receive_response(self.login_response)
         assert client.loaded_sync_token
 
+    def test_store_write_behind(self, client):
+        user = client.user_id
+        device_id = client.device_id
+        path = client.store_path
+        del client
+
+        config = ClientConfig(store_sync_tokens=True, store_write_behind=True)
+        client = Client(user, device_id, path, config=config)
+
+        client.receive_response(self.login_response)
+        assert client.store.write_behind
+
+        client.store.save_sync_token("unflushed")
+        assert client.store.has_pending_writes
+
+        client.receive_response(self.sync_response)
+        assert not client.store.has_pending_writes
+
+        client = Client(user, device_id, path, config=config)
+        client.receive_response(self.login_response)
+        assert client.loaded_sync_token == self.sync_response.next_batch
+
+    def test_store_lazy_group_sessions(self, client):
+        user = client.user_id
+        device_id = client.device_id
+        path = client.store_path
+        del client
+
+        config = ClientConfig(
+            store_lazy_group_sessions=True, store_group_session_cache_size=1
+        )
+        client = Client(user, device_id, path, config=config)
+        client.receive_response(self.login_response)
+
+        assert isinstance(client.olm.inbound_group_store, LazyGroupSessionStore)
+
+        sender_key = client.olm.account.identity_keys["curve25519"]
+        fp_key = client.olm.account.identity_keys["ed25519"]
+        sessions = [OutboundGroupSession() for _ in range(2)]
+
+        for session in sessions:
+            client.olm.create_group_session(
+                sender_key, fp_key, TEST_ROOM_ID, session.id, session.session_key
+            )
+
+        client = Client(user, device_id, path, config=config)
+        client.receive_response(self.login_response)
+
+        for session in sessions:
+            assert client.olm.inbound_group_store.get(
+                TEST_ROOM_ID, sender_key, session.id
+            )
+
+        assert len(list(client.olm.inbound_group_store)) == 2
+
     def test_presence_callback(self, client):
         client.receive_response(self.login_response)
 
@@ -1,13 +1,15 @@
 import copy
 import json
 import os
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import pytest
 from helpers import faker
-from olm import Account, OutboundGroupSession
+from olm import Account, InboundSession, OlmPreKeyMessage, OutboundGroupSession
 
 from nio.crypto import (
     DeviceStore,
@@ -20,6 +22,7 @@ from nio.crypto import (
     Session,
     SessionStore,
 )
+from nio.crypto.sessions import prekey_message_session_id
 from nio.events import (
     DummyEvent,
     ForwardedRoomKeyEvent,
@@ -34,7 +37,7 @@ from nio.events import (
 )
 from nio.exceptions import EncryptionError, GroupEncryptionError, OlmTrustError
 from nio.responses import KeysClaimResponse, KeysQueryResponse, KeysUploadResponse
-from nio.store import DefaultStore, Ed25519Key, Key, KeyStore
+from nio.store import DefaultStore, Ed25519Key, Key, KeyStore, SqliteMemoryStore
 
 AliceId = "@alice:example.org"
 Alice_device = "ALDEVICE"
@@ -110,8 +113,8 @@ class TestClass:
     def _load_response(filename):
         return json.loads(Path(filename).read_text())
 
-    def _get_store(self, user_id, device_id, pickle_key=""):
-        return DefaultStore(user_id, device_id, ephemeral_dir, pickle_key)
+    def _get_store(self, user_id, device_id, pickle_key="", store_path=ephemeral_dir):
+        return DefaultStore(user_id, device_id, store_path, pickle_key)
 
     @staticmethod
     def olm_message_to_event(message_dict, recipient, sender):
@@ -134,11 +137,21 @@ class TestClass:
         olm = self.ephemeral_olm
         assert isinstance(olm.account, Account)
 
-    def _load(self, user_id, device_id, pickle_key=""):
-        return Olm(user_id, device_id, self._get_store(user_id, device_id, pickle_key))
+    def _load(self, user_id, device_id, pickle_key="", store_path=ephemeral_dir):
+        store = self._get_store(user_id, device_id, pickle_key, store_path)
+        return Olm(user_id, device_id, store)
 
-    def test_account_loading(self):
-        olm = self._load("example", "DEVICEID", PICKLE_KEY)
+    def _load_example(self, tempdir):
+        # Opening the store migrates it, work on a copy to keep the fixture at
+        # its original store version.
+        for filename in os.listdir(ephemeral_dir):
+            if filename.startswith("example_DEVICEID."):
+                shutil.copy(os.path.join(ephemeral_dir, filename), tempdir)
+
+        return self._load("example", "DEVICEID", PICKLE_KEY, tempdir)
+
+    def test_account_loading(self, tempdir):
+        olm = self._load_example(tempdir)
         assert isinstance(olm.account, Account)
         assert (
             olm.account.identity_keys["curve25519"]
@@ -222,6 +235,84 @@ class TestClass:
         else:
             assert s2 == store.get(curve_key)
 
+    def test_session_store_index(self):
+        alice, bob, s = self._create_session()
+        curve_key = bob.identity_keys["curve25519"]
+        bob.generate_one_time_keys(1)
+        one_time = list(bob.one_time_keys["curve25519"].values())[0]
+        s2 = OutboundSession(alice, curve_key, one_time)
+        s2.use_time = s.use_time - timedelta(minutes=1)
+
+        store = SessionStore()
+        assert store.add(curve_key, s2)
+        assert store.add(curve_key, s)
+        assert not store.add(
+            curve_key, Session.from_pickle(s.pickle(), s.creation_time)
+        )
+
+        assert store[curve_key] == [s, s2]
+        assert store.get_by_id(curve_key, s2.id) is s2
+        assert not store.get_by_id(curve_key, "unknown")
+        assert not store.get_by_id("unknown", s.id)
+
+        store.mark_used(curve_key, s2)
+        assert store[curve_key] == [s2, s]
+        assert store.get(curve_key) is s2
+
+    def test_prekey_message_session_id(self):
+        _alice, _bob, s = self._create_session()
+        message = s.encrypt("It's a secret to everybody")
+
+        assert isinstance(message, OlmPreKeyMessage)
+        assert prekey_message_session_id(message) == s.id
+        assert prekey_message_session_id(OlmPreKeyMessage("AwoA")) is None
+
+    @ephemeral
+    def test_try_decrypt_stale_sessions(self):
+        olm = self.ephemeral_olm
+        alice = Account()
+        alice_key = alice.identity_keys["curve25519"]
+
+        olm.account.generate_one_time_keys(1)
+        one_time = list(olm.account.one_time_keys["curve25519"].values())[0]
+        alice_session = OutboundSession(
+            alice, olm.account.identity_keys["curve25519"], one_time
+        )
+
+        first_message = alice_session.encrypt("First")
+        second_message = alice_session.encrypt("Second")
+
+        session = olm._create_inbound_session(AliceId, alice_key, first_message)
+        assert session.decrypt(first_message) == "First"
+        session.use_time = datetime.now() - timedelta(days=1)
+        olm.session_store.add(alice_key, session)
+
+        # Sessions that were used more recently, but don't belong to Alice's
+        # messages.
+        for _ in range(2 * olm._max_olm_decryption_attempts):
+            bob = Account()
+            bob.generate_one_time_keys(1)
+            bob_one_time = list(bob.one_time_keys["curve25519"].values())[0]
+            olm.session_store.add(
+                alice_key,
+                OutboundSession(
+                    olm.account, bob.identity_keys["curve25519"], bob_one_time
+                ),
+            )
+
+        alice_session.decrypt(session.encrypt("Reply"))
+        third_message = alice_session.encrypt("Third")
+        assert not isinstance(third_message, OlmPreKeyMessage)
+
+        # The session is too far back to be tried for normal messages.
+        assert olm._try_decrypt(AliceId, alice_key, third_message) is None
+
+        # A pre-key message finds its session directly, which makes it the
+        # most recently used one.
+        assert olm._try_decrypt(AliceId, alice_key, second_message) == "Second"
+        assert olm.session_store.get(alice_key) is session
+        assert olm._try_decrypt(AliceId, alice_key, third_message) == "Third"
+
     def test_device_store(self):
         alice = OlmDevice(
             "example",
@@ -253,8 +344,8 @@ class TestClass:
             olm.session_store.get(bob.identity_keys["curve25519"]), OutboundSession
         )
 
-    def test_olm_session_load(self):
-        olm = self._load("example", "DEVICEID", PICKLE_KEY)
+    def test_olm_session_load(self, tempdir):
+        olm = self._load_example(tempdir)
 
         bob_session = olm.session_store.get(
             "+Qs131S/odNdWG6VJ8hiy9YZW0us24wnsDjYQbaxLk4"
@@ -670,6 +761,181 @@ class TestClass:
         assert isinstance(event, RoomMessageText)
         assert event.decrypted
 
+    def _sharing_machine(self, device_count):
+        """Create an Olm machine with an Olm session for device_count devices.
+
+        The sessions are copies of a single session with a real account, the
+        devices share its identity keys.
+        """
+        machine = Olm(AliceId, Alice_device, SqliteMemoryStore(AliceId, Alice_device))
+
+        bob = Account()
+        bob.generate_one_time_keys(1)
+        bob_keys = bob.identity_keys
+        one_time_key = next(iter(bob.one_time_keys["curve25519"].values()))
+
+        pickle = OutboundSession(
+            machine.account, bob_keys["curve25519"], one_time_key
+        ).pickle()
+
+        devices = {}
+
+        for i in range(device_count):
+            user_id = f"@user{i // 10}:example.org"
+            curve_key = f"curve25519_{i}"
+            device = OlmDevice(
+                user_id,
+                f"DEVICE{i}",
+                {"ed25519": bob_keys["ed25519"], "curve25519": curve_key},
+            )
+            devices.setdefault(user_id, {})[device.id] = device
+            machine.device_store.add(device)
+            machine.session_store.add(
+                curve_key, Session.from_pickle(pickle, datetime.now())
+            )
+
+        machine.store.save_device_keys(devices)
+
+        return machine, bob, list(devices)
+
+    def test_group_session_share_batches(self):
+        machine, bob, users = self._sharing_machine(45)
+
+        batches, template = machine.group_session_share_batches(
+            TEST_ROOM, users, ignore_unverified_devices=True
+        )
+
+        assert [len(batch) for batch in batches] == [20, 20, 5]
+
+        with ThreadPoolExecutor(3) as executor:
+            chunks = list(
+                executor.map(machine.encrypt_olm_batch, batches, [template] * 3)
+            )
+
+        for batch in batches:
+            machine.finish_olm_batch(batch)
+
+        sharing_with = set().union(*(chunk[0] for chunk in chunks))
+        assert len(sharing_with) == 45
+
+        group_session = machine.outbound_group_sessions[TEST_ROOM]
+        user_id, device_id = next(iter(sorted(sharing_with)))
+        device = machine.device_store[user_id][device_id]
+        messages = next(
+            chunk[1]["messages"] for chunk in chunks if (user_id, device_id) in chunk[0]
+        )
+        ciphertext = messages[user_id][device_id]["ciphertext"][device.curve25519]
+
+        message = OlmPreKeyMessage(ciphertext["body"])
+        payload = json.loads(InboundSession(bob, message).decrypt(message))
+
+        assert payload["recipient"] == user_id
+        assert payload["recipient_keys"] == {"ed25519": device.ed25519}
+        assert payload["sender_device"] == Alice_device
+        assert payload["type"] == "m.room_key"
+        assert payload["content"]["session_id"] == group_session.id
+        assert payload["content"]["session_key"] == group_session.session_key
+
+        # All the sessions are copies of a single one and share its id.
+        stored = list(machine.store.load_sessions())
+        assert [session.id for session in stored] == [
+            machine.session_store.get(device.curve25519).id
+        ]
+
+    @pytest.mark.parametrize("devices", [1000, 5000, 20000])
+    @pytest.mark.parametrize("mode", ["serial", "threads"])
+    def test_group_session_sharing_benchmark(self, benchmark, devices, mode):
+        machine, _, users = self._sharing_machine(devices)
+
+        def share_serial():
+            return list(machine.share_group_session_parallel(TEST_ROOM, users, True))
+
+        def share_threads():
+            batches, template = machine.group_session_share_batches(
+                TEST_ROOM, users, True
+            )
+
+            with ThreadPoolExecutor(4) as executor:
+                chunks = list(
+                    executor.map(
+                        machine.encrypt_olm_batch, batches, [template] * len(batches)
+                    )
+                )
+
+            for batch in batches:
+                machine.finish_olm_batch(batch)
+
+            return chunks
+
+        benchmark.group = f"share_group_session_{devices}"
+        chunks = benchmark.pedantic(
+            share_serial if mode == "serial" else share_threads,
+            rounds=1,
+        )
+
+        assert sum(len(sharing_with) for sharing_with, _ in chunks) == devices
+
+    @ephemeral
+    def test_group_decryption_batch(self):
+        olm = self.ephemeral_olm
+
+        def encrypt(room_id, body, event_id):
+            encrypted_dict = olm.group_encrypt(
+                room_id,
+                {
+                    "type": "m.room.message",
+                    "content": {"msgtype": "m.text", "body": body},
+                },
+            )
+            return MegolmEvent.from_dict(
+                {
+                    "type": "m.room.encrypted",
+                    "content": encrypted_dict,
+                    "event_id": event_id,
+                    "sender": "@ephemeral:localhost",
+                    "origin_server_ts": 0,
+                    "room_id": room_id,
+                }
+            )
+
+        events = []
+
+        for room_id in (TEST_ROOM, "!other_room"):
+            olm.create_outbound_group_session(room_id)
+            olm.outbound_group_sessions[room_id].shared = True
+
+            events.extend(encrypt(room_id, f"{i}", f"${room_id}{i}") for i in range(3))
+
+        # The same message index with a different event id, a replayed event.
+        replayed = copy.copy(events[0])
+        replayed.event_id = "$replayed"
+
+        unknown_session = encrypt(TEST_ROOM, "unknown", "$unknown")
+        unknown_session.session_id = "unknown"
+
+        events = [events[0], events[3], unknown_session, *events[1:3], *events[4:]]
+        events.append(replayed)
+
+        batches = olm.megolm_decryption_batches(events, batch_size=2)
+
+        assert [len(batch) for batch in batches] == [4, 3]
+        assert [index for index, _, _ in batches[0]] == [0, 3, 4, 7]
+
+        decrypted = olm.decrypt_megolm_events(events)
+
+        assert [event.body if event else None for event in decrypted] == [
+            "0",
+            "0",
+            None,
+            "1",
+            "2",
+            "1",
+            "2",
+            None,
+        ]
+        assert all(event.decrypted and event.verified for event in decrypted if event)
+        assert decrypted[1].room_id == "!other_room"
+
     @ephemeral
     def test_key_sharing(self):
         olm = self.ephemeral_olm
@@ -1,4 +1,5 @@
 import json
+from dataclasses import dataclass
 from pathlib import Path
 
 from nio.api import PushRuleKind
@@ -13,6 +14,7 @@ from nio.events import (
     DummyEvent,
     EphemeralEvent,
     Event,
+    EventRegistry,
     ForwardedRoomKeyEvent,
     FullyReadEvent,
     InviteAliasEvent,
@@ -467,6 +469,45 @@ class TestClass:
 
         assert isinstance(event, UnknownEvent)
 
+    def test_custom_room_event(self):
+        @dataclass
+        class CustomEvent(Event):
+            @classmethod
+            def from_dict(cls, parsed_dict):
+                return cls(parsed_dict)
+
+        parsed_dict = TestClass._load_response("tests/data/events/unknown.json")
+        event_type = parsed_dict["type"]
+
+        Event.registry.register(event_type, CustomEvent)
+
+        try:
+            event = Event.parse_event(parsed_dict)
+            assert isinstance(event, CustomEvent)
+        finally:
+            Event.registry.unregister(event_type)
+
+        event = Event.parse_event(parsed_dict)
+        assert isinstance(event, UnknownEvent)
+
+    def test_event_registry_prefix(self):
+        registry = EventRegistry()
+
+        @registry.register("org.example", prefix=True)
+        def parse_example(event_dict):
+            return "prefix"
+
+        registry.register("org.example.exact", lambda event_dict: "exact")
+
+        assert registry.get("org.example.exact")({}) == "exact"
+        assert registry.get("org.example.other.event")({}) == "prefix"
+        assert registry.get("org.examples") is None
+        assert "org.example.foo" in registry
+        assert "m.room.message" not in registry
+
+        registry.unregister("org.example", prefix=True)
+        assert registry.get("org.example.other.event") is None
+
     def test_unknown_to_device_event(self):
         parsed_dict = TestClass._load_response(
             "tests/data/events/unknown_to_device.json"
@@ -0,0 +1,138 @@
+import json as std_json
+from pathlib import Path
+
+import pytest
+from hypothesis import given
+from hypothesis import strategies as st
+
+from nio import json
+from nio.api import Api
+
+orjson_required = pytest.mark.skipif(
+    "orjson" not in json.BACKENDS, reason="orjson isn't installed"
+)
+
+json_values = st.recursive(
+    st.none()
+    | st.booleans()
+    | st.integers()
+    | st.floats(allow_nan=False, allow_infinity=False)
+    | st.text(),
+    lambda children: st.lists(children) | st.dictionaries(st.text(), children),
+    max_leaves=20,
+)
+
+SIGNED_OBJECTS = [
+    {
+        "algorithms": ["m.olm.v1.curve25519-aes-sha2", "m.megolm.v1.aes-sha2"],
+        "device_id": "JLAFKJWSCS",
+        "keys": {
+            "curve25519:JLAFKJWSCS": "3C5BFWi2Y8MaVvjM8M22DBmh24PmgR0nPvJOIArzgyI"
+        },
+        "user_id": "@alice:example.org",
+    },
+    {"unicode": "ü日本 \x7f", "control": '\x00\x1f\n\t"\\', "b": [], "a": {}},
+    {"big": 2**64, "negative": -(2**70), "float": 1e16, "small": 1.5e-07},
+    {"nested": {"z": [1, 2.5, None, True, False], "a": {"c": "x", "b": "y"}}},
+]
+
+
+@pytest.fixture
+def json_backend():
+    backend = json.get_backend()
+    yield json.set_backend
+    json.set_backend(backend)
+
+
+class TestClass:
+    def test_default_backend(self):
+        if "orjson" in json.BACKENDS:
+            assert json.DEFAULT_BACKEND == "orjson"
+        else:
+            assert json.DEFAULT_BACKEND == "json"
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError, match="not available"):
+            json.set_backend("simdjson")
+
+    @pytest.mark.parametrize("backend", json.BACKENDS)
+    @pytest.mark.parametrize("obj", SIGNED_OBJECTS)
+    def test_canonical_json(self, json_backend, backend, obj):
+        json_backend(backend)
+
+        expected = std_json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":"), sort_keys=True
+        )
+
+        assert Api.to_canonical_json(obj) == expected
+        assert json.loads(Api.to_json(obj)) == obj
+        assert json.loads(expected.encode()) == obj
+
+    @orjson_required
+    @given(json_values)
+    def test_canonical_json_backends_identical(self, obj):
+        std_backend = json.BACKENDS["json"]()
+        orjson_backend = json.BACKENDS["orjson"]()
+
+        assert orjson_backend.canonical_dumps(obj) == std_backend.canonical_dumps(obj)
+
+    @orjson_required
+    @given(json_values)
+    def test_loads_backends_identical(self, obj):
+        std_backend = json.BACKENDS["json"]()
+        orjson_backend = json.BACKENDS["orjson"]()
+        data = std_backend.dumps(obj)
+
+        assert orjson_backend.loads(data) == std_backend.loads(data)
+        assert orjson_backend.loads(data.encode()) == obj
+
+    @pytest.mark.parametrize("backend", json.BACKENDS)
+    def test_fallbacks(self, json_backend, backend):
+        json_backend(backend)
+
+        assert json.loads('{"a": NaN}')["a"] != 0
+        assert json.loads(str(2**80)) == 2**80
+        assert json.loads('"\\ud800"') == "\ud800"
+        assert json.canonical_dumps({2: "b", 1: "a"}) == '{"1":"a","2":"b"}'
+
+        with pytest.raises(json.JSONDecodeError):
+            json.loads(b'{"a": 1')
+
+    @pytest.mark.parametrize("obj", SIGNED_OBJECTS)
+    def test_signatures_identical(self, json_backend, olm_machine, obj):
+        signatures = {}
+
+        for backend in json.BACKENDS:
+            json_backend(backend)
+            signatures[backend] = olm_machine.sign_json(obj)
+
+        assert len(set(signatures.values())) == 1
+
+        for backend in json.BACKENDS:
+            json_backend(backend)
+
+            for signature in signatures.values():
+                signed = dict(
+                    obj,
+                    signatures={
+                        olm_machine.user_id: {
+                            f"ed25519:{olm_machine.device_id}": signature
+                        }
+                    },
+                )
+
+                assert olm_machine.verify_json(
+                    signed,
+                    olm_machine.account.identity_keys["ed25519"],
+                    olm_machine.user_id,
+                    olm_machine.device_id,
+                )
+
+    @pytest.mark.parametrize("backend", json.BACKENDS)
+    def test_loads_benchmark(self, json_backend, benchmark, backend):
+        json_backend(backend)
+
+        body = Path("tests/data/sync.json").read_bytes()
+
+        benchmark.group = "json_loads"
+        benchmark(json.loads, body)
@@ -5,6 +5,7 @@ from nio.crypto import (
     GroupSessionStore,
     InboundGroupSession,
     OlmAccount,
+    OlmDevice,
     OutboundGroupSession,
     OutboundSession,
     SessionStore,
@@ -81,6 +82,64 @@ class TestClass:
 
         assert fetched_device == device
 
+    def test_device_store_indexes(self):
+        store = DeviceStore()
+        device = faker.olm_device()
+        curve_key = device.curve25519
+
+        assert device not in store
+        assert store.add(device)
+        assert device in store
+        assert not store.add(device)
+        assert list(store.active_user_devices(device.user_id)) == [device]
+
+        store.update_curve25519(device, BOB_CURVE)
+
+        assert not store.device_from_sender_key(device.user_id, curve_key)
+        assert store.device_from_sender_key(device.user_id, BOB_CURVE) is device
+
+        replacement = OlmDevice(
+            device.user_id, device.id, dict(device.keys), display_name="Phone"
+        )
+
+        assert store.add(replacement)
+        assert store.device_from_sender_key(device.user_id, BOB_CURVE) is replacement
+
+        store.mark_deleted(replacement)
+
+        assert replacement.deleted
+        assert not store.device_from_sender_key(device.user_id, BOB_CURVE)
+        assert not list(store.active_user_devices(device.user_id))
+        assert list(store) == [replacement]
+
+    def test_device_store_loading_benchmark(self, benchmark):
+        devices = [
+            OlmDevice(
+                f"@user{user}:example.org",
+                f"DEVICE{device}",
+                {
+                    "ed25519": f"ed25519_{user}_{device}",
+                    "curve25519": f"curve25519_{user}_{device}",
+                },
+            )
+            for user in range(1000)
+            for device in range(100)
+        ]
+
+        def load():
+            store = DeviceStore()
+
+            for device in devices:
+                store.add(device)
+
+            return store
+
+        benchmark.group = "device_store"
+        store = benchmark.pedantic(load, rounds=3)
+
+        assert len(list(store)) == 100_000
+        assert store.device_from_sender_key("@user999:example.org", "curve25519_999_99")
+
     def test_group_session_store(self):
         store = GroupSessionStore()
         account = OlmAccount()
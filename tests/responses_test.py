@@ -17,6 +17,7 @@ from nio.responses import (
     KeysClaimResponse,
     KeysQueryResponse,
     KeysUploadResponse,
+    LazyEventList,
     LoginError,
     LoginInfoResponse,
     LoginResponse,
@@ -172,6 +173,36 @@ class TestClass:
         response = SyncResponse.from_dict(parsed_dict)
         assert isinstance(response, SyncResponse)
 
+    def test_sync_parse_lazy(self):
+        response = SyncResponse.from_dict(_load_response("tests/data/sync.json"))
+        lazy_response = SyncResponse.from_dict(
+            _load_response("tests/data/sync.json"), lazy=True
+        )
+        assert isinstance(lazy_response, SyncResponse)
+
+        room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+        room_info = response.rooms.join[room_id]
+        lazy_room_info = lazy_response.rooms.join[room_id]
+
+        timeline = lazy_room_info.timeline.events
+        assert isinstance(timeline, LazyEventList)
+        assert isinstance(lazy_room_info.state, LazyEventList)
+        assert timeline.parsed_count == 0
+
+        assert timeline[0] == room_info.timeline.events[0]
+        assert timeline.parsed_count == 1
+        assert timeline[0] is timeline[0]
+        assert timeline.source(0)["event_id"] == timeline[0].event_id
+
+        assert len(timeline) == len(room_info.timeline.events)
+        assert timeline == room_info.timeline.events
+        assert lazy_room_info.state == room_info.state
+        assert lazy_room_info.account_data == room_info.account_data
+
+        member_events = list(lazy_room_info.state.iter_types({"m.room.member"}))
+        assert member_events
+        assert all(event.source["type"] == "m.room.member" for event in member_events)
+
     def test_keyshare_request(self):
         parsed_dict = {
             "errcode": "M_LIMIT_EXCEEDED",
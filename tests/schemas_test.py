@@ -0,0 +1,154 @@
+import copy
+import json
+from pathlib import Path
+
+import pytest
+from jsonschema.exceptions import ValidationError
+
+from nio.schemas import (
+    Checker,
+    Schemas,
+    SchemaValidator,
+    Validator,
+    ValidatorRegistry,
+    compile_fast_check,
+    validate_json,
+)
+
+EVENT_SCHEMAS = [
+    ("message_text.json", Schemas.room_message_text),
+    ("member.json", Schemas.room_membership),
+    ("power_levels.json", Schemas.room_power_levels),
+    ("create.json", Schemas.room_create),
+    ("join_rules.json", Schemas.room_join_rules),
+    ("megolm.json", Schemas.room_megolm_encrypted),
+    ("olm.json", Schemas.room_olm_encrypted),
+    ("room_key.json", Schemas.room_key_event),
+    ("receipt.json", Schemas.m_receipt),
+    ("push_rules.json", Schemas.push_rules),
+]
+
+
+def load_event(name):
+    return json.loads(Path(f"tests/data/events/{name}").read_text())
+
+
+def full_validation(instance, schema):
+    Validator(schema, format_checker=Checker).validate(instance)
+
+
+def validation_result(function, instance, schema):
+    try:
+        function(instance, schema)
+    except ValidationError as e:
+        return e.message, instance
+
+    return None, instance
+
+
+class TestClass:
+    def test_schemas_compile(self):
+        schemas = [
+            schema
+            for name, schema in vars(Schemas).items()
+            if not name.startswith("_") and isinstance(schema, dict)
+        ]
+
+        compiled = [compile_fast_check(schema) for schema in schemas]
+
+        # The fast path should cover nearly all of our schemas.
+        assert sum(check is not None for check in compiled) >= len(schemas) - 2
+
+    def test_registry_caching(self):
+        registry = ValidatorRegistry()
+        validator = registry.get(Schemas.room_message)
+
+        assert isinstance(validator, SchemaValidator)
+        assert registry.get(Schemas.room_message) is validator
+        assert validator.fast_check is not None
+
+        registry.set_fast_path(False)
+        validator = registry.get(Schemas.room_message)
+        assert validator.fast_check is None
+
+    @pytest.mark.parametrize(("name", "schema"), EVENT_SCHEMAS)
+    def test_fast_check_matches_full_validation(self, name, schema):
+        event = load_event(name)
+        fast_check = compile_fast_check(schema)
+
+        fast_event = copy.deepcopy(event)
+        full_event = copy.deepcopy(event)
+
+        assert fast_check(fast_event)
+        full_validation(full_event, schema)
+        assert fast_event == full_event
+
+    def test_sync_defaults(self):
+        sync = json.loads(Path("tests/data/sync.json").read_text())
+        del sync["rooms"]["leave"]
+        del sync["to_device"]
+
+        fast_sync = copy.deepcopy(sync)
+        full_sync = copy.deepcopy(sync)
+
+        validate_json(fast_sync, Schemas.sync)
+        full_validation(full_sync, Schemas.sync)
+
+        assert fast_sync == full_sync
+        assert fast_sync["rooms"]["leave"] == {}
+        assert fast_sync["to_device"] == {"events": []}
+
+    @pytest.mark.parametrize(
+        ("instance", "schema"),
+        [
+            ({"type": "m.room.message", "content": {}}, Schemas.room_message),
+            (
+                {"type": "m.room.message", "content": {"msgtype": 1}},
+                Schemas.room_message,
+            ),
+            ({"content": {"msgtype": "m.text"}, "state_key": ""}, Schemas.room_message),
+            ({"sender": "alice", "type": "m.dummy"}, Schemas.dummy_event),
+            ({"origin_server_ts": -1}, Schemas.room_event),
+            ({"visibility": "hidden"}, Schemas.room_get_visibility),
+            ({"foo": "bar"}, Schemas.empty),
+            ({"content": {"join_rule": 1}}, Schemas.room_join_rules),
+            ([], Schemas.room_message),
+        ],
+    )
+    def test_invalid_events(self, instance, schema):
+        fast = validation_result(validate_json, copy.deepcopy(instance), schema)
+        full = validation_result(full_validation, copy.deepcopy(instance), schema)
+
+        assert fast[0] is not None
+        assert fast == full
+
+    def test_validation_benchmark_uncached(self, benchmark):
+        events = [(load_event(name), schema) for name, schema in EVENT_SCHEMAS]
+
+        def validate_all():
+            for event, schema in events:
+                full_validation(event, schema)
+
+        benchmark.group = "validate_json"
+        benchmark(validate_all)
+
+    def test_validation_benchmark_cached(self, benchmark):
+        events = [(load_event(name), schema) for name, schema in EVENT_SCHEMAS]
+        registry = ValidatorRegistry(fast_path=False)
+
+        def validate_all():
+            for event, schema in events:
+                registry.get(schema).validate(event)
+
+        benchmark.group = "validate_json"
+        benchmark(validate_all)
+
+    def test_validation_benchmark_fast_path(self, benchmark):
+        events = [(load_event(name), schema) for name, schema in EVENT_SCHEMAS]
+
+        def validate_all():
+            for event, schema in events:
+                validate_json(event, schema)
+
+        benchmark.group = "validate_json"
+        benchmark(validate_all)
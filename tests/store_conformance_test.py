@@ -0,0 +1,317 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from nio.crypto import (
+    InboundGroupSession,
+    LazyGroupSessionStore,
+    OlmAccount,
+    OlmDevice,
+    OutboundGroupSession,
+    OutboundSession,
+    OutgoingKeyRequest,
+    TrustState,
+)
+from nio.store import (
+    CryptoStore,
+    DefaultStore,
+    SnapshotStore,
+    SqliteMemoryStore,
+    SqliteStore,
+)
+
+BOB_ID = "@bob:example.org"
+BOB_DEVICE = "AGMTSWVYML"
+BOB_CURVE = "T9tOKF+TShsn6mk1zisW2IBsBbTtzDNvw99RBFMJOgI"
+BOB_ONETIME = "6QlQw3mGUveS735k/JDaviuoaih5eEi6S1J65iHjfgU"
+
+TEST_ROOM = "!test:example.org"
+TEST_FORWARDING_CHAIN = [BOB_CURVE, BOB_ONETIME]
+
+STORES = [DefaultStore, SqliteStore, SqliteMemoryStore, SnapshotStore]
+
+
+@pytest.fixture(params=STORES, ids=[store.__name__ for store in STORES])
+def crypto_store(request, tempdir):
+    if request.param is SqliteMemoryStore:
+        store = SqliteMemoryStore("ephemeral", "DEVICEID")
+    else:
+        store = request.param("ephemeral", "DEVICEID", tempdir)
+
+    store.save_account(OlmAccount())
+    return store
+
+
+def reopen(store):
+    """Open the store again, the data of an in-memory store is kept."""
+    if isinstance(store, SqliteMemoryStore):
+        return store
+
+    store.flush()
+    return type(store)(store.user_id, store.device_id, store.store_path)
+
+
+def crash(store):
+    """Open the store again without flushing the deferred writes."""
+    if isinstance(store, SqliteMemoryStore):
+        return store
+
+    return type(store)(store.user_id, store.device_id, store.store_path)
+
+
+def bob_device():
+    return OlmDevice(
+        BOB_ID, BOB_DEVICE, {"ed25519": BOB_ONETIME, "curve25519": BOB_CURVE}
+    )
+
+
+class TestClass:
+    def test_protocol(self, crypto_store):
+        assert isinstance(crypto_store, CryptoStore)
+
+    def test_account(self, crypto_store):
+        account = crypto_store.load_account()
+        account.shared = True
+        crypto_store.save_account(account)
+
+        loaded = reopen(crypto_store).load_account()
+
+        assert loaded.identity_keys == account.identity_keys
+        assert loaded.shared
+
+    def test_sessions(self, crypto_store):
+        account = crypto_store.load_account()
+        old = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        new = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        old.use_time = datetime.now() - timedelta(days=1)
+
+        crypto_store.save_session(BOB_CURVE, old)
+        crypto_store.save_sessions([(BOB_CURVE, new)])
+
+        sessions = reopen(crypto_store).load_sessions()[BOB_CURVE]
+
+        assert [session.id for session in sessions] == [new.id, old.id]
+
+    def test_inbound_group_sessions(self, crypto_store):
+        account = crypto_store.load_account()
+        curve_key = account.identity_keys["curve25519"]
+        session = InboundGroupSession(
+            OutboundGroupSession().session_key,
+            account.identity_keys["ed25519"],
+            curve_key,
+            TEST_ROOM,
+            TEST_FORWARDING_CHAIN,
+        )
+        crypto_store.save_inbound_group_session(session)
+
+        store = reopen(crypto_store)
+        loaded = store.load_inbound_group_session(TEST_ROOM, curve_key, session.id)
+
+        assert loaded.id == session.id
+        assert loaded.ed25519 == session.ed25519
+        assert loaded.forwarding_chain == TEST_FORWARDING_CHAIN
+        assert not store.load_inbound_group_session("!other", curve_key, session.id)
+        assert store.load_inbound_group_sessions().get(TEST_ROOM, curve_key, session.id)
+        assert [s.id for s in store.iter_inbound_group_sessions(TEST_ROOM)] == [
+            session.id
+        ]
+        assert not list(store.iter_inbound_group_sessions("!other"))
+
+        store.lazy_group_sessions = True
+        lazy_store = store.load_inbound_group_sessions()
+
+        assert isinstance(lazy_store, LazyGroupSessionStore)
+        assert lazy_store.get(TEST_ROOM, curve_key, session.id).id == session.id
+
+    def test_outbound_group_sessions(self, crypto_store):
+        session = OutboundGroupSession()
+        session.shared = True
+        session.users_shared_with.add((BOB_ID, BOB_DEVICE))
+        session.users_ignored.add((BOB_ID, "IGNORED"))
+        session.encrypt("It's a secret to everybody")
+        crypto_store.save_outbound_group_session(TEST_ROOM, session)
+
+        loaded = reopen(crypto_store).load_outbound_group_sessions()[TEST_ROOM]
+
+        assert loaded.id == session.id
+        assert loaded.message_count == 1
+        assert loaded.creation_time == session.creation_time
+        assert loaded.shared
+        assert loaded.users_shared_with == {(BOB_ID, BOB_DEVICE)}
+        assert loaded.users_ignored == {(BOB_ID, "IGNORED")}
+
+        new_session = OutboundGroupSession()
+        crypto_store.save_outbound_group_session(TEST_ROOM, new_session)
+
+        loaded = reopen(crypto_store).load_outbound_group_sessions()[TEST_ROOM]
+
+        assert loaded.id == new_session.id
+        assert not loaded.users_shared_with
+
+        crypto_store.remove_outbound_group_session(TEST_ROOM)
+
+        assert not reopen(crypto_store).load_outbound_group_sessions()
+
+    def test_device_keys(self, crypto_store):
+        device = bob_device()
+        device.display_name = "Bob's phone"
+        crypto_store.save_device_keys({BOB_ID: {BOB_DEVICE: device}})
+
+        device.deleted = True
+        crypto_store.save_device_keys({BOB_ID: {BOB_DEVICE: device}})
+
+        loaded = reopen(crypto_store).load_device_keys()[BOB_ID][BOB_DEVICE]
+
+        assert loaded.ed25519 == BOB_ONETIME
+        assert loaded.curve25519 == BOB_CURVE
+        assert loaded.display_name == "Bob's phone"
+        assert loaded.deleted
+        assert loaded.trust_state == TrustState.unset
+
+    @pytest.mark.parametrize(
+        ("trust", "untrust", "check", "state"),
+        [
+            ("verify_device", "unverify_device", "is_device_verified", "verified"),
+            (
+                "blacklist_device",
+                "unblacklist_device",
+                "is_device_blacklisted",
+                "blacklisted",
+            ),
+            ("ignore_device", "unignore_device", "is_device_ignored", "ignored"),
+        ],
+    )
+    def test_trust_states(self, crypto_store, trust, untrust, check, state):
+        device = bob_device()
+        crypto_store.save_device_keys({BOB_ID: {BOB_DEVICE: device}})
+
+        assert not getattr(crypto_store, check)(device)
+        assert not getattr(crypto_store, untrust)(device)
+        assert getattr(crypto_store, trust)(device)
+        assert device.trust_state == TrustState[state]
+
+        store = reopen(crypto_store)
+
+        assert getattr(store, check)(device)
+        assert store.load_device_keys()[BOB_ID][BOB_DEVICE].trust_state == (
+            TrustState[state]
+        )
+        assert getattr(store, untrust)(device)
+        assert not getattr(store, check)(
+            reopen(store).load_device_keys()[BOB_ID][BOB_DEVICE]
+        )
+
+    def test_ignore_devices(self, crypto_store):
+        devices = [
+            bob_device(),
+            OlmDevice(BOB_ID, "OTHER", {"ed25519": BOB_CURVE, "curve25519": BOB_CURVE}),
+        ]
+        crypto_store.save_device_keys({BOB_ID: {d.id: d for d in devices}})
+        crypto_store.ignore_devices(devices)
+
+        store = reopen(crypto_store)
+
+        assert all(store.is_device_ignored(device) for device in devices)
+
+    def test_encrypted_rooms(self, crypto_store):
+        crypto_store.save_encrypted_rooms([TEST_ROOM, "!other:example.org"])
+        crypto_store.delete_encrypted_room("!other:example.org")
+
+        assert reopen(crypto_store).load_encrypted_rooms() == {TEST_ROOM}
+
+    def test_outgoing_key_requests(self, crypto_store):
+        request = OutgoingKeyRequest("ABCDF", "SESSION", TEST_ROOM, "megolm.v1")
+        other = OutgoingKeyRequest("OTHER", "SESSION", TEST_ROOM, "megolm.v1")
+        crypto_store.add_outgoing_key_request(request)
+        crypto_store.add_outgoing_key_request(other)
+        crypto_store.remove_outgoing_key_request(other)
+
+        assert reopen(crypto_store).load_outgoing_key_requests() == {"ABCDF": request}
+
+    def test_sync_token(self, crypto_store):
+        assert not crypto_store.load_sync_token()
+
+        crypto_store.save_sync_token("token1")
+        crypto_store.save_sync_token("token2")
+
+        assert reopen(crypto_store).load_sync_token() == "token2"
+
+    def test_write_behind(self, crypto_store):
+        crypto_store.write_behind = True
+        crypto_store.save_sync_token("token")
+
+        assert crypto_store.has_pending_writes
+        assert crypto_store.load_sync_token() == "token"
+
+        crypto_store.flush()
+
+        assert not crypto_store.has_pending_writes
+        assert reopen(crypto_store).load_sync_token() == "token"
+
+    def test_write_behind_delay(self, crypto_store):
+        crypto_store.write_behind = True
+        crypto_store.write_behind_delay = 0
+        account = crypto_store.load_account()
+
+        crypto_store.save_account(account)
+        crypto_store.save_sync_token("token")
+        crypto_store.save_account(account)
+
+        # The overdue changes are written, the sync token waits for flush().
+        if not isinstance(crypto_store, SqliteMemoryStore):
+            assert not crash(crypto_store).load_sync_token()
+
+        assert crypto_store.has_pending_writes
+
+        crypto_store.flush()
+
+        assert crash(crypto_store).load_sync_token() == "token"
+
+    def test_write_behind_sent_sessions(self, crypto_store):
+        account = crypto_store.load_account()
+        olm_session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        group_session = OutboundGroupSession()
+        group_session.shared = True
+
+        crypto_store.write_behind = True
+        crypto_store.save_sync_token("token")
+        crypto_store.save_outbound_group_session(TEST_ROOM, group_session)
+        group_session.encrypt("It's a secret to everybody")
+        crypto_store.save_outbound_group_session(TEST_ROOM, group_session)
+        olm_session.encrypt("It's a secret to everybody")
+        crypto_store.save_session(BOB_CURVE, olm_session, sent=True)
+
+        # The ratchets of sessions that were used to send messages are never
+        # rolled back, the sync token waits for the flush.
+        store = crash(crypto_store)
+
+        assert store.load_outbound_group_sessions()[TEST_ROOM].message_count == 1
+        assert store.load_sessions()[BOB_CURVE][0].id == olm_session.id
+
+        if not isinstance(store, SqliteMemoryStore):
+            assert not store.load_sync_token()
+
+    def test_prune(self, crypto_store):
+        account = crypto_store.load_account()
+        now = datetime.now()
+        sessions = []
+
+        for i in range(3):
+            session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+            session.use_time = now - timedelta(hours=i)
+            sessions.append((BOB_CURVE, session))
+
+        crypto_store.save_sessions(sessions)
+        crypto_store.save_device_keys({BOB_ID: {BOB_DEVICE: bob_device()}})
+
+        result = crypto_store.prune(2, {BOB_ID})
+
+        assert result.olm_sessions == 1
+        assert result.device_keys == 1
+
+        store = reopen(crypto_store)
+
+        assert [s.id for s in store.load_sessions()[BOB_CURVE]] == [
+            session.id for _, session in sessions[:2]
+        ]
+        assert not store.load_device_keys()[BOB_ID]
@@ -1,12 +1,21 @@
+import asyncio
 import copy
 import os
+import shutil
+import sqlite3
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import chain
+from pathlib import Path
 
 import pytest
 from helpers import ephemeral, ephemeral_dir, faker
 
 from nio.crypto import (
     InboundGroupSession,
+    LazyGroupSessionStore,
     OlmAccount,
     OlmDevice,
     OutboundGroupSession,
@@ -16,14 +25,18 @@ from nio.crypto import (
 )
 from nio.exceptions import OlmTrustError
 from nio.store import (
+    AsyncMatrixStore,
     DefaultStore,
     Ed25519Key,
     Key,
     KeyStore,
     MatrixStore,
+    SnapshotStore,
     SqliteMemoryStore,
     SqliteStore,
+    StoreProfile,
 )
+from nio.store.database import database_lock
 
 BOB_ID = "@bob:example.org"
 BOB_DEVICE = "AGMTSWVYML"
@@ -186,6 +199,130 @@ class TestClass:
         for key in keys:
             assert key not in store2
 
+    def test_key_store_journal(self, tempdir):
+        path = os.path.join(tempdir, "test_store")
+        store = KeyStore(path)
+        keys = [faker.ed25519_key() for _ in range(4)]
+
+        store.add_many(keys[:3])
+        store.add(keys[3])
+        store.add(keys[0])
+
+        with open(path) as f:
+            assert f.readlines() == [key.to_line() for key in keys]
+
+        # Removals compact the file, it never contains removed keys which
+        # older versions would read as trusted.
+        assert store.remove(keys[1])
+        assert not store.remove(keys[1])
+
+        with open(path) as f:
+            assert f.readlines() == [
+                keys[0].to_line(),
+                *(k.to_line() for k in keys[2:]),
+            ]
+
+        store2 = KeyStore(path)
+        assert list(store2) == [keys[0], keys[2], keys[3]]
+        assert len(store2) == 3
+
+    def test_key_store_torn_line(self, tempdir, caplog):
+        path = os.path.join(tempdir, "test_store")
+        store = KeyStore(path)
+        keys = [faker.ed25519_key() for _ in range(2)]
+        store.add_many(keys)
+
+        # Simulate an append that was interrupted in the middle of the
+        # fingerprint.
+        with open(path, "a") as f:
+            f.write(faker.ed25519_key().to_line()[:-10])
+
+        store2 = KeyStore(path)
+        assert list(store2) == keys
+        assert "incomplete last line" in caplog.text
+
+        key = faker.ed25519_key()
+        store2.add(key)
+        assert list(KeyStore(path)) == [*keys, key]
+
+    def test_key_store_skipped_lines(self, tempdir, caplog):
+        path = os.path.join(tempdir, "test_store")
+        store = KeyStore(path)
+        key = Ed25519Key("@a:b", "DEV", "shortkey")
+        store.add(key)
+
+        with open(path, "a") as f:
+            f.write("# A comment\n@a:b OTHER unknown-type key\n")
+
+        # Keys aren't validated, only the invalid line is skipped.
+        assert list(KeyStore(path)) == [key]
+        assert "Ignoring invalid line 3" in caplog.text
+
+    def test_key_store_batch(self, tempdir, monkeypatch):
+        store = KeyStore(os.path.join(tempdir, "test_store"))
+        keys = [faker.ed25519_key() for _ in range(1000)]
+
+        writes = 0
+        fsync = os.fsync
+        compact = store._compact
+
+        def counting_fsync(fd):
+            nonlocal writes
+            writes += 1
+            fsync(fd)
+
+        def counting_compact():
+            nonlocal writes
+            writes += 1
+            compact()
+
+        monkeypatch.setattr(os, "fsync", counting_fsync)
+        monkeypatch.setattr(store, "_compact", counting_compact)
+
+        with store.batch():
+            for key in keys:
+                store.add(key)
+
+            assert writes == 0
+
+        assert writes == 1
+
+        # The removal compacts the file once the batch exits.
+        with store.batch():
+            store.remove(keys[0])
+
+            with store.batch():
+                store.add(keys[0])
+                store.remove(keys[0])
+
+            assert writes == 1
+
+        assert writes == 2
+
+        store2 = KeyStore(os.path.join(tempdir, "test_store"))
+        assert len(store2) == 999
+        assert keys[0] not in store2
+        assert all(key in store2 for key in keys[1:])
+
+    def test_key_store_benchmark(self, tempdir, benchmark):
+        keys = [
+            Ed25519Key(f"@user{i}:example.org", "DEVICEID", f"ed25519_{i}")
+            for i in range(10_000)
+        ]
+
+        def add_and_remove():
+            store = KeyStore(os.path.join(tempdir, "test_store"))
+
+            with store.batch():
+                for key in keys:
+                    store.add(key)
+                    assert key in store
+
+            store.remove_many(keys)
+
+        benchmark.group = "key_store"
+        benchmark.pedantic(add_and_remove, rounds=3)
+
     @ephemeral
     def test_store_opening(self):
         store = self.ephemeral_store
@@ -388,6 +525,42 @@ class TestClass:
         assert in_group.id == loaded_session.id
         assert sorted(loaded_session.forwarding_chain) == sorted(TEST_FORWARDING_CHAIN)
 
+    def test_outbound_group_session_saving(self, store):
+        session = OutboundGroupSession()
+        session.shared = True
+        session.users_shared_with.update({(BOB_ID, BOB_DEVICE), (BOB_ID, "OTHER")})
+        session.users_ignored.add((BOB_ID, "IGNORED"))
+        session.encrypt("It's a secret to everybody")
+        store.save_outbound_group_session(TEST_ROOM, session)
+
+        loaded = self.copy_store(store).load_outbound_group_sessions()[TEST_ROOM]
+
+        assert loaded.id == session.id
+        assert loaded.message_index == session.message_index
+        assert loaded.message_count == 1
+        assert loaded.creation_time == session.creation_time
+        assert loaded.shared
+        assert loaded.users_shared_with == session.users_shared_with
+        assert loaded.users_ignored == session.users_ignored
+
+        session.users_shared_with.add((BOB_ID, "NEW"))
+        store.save_outbound_group_session(TEST_ROOM, session)
+
+        loaded = self.copy_store(store).load_outbound_group_sessions()[TEST_ROOM]
+        assert (BOB_ID, "NEW") in loaded.users_shared_with
+
+        # A new session replaces the old one of the room.
+        new_session = OutboundGroupSession()
+        store.save_outbound_group_session(TEST_ROOM, new_session)
+
+        loaded = self.copy_store(store).load_outbound_group_sessions()[TEST_ROOM]
+        assert loaded.id == new_session.id
+        assert not loaded.shared
+        assert not loaded.users_shared_with
+
+        store.remove_outbound_group_session(TEST_ROOM)
+        assert not self.copy_store(store).load_outbound_group_sessions()
+
     def test_new_store_device_keys(self, store):
         store.load_account()
 
@@ -530,7 +703,7 @@ class TestClass:
     def test_store_versioning(self, store):
         version = store._get_store_version()
 
-        assert version == 2
+        assert version == 3
 
     def test_sqlitestore_verification(self, sqlstore):
         devices = self.example_devices
@@ -627,6 +800,48 @@ class TestClass:
         for device in device_list:
             assert sqlstore.is_device_ignored(device)
 
+    def test_trust_state_cache_sqlite(self, sqlstore, monkeypatch):
+        devices = self._bulk_devices(50, 100)
+        device_list = [device for d in devices.values() for device in d.values()]
+        ignored = device_list[::2]
+        ignored_ids = {(device.user_id, device.id) for device in ignored}
+        verified = device_list[1]
+
+        sqlstore.save_device_keys(devices)
+        sqlstore.ignore_devices(ignored)
+        sqlstore.verify_device(verified)
+
+        store2 = SqliteStore(sqlstore.user_id, sqlstore.device_id, sqlstore.store_path)
+        device_store = store2.load_device_keys()
+        device_list = list(device_store)
+
+        queries = 0
+        execute_sql = store2.database.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            nonlocal queries
+            queries += 1
+            return execute_sql(*args, **kwargs)
+
+        monkeypatch.setattr(store2.database, "execute_sql", counting_execute_sql)
+
+        for device in device_list:
+            assert not store2.is_device_blacklisted(device)
+            assert store2.is_device_verified(device) == (device == verified)
+            assert store2.is_device_ignored(device) == (
+                (device.user_id, device.id) in ignored_ids
+            )
+
+        assert queries == 0
+
+        assert store2.blacklist_device(verified)
+        assert queries > 0
+        assert store2.is_device_blacklisted(verified)
+        assert not store2.is_device_verified(verified)
+
+        store3 = SqliteStore(sqlstore.user_id, sqlstore.device_id, sqlstore.store_path)
+        assert store3.is_device_blacklisted(verified)
+
     def test_trust_state_updating_sqlite(self, sqlstore):
         devices = self.example_devices
         bob_device = devices[BOB_ID][BOB_DEVICE]
@@ -725,3 +940,778 @@ class TestClass:
         sqlstore.save_sync_token(token)
         loaded_token = sqlstore.load_sync_token()
         assert token == loaded_token
+
+    def _create_group_session(self, account):
+        return InboundGroupSession(
+            OutboundGroupSession().session_key,
+            account.identity_keys["ed25519"],
+            account.identity_keys["curve25519"],
+            TEST_ROOM,
+            TEST_FORWARDING_CHAIN,
+        )
+
+    def test_write_behind(self, store):
+        store.write_behind = True
+        account = store.load_account()
+
+        session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        group_session = self._create_group_session(account)
+
+        pickled = 0
+        pickle = session.pickle
+
+        def counting_pickle(*args):
+            nonlocal pickled
+            pickled += 1
+            return pickle(*args)
+
+        session.pickle = counting_pickle
+
+        store.save_session(BOB_CURVE, session)
+        store.save_session(BOB_CURVE, session)
+        store.save_inbound_group_session(group_session)
+        store.save_sync_token("1234")
+
+        assert store.has_pending_writes
+        assert pickled == 0
+
+        # Nothing was written yet, this is what a crash would leave behind.
+        store2 = self.copy_store(store)
+        assert not store2.load_sessions().get(BOB_CURVE)
+        assert not store2.load_inbound_group_sessions().get(
+            TEST_ROOM, account.identity_keys["curve25519"], group_session.id
+        )
+        assert store2.load_sync_token() is None
+
+        # Outbound sessions are written right away, together with the pending
+        # changes except for the sync token.
+        outbound_session = OutboundGroupSession()
+        store.save_outbound_group_session(TEST_ROOM, outbound_session)
+
+        assert pickled == 1
+        assert store2.load_sessions().get(BOB_CURVE).id == session.id
+        assert store2.load_inbound_group_sessions().get(
+            TEST_ROOM, account.identity_keys["curve25519"], group_session.id
+        )
+        assert (
+            store2.load_outbound_group_sessions()[TEST_ROOM].id == outbound_session.id
+        )
+        assert store2.load_sync_token() is None
+
+        store.flush()
+
+        assert not store.has_pending_writes
+        assert pickled == 1
+        assert store2.load_sync_token() == "1234"
+
+    def test_write_behind_flush_is_atomic(self, store, monkeypatch):
+        store.write_behind = True
+        account = store.load_account()
+
+        session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        store.save_session(BOB_CURVE, session)
+        store.save_sync_token("1234")
+
+        def failing_write(token):
+            raise OSError("Disk full")
+
+        monkeypatch.setattr(store, "_write_sync_token", failing_write)
+
+        with pytest.raises(OSError, match="Disk full"):
+            store.flush()
+
+        # The session written before the failure was rolled back.
+        store2 = self.copy_store(store)
+        assert not store2.load_sessions().get(BOB_CURVE)
+        assert store.has_pending_writes
+
+        monkeypatch.undo()
+        store.flush()
+
+        assert store2.load_sessions().get(BOB_CURVE).id == session.id
+        assert store2.load_sync_token() == "1234"
+
+    def test_write_behind_delay(self, store):
+        store.write_behind = True
+        store.write_behind_delay = 0
+        account = store.load_account()
+
+        store.save_sync_token("1234")
+        assert store.has_pending_writes
+
+        group_session = self._create_group_session(account)
+        store.save_inbound_group_session(group_session)
+
+        # The overdue changes were written, the sync token waits for flush()
+        # since the rest of its sync might not be handled yet.
+        store2 = self.copy_store(store)
+        assert store2.load_inbound_group_sessions().get(
+            TEST_ROOM, account.identity_keys["curve25519"], group_session.id
+        )
+        assert store.has_pending_writes
+        assert store2.load_sync_token() is None
+
+        store.flush()
+        assert not store.has_pending_writes
+        assert store2.load_sync_token() == "1234"
+
+    @pytest.mark.parametrize(
+        "sqlite_version", [(3, 23, 0), sqlite3.sqlite_version_info]
+    )
+    def test_device_keys_updating(self, sqlstore, monkeypatch, sqlite_version):
+        monkeypatch.setattr(
+            "nio.store.database.sqlite3.sqlite_version_info", sqlite_version
+        )
+
+        devices = self.example_devices
+        sqlstore.save_device_keys(devices)
+
+        bob_device = devices[BOB_ID][BOB_DEVICE]
+        bob_device.deleted = True
+        bob_device.keys["curve25519"] = BOB_ONETIME
+        sqlstore.save_device_keys({BOB_ID: {BOB_DEVICE: bob_device}})
+
+        device_store = self.copy_store(sqlstore).load_device_keys()
+        loaded_device = device_store[BOB_ID][BOB_DEVICE]
+
+        assert loaded_device.deleted
+        assert loaded_device.curve25519 == BOB_ONETIME
+        assert len(list(device_store)) == len(list(chain(*devices.values())))
+
+    @staticmethod
+    def _bulk_devices(user_count, device_count):
+        devices = defaultdict(dict)
+
+        for user in range(user_count):
+            user_id = f"@user{user}:example.org"
+
+            for device in range(device_count):
+                device_id = f"DEVICE{device}"
+                devices[user_id][device_id] = OlmDevice(
+                    user_id,
+                    device_id,
+                    {
+                        "ed25519": f"ed25519_{user}_{device}",
+                        "curve25519": f"curve25519_{user}_{device}",
+                    },
+                )
+
+        return devices
+
+    def test_store_pruning(self, sqlstore):
+        account = sqlstore.load_account()
+        now = datetime.now()
+
+        sessions = []
+        for i in range(5):
+            session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+            session.use_time = now - timedelta(minutes=i)
+            sessions.append(session)
+
+        other_session = OutboundSession(account, BOB_ONETIME, BOB_CURVE)
+        sqlstore.save_sessions(
+            [(BOB_CURVE, session) for session in reversed(sessions)]
+            + [(BOB_ONETIME, other_session)]
+        )
+
+        sqlstore.save_device_keys(self._bulk_devices(3, 2))
+        device_store = sqlstore.load_device_keys()
+        sqlstore.unverify_device(device_store["@user0:example.org"]["DEVICE0"])
+
+        # Forwarding chains of a session that is gone, foreign keys aren't
+        # enforced by every database that was used with the store.
+        sqlstore.save_inbound_group_session(self._create_group_session(account))
+        sqlstore.database.pragma("foreign_keys", 0)
+        sqlstore.database.execute_sql("DELETE FROM megolminboundsessions")
+        sqlstore.database.pragma("foreign_keys", 1)
+
+        result = sqlstore.prune(2, ["@user0:example.org", "@user1:example.org"])
+
+        assert result.olm_sessions == 3
+        assert result.device_keys == 4
+        assert result.forwarded_chains == len(TEST_FORWARDING_CHAIN)
+
+        store2 = SqliteStore("ephemeral", "DEVICEID", sqlstore.store_path)
+        session_store = store2.load_sessions()
+
+        assert [s.id for s in session_store[BOB_CURVE]] == [s.id for s in sessions[:2]]
+        assert session_store.get(BOB_ONETIME).id == other_session.id
+        assert set(store2.load_device_keys().users) == {"@user2:example.org"}
+
+    @pytest.mark.parametrize("incremental", [True, False])
+    def test_store_vacuum(self, sqlstore, incremental):
+        devices = self._bulk_devices(50, 20)
+        sqlstore.save_device_keys(devices)
+        size = os.path.getsize(sqlstore.database_path)
+
+        sqlstore.prune_device_keys(devices)
+        free_pages = sqlstore.database.pragma("freelist_count")
+        page_size = sqlstore.database.pragma("page_size")
+        assert free_pages > 1
+
+        reclaimed = sqlstore.vacuum(incremental)
+
+        assert sqlstore.database.pragma("freelist_count") == 0
+        assert os.path.getsize(sqlstore.database_path) < size
+
+        if incremental:
+            assert reclaimed == free_pages * page_size
+        else:
+            assert reclaimed >= free_pages * page_size
+
+    def test_store_vacuum_old_database(self, tempdir):
+        # The fixture was created before the store used the incremental
+        # auto-vacuum mode.
+        shutil.copy(os.path.join(ephemeral_dir, "example_DEVICEID.db"), tempdir)
+        store = SqliteStore("example", "DEVICEID", tempdir, "DEFAULT_KEY")
+
+        devices = self._bulk_devices(50, 20)
+        store.save_device_keys(devices)
+        store.prune_device_keys(devices)
+
+        assert store.database.pragma("auto_vacuum") == 0
+        assert store.database.pragma("freelist_count")
+        assert store.vacuum(incremental=True) == 0
+
+        store.vacuum(incremental=False)
+
+        assert store.database.pragma("auto_vacuum") == 2
+        assert store.load_account()
+
+    def test_store_query_plans(self, sqlstore):
+        queries = []
+        execute_sql = sqlstore.database.execute_sql
+
+        def record(sql, params=None, *args, **kwargs):
+            queries.append((sql, params))
+            return execute_sql(sql, params, *args, **kwargs)
+
+        sqlstore.database.execute_sql = record
+
+        account = sqlstore.load_account()
+        session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        group_session = InboundGroupSession(
+            OutboundGroupSession().session_key,
+            account.identity_keys["ed25519"],
+            account.identity_keys["curve25519"],
+            TEST_ROOM,
+            TEST_FORWARDING_CHAIN,
+        )
+        devices = self.example_devices
+        key_request = OutgoingKeyRequest("ABCDF", "ABCDF", TEST_ROOM, "megolm.v1")
+
+        sqlstore.save_session(BOB_CURVE, session)
+        sqlstore.save_inbound_group_session(group_session)
+        sqlstore.save_outbound_group_session(TEST_ROOM, OutboundGroupSession())
+        sqlstore.save_device_keys(devices)
+        sqlstore.verify_device(devices[BOB_ID][BOB_DEVICE])
+        sqlstore.save_encrypted_rooms([TEST_ROOM])
+        sqlstore.add_outgoing_key_request(key_request)
+        sqlstore.save_sync_token("SYNC_TOKEN")
+
+        sqlstore.load_sessions()
+        sqlstore.load_inbound_group_session(
+            TEST_ROOM, group_session.sender_key, group_session.id
+        )
+        sqlstore.load_inbound_group_sessions()
+        list(sqlstore.iter_inbound_group_sessions(TEST_ROOM))
+        sqlstore.load_outbound_group_sessions()
+        sqlstore.load_device_keys()
+        sqlstore.load_encrypted_rooms()
+        sqlstore.load_outgoing_key_requests()
+        sqlstore.load_sync_token()
+        sqlstore.remove_outgoing_key_request(key_request)
+        sqlstore.remove_outbound_group_session(TEST_ROOM)
+        sqlstore.delete_encrypted_room(TEST_ROOM)
+
+        sqlstore.database.execute_sql = execute_sql
+        statements = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+        for sql, params in queries:
+            if not sql.lstrip().upper().startswith(statements):
+                continue
+
+            plan = execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            details = [row[-1] for row in plan]
+
+            for detail in details:
+                assert not detail.startswith("SCAN") or "CONSTANT ROWS" in detail, (
+                    sql,
+                    details,
+                )
+                assert "TEMP B-TREE" not in detail, (sql, details)
+
+    def test_db_upgrade_to_v3(self, tempdir):
+        store = SqliteStore("ephemeral", "DEVICEID", tempdir)
+        store.save_account(OlmAccount())
+        store._update_version(2)
+        store.database.execute_sql("DROP INDEX olmsessions_account_id_last_usage_date")
+        store.database.execute_sql(
+            "DROP INDEX megolminboundsessions_account_id_room_id_session_id"
+        )
+        store.database.close()
+
+        store = SqliteStore("ephemeral", "DEVICEID", tempdir)
+        indexes = store.database.get_indexes("olmsessions") + (
+            store.database.get_indexes("megolminboundsessions")
+        )
+
+        assert store._get_store_version() == 3
+        assert {
+            "olmsessions_account_id_last_usage_date",
+            "megolminboundsessions_account_id_room_id_session_id",
+        } <= {index.name for index in indexes}
+        assert store.load_account()
+
+    def test_db_upgrade_fixture_to_v3(self, tempdir):
+        fixture = os.path.join(ephemeral_dir, "example_DEVICEID.db")
+
+        def store_version(path):
+            with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+                return db.execute("SELECT version FROM storeversion").fetchone()[0]
+
+        # The fixture is a real store as written by the previous version.
+        assert store_version(fixture) == 2
+
+        shutil.copy(fixture, tempdir)
+        store = SqliteStore("example", "DEVICEID", tempdir, "DEFAULT_KEY")
+        indexes = store.database.get_indexes("olmsessions") + (
+            store.database.get_indexes("megolminboundsessions")
+        )
+
+        assert store._get_store_version() == 3
+        assert {
+            "olmsessions_account_id_last_usage_date",
+            "megolminboundsessions_account_id_room_id_session_id",
+        } <= {index.name for index in indexes}
+        assert store.load_account()
+        assert store.load_sessions()
+
+    @pytest.mark.asyncio
+    async def test_async_store(self, sqlstore):
+        async_store = AsyncMatrixStore(sqlstore)
+        store = async_store.threaded_store()
+
+        account = store.load_account()
+        session = OutboundSession(account, BOB_CURVE, BOB_ONETIME)
+        group_session = InboundGroupSession(
+            OutboundGroupSession().session_key,
+            account.identity_keys["ed25519"],
+            account.identity_keys["curve25519"],
+            TEST_ROOM,
+            TEST_FORWARDING_CHAIN,
+        )
+
+        statements = []
+        execute_sql = sqlstore.database.execute_sql
+
+        def record(sql, *args, **kwargs):
+            statements.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+
+        sqlstore.database.execute_sql = record
+
+        # Keep the database thread busy so the following calls queue up.
+        unblock = threading.Event()
+        sqlstore.wait = unblock.wait
+        waiting = asyncio.ensure_future(async_store.wait())
+        await asyncio.sleep(0)
+
+        assert store.save_session(BOB_CURVE, session) is None
+        store.save_inbound_group_session(group_session)
+        store.save_sync_token("SYNC_TOKEN")
+        failing = asyncio.ensure_future(async_store.save_encrypted_rooms(None))
+        await asyncio.sleep(0)
+
+        statements.clear()
+        unblock.set()
+        await waiting
+
+        with pytest.raises(TypeError):
+            await failing
+
+        # The queued calls are committed in one transaction, the failing one
+        # is rolled back on its own.
+        assert statements.count("BEGIN") == 1
+        assert await async_store.load_sync_token() == "SYNC_TOKEN"
+        assert (await async_store.load_sessions()).get(BOB_CURVE).id == session.id
+        assert [s.id async for s in async_store.iter_inbound_group_sessions()] == [
+            group_session.id
+        ]
+        assert [s.id for s in store.iter_inbound_group_sessions(TEST_ROOM)] == [
+            group_session.id
+        ]
+
+        store.save_encrypted_rooms(None)
+
+        with pytest.raises(TypeError):
+            await async_store.flush()
+
+        await async_store.close()
+
+        assert not async_store._thread.is_alive()
+
+        with pytest.raises(RuntimeError):
+            store.save_sync_token("SYNC_TOKEN_2")
+
+    @pytest.mark.asyncio
+    async def test_async_store_batch_lock(self, sqlstore):
+        async_store = AsyncMatrixStore(sqlstore)
+        store = async_store.threaded_store()
+        locked = []
+
+        def lock_is_free():
+            if database_lock.acquire(blocking=False):
+                database_lock.release()
+                return True
+            return False
+
+        execute_sql = sqlstore.database.execute_sql
+
+        def record(sql, *args, **kwargs):
+            if sql == "BEGIN":
+                # Another store checks the lock from its own thread.
+                with ThreadPoolExecutor(1) as executor:
+                    locked.append(not executor.submit(lock_is_free).result())
+            return execute_sql(sql, *args, **kwargs)
+
+        sqlstore.database.execute_sql = record
+
+        unblock = threading.Event()
+        sqlstore.wait = unblock.wait
+        waiting = asyncio.ensure_future(async_store.wait())
+        await asyncio.sleep(0)
+
+        store.save_sync_token("SYNC_TOKEN")
+        store.save_encrypted_rooms([TEST_ROOM])
+
+        unblock.set()
+        await waiting
+        await async_store.flush()
+
+        # The lock that guards the models is only held while a call of the
+        # batch runs, not for the whole transaction.
+        assert locked
+        assert not any(locked)
+        assert await async_store.load_sync_token() == "SYNC_TOKEN"
+
+        await async_store.close()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("store_fixture", ["store", "sqlstore"])
+    async def test_threaded_store_trust_states(self, request, store_fixture):
+        wrapped = request.getfixturevalue(store_fixture)
+        wrapped.save_device_keys(self._bulk_devices(2, 2))
+        wrapped.verify_device(
+            wrapped.load_device_keys()["@user0:example.org"]["DEVICE0"]
+        )
+
+        async_store = AsyncMatrixStore(wrapped)
+        store = async_store.threaded_store()
+
+        jobs = []
+        submit = async_store._submit_function
+
+        def counting_submit(function, *args, **kwargs):
+            jobs.append(function)
+            return submit(function, *args, **kwargs)
+
+        async_store._submit_function = counting_submit
+
+        devices = store.load_device_keys()
+        device = devices["@user0:example.org"]["DEVICE0"]
+        other = devices["@user1:example.org"]["DEVICE1"]
+
+        assert len(jobs) == 1
+
+        # The trust checks don't wait for the database thread.
+        assert store.is_device_verified(device)
+        assert not store.is_device_blacklisted(other)
+        assert len(jobs) == 1
+
+        assert store.blacklist_device(other)
+        assert store.is_device_blacklisted(other)
+        assert not store.is_device_verified(other)
+        assert len(jobs) == 2
+
+        # The trust state of a device that wasn't loaded is loaded once.
+        new_device = OlmDevice(
+            "@user2:example.org", "DEVICE0", {"ed25519": "ed", "curve25519": "curve"}
+        )
+
+        assert not store.is_device_ignored(new_device)
+        assert not store.is_device_verified(new_device)
+        assert len(jobs) == 3
+
+        await async_store.close()
+
+        assert wrapped.is_device_blacklisted(other)
+
+    def test_async_store_memory(self, sqlmemorystore):
+        with pytest.raises(ValueError, match="In-memory"):
+            AsyncMatrixStore(sqlmemorystore)
+
+    def test_device_keys_saving_benchmark(self, sqlstore, benchmark):
+        devices = self._bulk_devices(500, 100)
+
+        benchmark.group = "save_device_keys"
+        benchmark.pedantic(sqlstore.save_device_keys, args=(devices,), rounds=3)
+
+    def test_device_keys_loading_benchmark(self, sqlstore, benchmark):
+        sqlstore.save_device_keys(self._bulk_devices(1000, 100))
+
+        benchmark.group = "load_device_keys"
+        device_store = benchmark.pedantic(sqlstore.load_device_keys, rounds=1)
+
+        assert len(list(device_store)) == 100_000
+
+    @pytest.mark.parametrize(
+        ("profile", "journal_mode"),
+        [(StoreProfile.secure(), "delete"), (StoreProfile.high_throughput(), "wal")],
+    )
+    def test_store_profile(self, tempdir, profile, journal_mode):
+        store = SqliteStore("ephemeral", "DEVICEID", tempdir, profile=profile)
+        store.save_account(OlmAccount())
+
+        pragmas = {
+            pragma: store.database.execute_sql(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ("journal_mode", "mmap_size", "cache_size", "secure_delete")
+        }
+
+        assert pragmas == {
+            "journal_mode": journal_mode,
+            "mmap_size": profile.mmap_size,
+            "cache_size": profile.cache_size,
+            "secure_delete": 1,
+        }
+
+        store2 = SqliteStore("ephemeral", "DEVICEID", tempdir, profile=profile)
+        assert store2.load_account()
+
+    def test_store_binding(self, tempdir):
+        store = DefaultStore("ephemeral", "DEVICEID", tempdir)
+        store2 = SqliteMemoryStore("ephemeral", "DEVICEID")
+
+        for store_ in (store, store2):
+            store_.save_account(OlmAccount())
+            store_.save_sync_token(type(store_).__name__)
+
+        # The models are bound persistently, alternating between the stores
+        # needs to bind them again.
+        assert store.load_sync_token() == "DefaultStore"
+        assert store2.load_sync_token() == "SqliteMemoryStore"
+        assert store.load_sync_token() == "DefaultStore"
+
+        assert all(model._meta.database is store.database for model in store.models)
+
+    @pytest.mark.parametrize(
+        "profile",
+        [StoreProfile.secure(), StoreProfile.high_throughput()],
+        ids=["secure", "high_throughput"],
+    )
+    def test_store_profile_benchmark(self, tempdir, benchmark, profile):
+        store = SqliteStore("ephemeral", "DEVICEID", tempdir, profile=profile)
+        account = OlmAccount()
+        store.save_account(account)
+
+        sessions = [
+            OutboundSession(account, BOB_CURVE, BOB_ONETIME) for _ in range(100)
+        ]
+
+        def save_and_load():
+            for session in sessions:
+                store.save_session(BOB_CURVE, session)
+
+            return store.load_sessions()
+
+        benchmark.group = "store_profile"
+        benchmark.extra_info["sessions"] = len(sessions)
+        session_store = benchmark.pedantic(save_and_load, rounds=3)
+
+        assert len(session_store[BOB_CURVE]) == len(sessions)
+
+    def test_lazy_group_session_store(self, store):
+        account = store.load_account()
+        sessions = [self._create_group_session(account) for _ in range(3)]
+
+        for session in sessions:
+            store.save_inbound_group_session(session)
+
+        store.lazy_group_sessions = True
+        store.group_session_cache_size = 2
+        group_store = store.load_inbound_group_sessions()
+
+        assert isinstance(group_store, LazyGroupSessionStore)
+        assert not group_store._cache
+
+        sender_key = account.identity_keys["curve25519"]
+
+        for session in sessions:
+            loaded = group_store.get(TEST_ROOM, sender_key, session.id)
+            assert loaded.id == session.id
+            assert loaded.forwarding_chain == TEST_FORWARDING_CHAIN
+
+        assert len(group_store._cache) == 2
+        assert not group_store.get(TEST_ROOM_2, sender_key, sessions[0].id)
+
+        new_session = self._create_group_session(account)
+        assert group_store.add(new_session)
+        assert not group_store.add(new_session)
+        assert group_store.get(TEST_ROOM, sender_key, new_session.id) is new_session
+
+        # Added sessions are written through to the database.
+        store2 = self.copy_store(store)
+        assert store2.load_inbound_group_sessions().get(
+            TEST_ROOM, sender_key, new_session.id
+        )
+
+        session_ids = {session.id for session in sessions + [new_session]}
+        assert {session.id for session in group_store} == session_ids
+        assert set(group_store[TEST_ROOM][sender_key]) == session_ids
+        assert not group_store[TEST_ROOM_2]
+
+    def test_lazy_group_session_store_paging(self, store, monkeypatch):
+        account = store.load_account()
+        sessions = [self._create_group_session(account) for _ in range(5)]
+
+        store.write_behind = True
+
+        for session in sessions:
+            store.save_inbound_group_session(session)
+
+        load_page = store._load_inbound_group_session_page
+        monkeypatch.setattr(
+            store,
+            "_load_inbound_group_session_page",
+            lambda room_id, last_id: load_page(room_id, last_id, page_size=2),
+        )
+
+        assert {s.id for s in store.iter_inbound_group_sessions()} == {
+            s.id for s in sessions
+        }
+        assert not store.has_pending_writes
+
+    @pytest.mark.parametrize("lazy", [False, True], ids=["eager", "lazy"])
+    def test_group_session_loading_benchmark(self, store, benchmark, lazy):
+        account = store.load_account()
+        store.write_behind = True
+
+        for _ in range(1000):
+            store.save_inbound_group_session(self._create_group_session(account))
+
+        store.flush()
+        store.lazy_group_sessions = lazy
+
+        benchmark.group = "load_inbound_group_sessions"
+        benchmark(store.load_inbound_group_sessions)
+
+    def test_snapshot_store_journal(self, tempdir):
+        store = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        store.save_account(OlmAccount())
+
+        for i in range(5):
+            store.save_sync_token(f"token{i}")
+
+        store.save_encrypted_rooms([TEST_ROOM, TEST_ROOM_2])
+        store.delete_encrypted_room(TEST_ROOM_2)
+
+        store2 = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        assert store2._journal_length == 9
+        assert store2.load_sync_token() == "token4"
+        assert store2.load_encrypted_rooms() == {TEST_ROOM}
+
+        size = os.path.getsize(store2.database_path)
+        result = store2.prune(10)
+
+        assert result.reclaimed_bytes == size - os.path.getsize(store2.database_path)
+        assert result.reclaimed_bytes > 0
+        assert store2._journal_length == 3
+
+        store3 = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        assert store3.load_account().identity_keys == (
+            store.load_account().identity_keys
+        )
+        assert store3.load_sync_token() == "token4"
+        assert store3.load_encrypted_rooms() == {TEST_ROOM}
+
+    def test_snapshot_store_damaged_tail(self, tempdir):
+        store = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        store.save_sync_token("token1")
+        size = os.path.getsize(store.database_path)
+        store.save_sync_token("token2")
+
+        # Simulate a write that was interrupted.
+        with open(store.database_path, "r+b") as f:
+            f.truncate(os.path.getsize(store.database_path) - 1)
+
+        store2 = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+
+        assert store2.load_sync_token() == "token1"
+        assert os.path.getsize(store2.database_path) == size
+        assert os.listdir(tempdir) == [os.path.basename(store2.database_path)]
+
+        store2.save_sync_token("token3")
+        assert SnapshotStore("ephemeral", "DEVICEID", tempdir).load_sync_token() == (
+            "token3"
+        )
+
+    def test_snapshot_store_compaction_sync_token(self, tempdir):
+        store = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        store.save_sync_token("token1")
+
+        store.write_behind = True
+        store.compaction_threshold = 0
+        store.save_sync_token("token2")
+        store.save_encrypted_rooms([TEST_ROOM])
+        store.save_outbound_group_session(TEST_ROOM, OutboundGroupSession())
+
+        # The file was compacted with the sync token that was flushed last.
+        store2 = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+
+        assert store2.load_encrypted_rooms() == {TEST_ROOM}
+        assert store2.load_sync_token() == "token1"
+        assert store.load_sync_token() == "token2"
+
+        store.flush()
+
+        assert SnapshotStore("ephemeral", "DEVICEID", tempdir).load_sync_token() == (
+            "token2"
+        )
+
+    @pytest.mark.parametrize("position", [-1, 6], ids=["pickle", "header"])
+    def test_snapshot_store_damaged_record(self, tempdir, position):
+        store = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+        store.save_encrypted_rooms([TEST_ROOM])
+        size = os.path.getsize(store.database_path)
+        store.save_account(OlmAccount())
+        account_size = os.path.getsize(store.database_path) - size
+        store.save_sync_token("token1")
+
+        # Damage the account record, other records follow it.
+        with open(store.database_path, "r+b") as f:
+            f.seek(size + position % account_size)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+        damaged = Path(store.database_path).read_bytes()
+
+        store2 = SnapshotStore("ephemeral", "DEVICEID", tempdir)
+
+        assert not store2.load_account()
+        assert store2.load_encrypted_rooms() == {TEST_ROOM}
+        assert store2.load_sync_token() == "token1"
+
+        # The damaged file is kept next to the compacted one.
+        backups = [
+            name
+            for name in os.listdir(tempdir)
+            if name != os.path.basename(store2.database_path)
+        ]
+
+        assert len(backups) == 1
+        assert Path(tempdir, backups[0]).read_bytes() == damaged
+
+        assert SnapshotStore("ephemeral", "DEVICEID", tempdir).load_sync_token() == (
+            "token1"
+        )
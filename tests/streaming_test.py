@@ -0,0 +1,94 @@
+import json
+from json.decoder import JSONDecodeError
+from pathlib import Path
+
+import pytest
+
+from nio.responses import Rooms, SyncResponse
+from nio.streaming import SyncStreamParser
+
+
+def _load_body(filename):
+    return Path(filename).read_bytes()
+
+
+def _parse(body, chunk_size):
+    parser = SyncStreamParser()
+    rooms = []
+
+    for i in range(0, len(body), chunk_size):
+        rooms.extend(parser.feed(body[i : i + chunk_size]))
+
+    rooms.extend(parser.close())
+
+    return rooms, parser.result
+
+
+class TestClass:
+    @pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+    def test_sync_body(self, chunk_size):
+        body = _load_body("tests/data/sync.json")
+        expected = json.loads(body)
+
+        rooms, result = _parse(body, chunk_size)
+
+        for section, room_id, room_dict in rooms:
+            assert expected["rooms"][section].pop(room_id) == room_dict
+
+        assert rooms
+        assert result == expected
+
+    def test_sync_response(self):
+        body = _load_body("tests/data/sync.json")
+        parsed_rooms, result = _parse(body, 100)
+
+        rooms = Rooms({}, {}, {})
+        for section, room_id, room_dict in parsed_rooms:
+            SyncResponse.add_streamed_room(rooms, section, room_id, room_dict)
+
+        response = SyncResponse.from_dict(result, False, rooms)
+        expected = SyncResponse.from_dict(json.loads(body))
+
+        assert isinstance(response, SyncResponse)
+        assert response == expected
+
+    def test_split_unicode(self):
+        body = json.dumps(
+            {
+                "next_batch": "ü",
+                "rooms": {"join": {"!ö:example.org": {"state": {"events": []}}}},
+            },
+            ensure_ascii=False,
+        ).encode()
+
+        rooms, result = _parse(body, 1)
+
+        assert rooms == [("join", "!ö:example.org", {"state": {"events": []}})]
+        assert result == {"next_batch": "ü", "rooms": {"join": {}}}
+
+    def test_numbers_across_chunks(self):
+        parser = SyncStreamParser()
+
+        assert parser.feed(b'{"next_batch": "s1", "count": 12') == []
+        parser.feed(b"34}")
+        parser.close()
+
+        assert parser.result == {"next_batch": "s1", "count": 1234}
+
+    @pytest.mark.parametrize(
+        "body",
+        [
+            b'{"next_batch": "s1", "rooms": {"join": {"!a:b": {}}',
+            b'{"next_batch": "s1" "rooms": {}}',
+            b'{"next_batch": "s1", "rooms": {"join": {"!a:b": {]}}}',
+            b"[]",
+        ],
+    )
+    def test_invalid_body(self, body):
+        def parse():
+            parser = SyncStreamParser()
+            parser.feed(body)
+            parser.close()
+
+        with pytest.raises(JSONDecodeError):
+            parse()